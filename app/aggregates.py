@@ -0,0 +1,363 @@
+import functools
+import operator
+import pickle
+import re
+import tempfile
+from array import array
+from dataclasses import dataclass
+
+from .btree import collate, sort_key
+from .overflow import materialize
+
+MAX_GROUPS_IN_MEMORY = 100_000 # groups held in the hash table before they're spilled to temporary files
+SPILL_PARTITIONS = 16 # temporary files spilled groups are spread over by the hash of their key
+
+# The number at the start of a TEXT value, the way SQLite reads one when adding it up
+NUMERIC_PREFIX = re.compile(rb'\s*([+-]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)')
+
+def sum_operand(value):
+    """
+    The number SUM and AVG add for a non NULL value. TEXT that holds a whole number counts as that number, any other
+    TEXT or BLOB as the REAL value of its numeric prefix (0.0 when it has none), as in SQLite.
+    """
+    if isinstance(value, (int, float)):
+        return value
+    text = materialize(value)
+    match = NUMERIC_PREFIX.match(text)
+    if match is None:
+        return 0.0
+    number = match.group(1)
+    if text[match.end():].strip() or any(char in number for char in b'.eE'):
+        return float(number)
+    return int(number)
+
+class CountRows:
+    """
+    COUNT(*)
+    """
+    def __init__(self):
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+
+    def add_batch(self, values):
+        self.count += len(values)
+
+    def merge(self, other):
+        self.count += other.count
+
+    def result(self):
+        return self.count
+
+class Count(CountRows):
+    """
+    COUNT(column), which skips NULLs.
+    """
+    def add(self, value):
+        if value is not None:
+            self.count += 1
+
+    def add_batch(self, values):
+        # arrays only ever hold numbers
+        self.count += len(values) - (values.count(None) if isinstance(values, list) else 0)
+
+class Sum:
+    """
+    SUM(column) and AVG(column). SUM is an INTEGER while every value added is one and NULL when there were none,
+    AVG is always a REAL.
+    """
+    def __init__(self, average=False):
+        self.average = average
+        self.total = 0
+        self.count = 0
+
+    def add(self, value):
+        if value is not None:
+            self.total += sum_operand(value)
+            self.count += 1
+
+    def add_batch(self, values):
+        if not isinstance(values, array):
+            for value in values:
+                self.add(value)
+            return
+        # added one after the other like add does, so REAL totals come out the same to the last bit
+        self.total = functools.reduce(operator.add, values, self.total)
+        self.count += len(values)
+
+    def merge(self, other):
+        self.total += other.total
+        self.count += other.count
+
+    def result(self):
+        if not self.count:
+            return None
+        return self.total / self.count if self.average else self.total
+
+class Extreme:
+    """
+    MIN(column) or MAX(column), better being operator.lt or operator.gt on sort keys. NULLs are skipped. TEXT is
+    compared under the column's collation, None for BINARY.
+    """
+    def __init__(self, better, collation=None):
+        self.better = better
+        self.collation = collation
+        self.key = None
+        self.value = None
+
+    def add(self, value):
+        if value is None:
+            return
+        key = sort_key(collate(value, self.collation))
+        if self.key is None or self.better(key, self.key):
+            self.key, self.value = key, materialize(value)
+
+    def add_batch(self, values):
+        if not isinstance(values, array):
+            for value in values:
+                self.add(value)
+        elif values:
+            # min and max keep the first of equal values, like add
+            self.add(min(values) if self.better is operator.lt else max(values))
+
+    def merge(self, other):
+        if other.key is not None:
+            self.add(other.value)
+
+    def result(self):
+        return self.value
+
+class Distinct:
+    """
+    The DISTINCT form of an aggregate: each non NULL value is passed on to it once, values the column's collation
+    finds equal counting as one. seen maps each of them, as the collation compares it, to the value passed on.
+    """
+    def __init__(self, accumulator, collation=None):
+        self.accumulator = accumulator
+        self.collation = collation
+        self.seen = {}
+
+    def add(self, value):
+        if value is None:
+            return
+        value = materialize(value)
+        key = collate(value, self.collation)
+        if key not in self.seen:
+            self.seen[key] = value
+            self.accumulator.add(value)
+
+    def add_batch(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        for value in other.seen.values():
+            self.add(value)
+
+    def result(self):
+        return self.accumulator.result()
+
+class LastValue:
+    """
+    A column selected in an aggregate query without being grouped on, SQLite returns its value in the last row of the group.
+    """
+    def __init__(self):
+        self.value = None
+
+    def add(self, value):
+        self.value = materialize(value)
+
+    def add_batch(self, values):
+        if len(values):
+            self.add(values[-1])
+
+    def merge(self, other):
+        self.value = other.value
+
+    def result(self):
+        return self.value
+
+@dataclass
+class AggregateCall:
+    """
+    One aggregate computed for every group. name is COUNT, SUM, AVG, MIN or MAX, or None for a column that isn't grouped
+    on. position is where its argument is in the rows being grouped, None for COUNT(*). collation is the one its
+    column compares TEXT under for MIN, MAX and DISTINCT, None for BINARY.
+    """
+    name: str
+    position: int
+    distinct: bool = False
+    collation: str = None
+
+    def accumulator(self):
+        if self.name is None:
+            return LastValue()
+        elif self.name == 'COUNT':
+            accumulator = CountRows() if self.position is None else Count()
+        elif self.name in ('SUM', 'AVG'):
+            accumulator = Sum(average=self.name == 'AVG')
+        else:
+            accumulator = Extreme(operator.lt if self.name == 'MIN' else operator.gt, self.collation)
+        return Distinct(accumulator, self.collation) if self.distinct else accumulator
+
+def group_sort_key(key):
+    return [sort_key(value) for value in key]
+
+class SpilledGroups:
+    """
+    Groups moved out of the hash table into SPILL_PARTITIONS temporary files, each group going to the file its key
+    hashes to. A key spilled several times is always in the same file, so each file is merged back on its own.
+    """
+    def __init__(self):
+        self.files = [tempfile.TemporaryFile() for _ in range(SPILL_PARTITIONS)]
+
+    def write(self, groups):
+        partitions = [[] for _ in self.files]
+        for key, accumulators in groups.items():
+            partitions[hash(key) % len(partitions)].append((key, accumulators))
+        for file, partition in zip(self.files, partitions):
+            if partition:
+                pickle.dump(partition, file)
+
+    def merged(self):
+        """
+        Yields the groups of one file at a time, with the partial states of keys spilled more than once merged.
+        """
+        for file in self.files:
+            file.seek(0)
+            groups = {}
+            while True:
+                try:
+                    partition = pickle.load(file)
+                except EOFError:
+                    break
+                for key, accumulators in partition:
+                    existing = groups.get(key)
+                    if existing is None:
+                        groups[key] = accumulators
+                    else:
+                        for accumulator, other in zip(existing, accumulators):
+                            accumulator.merge(other)
+            file.close()
+            yield groups
+
+class GroupTable:
+    """
+    The hash table group_rows and group_batches aggregate into: one accumulator per AggregateCall for each group.
+    Once it holds max_groups groups it's spilled to temporary files and emptied.
+    """
+    def __init__(self, calls, max_groups):
+        self.calls = calls
+        self.max_groups = max_groups
+        self.groups = {}
+        self.spilled = None
+
+    def add(self, key):
+        """
+        Starts a group for key, which isn't in the table yet, and returns its accumulators.
+        """
+        if len(self.groups) >= self.max_groups:
+            if self.spilled is None:
+                self.spilled = SpilledGroups()
+            self.spilled.write(self.groups)
+            self.groups.clear()
+        # keys are copied out of the page so they outlive it
+        accumulators = self.groups[tuple([materialize(value) for value in key])] = [call.accumulator() for call in self.calls]
+        return accumulators
+
+    def results(self, grouped=True):
+        """
+        Yields (key, results) per group in key order, or in key order within each spill file once the table was spilled.
+        Without grouped every row is in the one group, which is there even when there were no rows.
+        """
+        if not grouped and not self.groups and self.spilled is None:
+            self.add(())
+
+        if self.spilled is None:
+            partitions = [self.groups]
+        else:
+            self.spilled.write(self.groups)
+            partitions = self.spilled.merged()
+
+        for partition in partitions:
+            for key in sorted(partition, key=group_sort_key):
+                yield key, [accumulator.result() for accumulator in partition[key]]
+
+def group_key_function(group_positions, group_collations):
+    """
+    The function of a row giving its group key: the values at group_positions, TEXT folded by the collation of
+    group_collations at the same place (None for BINARY) so values the collation finds equal share a group.
+    """
+    if not any(group_collations or ()):
+        return lambda row: tuple([row[position] for position in group_positions])
+    return lambda row: tuple([collate(row[position], collation) for position, collation in zip(group_positions, group_collations)])
+
+def group_rows(table_rows, group_positions, calls, max_groups=MAX_GROUPS_IN_MEMORY, group_collations=None):
+    """
+    Streams rows into a hash table keyed on the values at group_positions that only holds one accumulator per
+    AggregateCall for each group, yielding (key, results) per group with results in calls order. With
+    group_collations keys hold TEXT as group_key_function folds it, the values grouped on are then up to the caller.
+
+    Groups come out in key order. Once the hash table holds max_groups groups it's spilled to temporary files and
+    emptied, the spilled groups are merged back at the end and come out in key order within each file instead.
+    Without group_positions every row is in the one group, which is there even when there are no rows.
+    """
+    steps = [call.position for call in calls]
+    table = GroupTable(calls, max_groups)
+    groups = table.groups
+    group_key = group_key_function(group_positions, group_collations)
+
+    for row in table_rows:
+        key = group_key(row)
+        accumulators = groups.get(key)
+        if accumulators is None:
+            accumulators = table.add(key)
+        for accumulator, position in zip(accumulators, steps):
+            accumulator.add(None if position is None else row[position])
+
+    yield from table.results(bool(group_positions))
+
+def take(vector, indexes):
+    """
+    The values of a batch column at indexes, still an array when the column is one.
+    """
+    values = map(vector.__getitem__, indexes)
+    return array(vector.typecode, values) if isinstance(vector, array) else list(values)
+
+def group_batches(batches, group_positions, calls, max_groups=MAX_GROUPS_IN_MEMORY, group_collations=None):
+    """
+    group_rows for ColumnBatches. The rows of a batch are split up by group first, then every accumulator of a group
+    takes the group's values of its column at once through add_batch.
+    """
+    table = GroupTable(calls, max_groups)
+    groups = table.groups
+    group_collations = group_collations or [None] * len(group_positions)
+
+    for batch in batches:
+        if group_positions:
+            members = {}
+            key_columns = [batch.column(position) if collation is None else [collate(value, collation) for value in batch.column(position)]
+                           for position, collation in zip(group_positions, group_collations)]
+            for index, key in enumerate(zip(*key_columns)):
+                indexes = members.get(key)
+                if indexes is None:
+                    members[key] = indexes = []
+                indexes.append(index)
+        else:
+            members = {(): None} # every row of the batch
+
+        vectors = [None if call.position is None else batch.column(call.position) for call in calls]
+        for key, indexes in members.items():
+            accumulators = groups.get(key)
+            if accumulators is None:
+                accumulators = table.add(key)
+            for accumulator, vector in zip(accumulators, vectors):
+                if vector is None:
+                    # COUNT(*) only needs to know how many rows there are
+                    vector = range(batch.length if indexes is None else len(indexes))
+                elif indexes is not None:
+                    vector = take(vector, indexes)
+                accumulator.add_batch(vector)
+
+    yield from table.results(bool(group_positions))
@@ -0,0 +1,563 @@
+import bisect
+import struct
+from dataclasses import dataclass
+
+from .overflow import index_max_local, materialize, read_payload, table_leaf_max_local
+from .pager import READ_AHEAD_PAGES
+from .record_parser import parse_record, parse_record_columns
+from .stats import current as current_stats
+from .varint_parser import parse_varint
+
+DATABASE_HEADER_LENGTH = 100
+LEAF_HEADER_LENGTH = 8
+INTERIOR_HEADER_LENGTH = 12
+
+INTERIOR_INDEX_PAGE = 2
+INTERIOR_TABLE_PAGE = 5
+LEAF_INDEX_PAGE = 10
+LEAF_TABLE_PAGE = 13
+
+@dataclass(init=False)
+class PageHeader:
+    page_type: int
+    first_free_block_start: int
+    number_of_cells: int
+    start_of_content_area: int
+    fragmented_free_bytes: int
+    right_most_pointer: int
+    cell_pointer_array_start: int
+
+    @classmethod
+    def parse_from(cls, page, offset):
+        """
+        Parses a page header as mentioned here: https://www.sqlite.org/fileformat2.html#b_tree_pages
+        """
+        instance = cls()
+
+        (
+            instance.page_type,
+            instance.first_free_block_start,
+            instance.number_of_cells,
+            instance.start_of_content_area,
+            instance.fragmented_free_bytes,
+        ) = struct.unpack_from(">BHHHB", page, offset)
+
+        if instance.page_type in [INTERIOR_TABLE_PAGE, INTERIOR_INDEX_PAGE]:
+            instance.right_most_pointer = int.from_bytes(page[offset + 8:offset + 12], "big")
+            instance.cell_pointer_array_start = offset + INTERIOR_HEADER_LENGTH
+        else:
+            instance.right_most_pointer = None
+            instance.cell_pointer_array_start = offset + LEAF_HEADER_LENGTH
+
+        return instance
+
+def read_page(pager, page_number):
+    """
+    Returns a cached page (a memoryview) along with its parsed header.
+    """
+    page = pager.get_page(page_number)
+    header_offset = DATABASE_HEADER_LENGTH if page_number == 1 else 0  # The database header only lives on the first page
+    return page, PageHeader.parse_from(page, header_offset)
+
+def read_cell_pointers(page, page_header):
+    return struct.unpack_from(f">{page_header.number_of_cells}H", page, page_header.cell_pointer_array_start)
+
+
+@dataclass
+class RowLayout:
+    """
+    The table columns a query needs. Rows are tuples holding just these columns, in table order.
+    """
+    columns: list
+    record_indexes: list
+    rowid_position: int
+    real_positions: tuple = () # columns of REAL affinity, their INTEGER values are read back as REALs
+
+    @classmethod
+    def for_columns(cls, table_columns, needed_columns, rowid_alias=None, real_columns=()):
+        columns = [column for column in table_columns if column in needed_columns]
+        # an INTEGER PRIMARY KEY column is stored as NULL in the record, its value is the rowid
+        rowid_position = columns.index(rowid_alias) if rowid_alias in columns else None
+        real_positions = tuple(position for position, column in enumerate(columns) if column in real_columns)
+        return cls(columns, [table_columns.index(column) for column in columns], rowid_position, real_positions)
+
+    def subset(self, needed_columns):
+        """
+        The layout of the columns in needed_columns alone, which must all be part of this one.
+        """
+        positions = [position for position, column in enumerate(self.columns) if column in needed_columns]
+        rowid_position = positions.index(self.rowid_position) if self.rowid_position in positions else None
+        real_positions = tuple(positions.index(position) for position in self.real_positions if position in positions)
+        return RowLayout([self.columns[position] for position in positions], [self.record_indexes[position] for position in positions],
+                         rowid_position, real_positions)
+
+    def decode(self, page, offset, rowid, overflow=None):
+        values = parse_record_columns(page, offset, self.record_indexes, overflow)
+        if self.rowid_position is not None:
+            values[self.rowid_position] = rowid
+        for position in self.real_positions:
+            values[position] = as_real(values[position])
+        return tuple(values)
+
+def as_real(value):
+    """
+    A value of a REAL column as SQLite reads it: a REAL stored as an INTEGER to save space is a REAL again.
+    """
+    return float(value) if type(value) is int else value
+
+def read_table_cell(pager, page, cell_pointer):
+    """
+    Returns the rowid of a table leaf cell along with (buffer, offset, overflow) to decode its record from.
+    """
+    number_of_bytes_in_payload, offset = parse_varint(page, cell_pointer)
+    rowid, offset = parse_varint(page, offset)
+    return rowid, read_payload(pager, page, offset, number_of_bytes_in_payload, table_leaf_max_local(pager.usable_size))
+
+def read_table_cell_record(pager, page, cell_pointer, column_count):
+    """
+    Fully decodes the record of a table leaf cell, copying every value into bytes.
+    """
+    _rowid, (buffer, offset, overflow) = read_table_cell(pager, page, cell_pointer)
+    if overflow is not None:
+        buffer, offset = overflow.read(0, overflow.size), 0
+    return [materialize(value) for value in parse_record(buffer, offset, column_count)]
+
+def read_pages(pager, page_number):
+    """
+    Yields (page, cell_pointer) for every cell of the table B-tree rooted at page_number, in rowid order.
+    """
+    page, page_header = read_page(pager, page_number)
+
+    if page_header.page_type == LEAF_TABLE_PAGE:
+        for cell_pointer in read_cell_pointers(page, page_header):
+            yield page, cell_pointer
+    elif page_header.page_type == INTERIOR_TABLE_PAGE:
+        yield from read_interior_page(pager, page, page_header)
+        yield from read_pages(pager, page_header.right_most_pointer)
+
+    else:
+        raise Exception(f"Unknown page type {page_header.page_type} on page {page_number}")
+
+def get_leaf_pages(pager, page_number):
+    """
+    Lists the leaf pages of a table or index B-tree in key order while only reading interior pages. The tree is
+    balanced, so once the first child of an interior page is a leaf all of its children are.
+    """
+    page, page_header = read_page(pager, page_number)
+    if page_header.page_type in (LEAF_TABLE_PAGE, LEAF_INDEX_PAGE):
+        return [page_number]
+
+    children = [int.from_bytes(page[cell_pointer:cell_pointer + 4], "big") for cell_pointer in read_cell_pointers(page, page_header)]
+    children.append(page_header.right_most_pointer)
+
+    _, first_child_header = read_page(pager, children[0])
+    if first_child_header.page_type in (LEAF_TABLE_PAGE, LEAF_INDEX_PAGE):
+        return children
+
+    leaf_pages = []
+    for child in children:
+        leaf_pages.extend(get_leaf_pages(pager, child))
+    return leaf_pages
+
+def read_leaf_cells(pager, leaf_page_numbers):
+    """
+    Yields (page, cell_pointer) for every cell of the leaf pages listed, as get_leaf_pages lists them, without going
+    back through the interior pages above them.
+    """
+    for leaf, page_number in enumerate(leaf_page_numbers):
+        if pager.read_ahead_executor is not None:
+            pager.read_ahead(leaf_page_numbers[leaf + 1:leaf + 1 + READ_AHEAD_PAGES])
+        page, page_header = read_page(pager, page_number)
+        for cell_pointer in read_cell_pointers(page, page_header):
+            yield page, cell_pointer
+
+def read_pages_in_range(pager, page_number, first_rowid=None, last_rowid=None, reverse=False):
+    """
+    Yields (page, cell_pointer) for the cells of a table B-tree whose rowid is between first_rowid and last_rowid
+    (both inclusive, None leaves that side open), in rowid order or descending rowid order with reverse. Subtrees
+    outside the range are never read.
+    """
+    page, page_header = read_page(pager, page_number)
+    cell_pointers = read_cell_pointers(page, page_header)
+
+    if page_header.page_type == LEAF_TABLE_PAGE:
+        def cell_rowid(cell_index):
+            return leaf_cell_rowid(page, cell_pointers[cell_index])
+
+        if reverse:
+            end = len(cell_pointers) if last_rowid is None else bisect_cells(len(cell_pointers), cell_rowid, last_rowid + 1)
+            for cell_index in range(end - 1, -1, -1):
+                if first_rowid is not None and cell_rowid(cell_index) < first_rowid:
+                    return
+                yield page, cell_pointers[cell_index]
+            return
+
+        start = 0 if first_rowid is None else bisect_cells(len(cell_pointers), cell_rowid, first_rowid)
+        for cell_index in range(start, len(cell_pointers)):
+            if last_rowid is not None and cell_rowid(cell_index) > last_rowid:
+                return
+            yield page, cell_pointers[cell_index]
+    elif page_header.page_type == INTERIOR_TABLE_PAGE:
+        def integer_key(cell_index):
+            return interior_cell_key(page, cell_pointers[cell_index])
+
+        def child_page(child):
+            if child == len(cell_pointers):
+                return page_header.right_most_pointer
+            return int.from_bytes(page[cell_pointers[child]:cell_pointers[child] + 4], "big")
+
+        if reverse:
+            # child number len(cell_pointers) is the right-most pointer, holding the rowids above every key
+            end = len(cell_pointers) if last_rowid is None else bisect_cells(len(cell_pointers), integer_key, last_rowid)
+            for child in range(end, -1, -1):
+                yield from read_pages_in_range(pager, child_page(child), first_rowid, last_rowid, reverse)
+                if child and first_rowid is not None and integer_key(child - 1) < first_rowid:
+                    return
+            return
+
+        # the left child of a cell holds the rowids <= its key, so the first child that can hold first_rowid is found by bisecting the keys
+        start = 0 if first_rowid is None else bisect_cells(len(cell_pointers), integer_key, first_rowid)
+        for child in range(start, len(cell_pointers)):
+            if pager.read_ahead_executor is not None:
+                pager.read_ahead([child_page(sibling) for sibling in range(child + 1, min(child + 1 + READ_AHEAD_PAGES, len(cell_pointers) + 1))])
+            yield from read_pages_in_range(pager, child_page(child), first_rowid, last_rowid)
+            if last_rowid is not None and integer_key(child) >= last_rowid:
+                return
+        yield from read_pages_in_range(pager, page_header.right_most_pointer, first_rowid, last_rowid)
+
+    else:
+        raise Exception(f"Unknown page type {page_header.page_type} on page {page_number}")
+
+def leaf_cell_rowid(page, cell_pointer):
+    _number_of_bytes_in_payload, offset = parse_varint(page, cell_pointer)
+    rowid, _ = parse_varint(page, offset)
+    return rowid
+
+def interior_cell_key(page, cell_pointer):
+    key, _ = parse_varint(page, cell_pointer + 4) # skip the left pointer
+    return key
+
+def read_interior_page(pager, page, page_header):
+    cell_pointers = read_cell_pointers(page, page_header)
+    # left pointers, then the right-most pointer the caller reads after them
+    children = [int.from_bytes(page[cell_pointer:cell_pointer + 4], "big") for cell_pointer in cell_pointers]
+    children.append(page_header.right_most_pointer)
+
+    for child, page_number in enumerate(children[:-1]):
+        if pager.read_ahead_executor is not None:
+            # the siblings to the right are the next pages this scan reads
+            pager.read_ahead(children[child + 1:child + 1 + READ_AHEAD_PAGES])
+        yield from read_pages(pager, page_number)
+
+def count_table_rows(pager, page_number):
+    """
+    Counts the rows of a table B-tree by summing number_of_cells over its leaf page headers, no cell is read.
+    """
+    page, page_header = read_page(pager, page_number)
+
+    if page_header.page_type == LEAF_TABLE_PAGE:
+        return page_header.number_of_cells
+    elif page_header.page_type == INTERIOR_TABLE_PAGE:
+        row_count = count_table_rows(pager, page_header.right_most_pointer)
+        for cell_pointer in read_cell_pointers(page, page_header):
+            row_count += count_table_rows(pager, int.from_bytes(page[cell_pointer:cell_pointer + 4], "big"))
+        return row_count
+
+    else:
+        raise Exception(f"Unknown page type {page_header.page_type} on page {page_number}")
+
+def get_table_rows(pager, cells, row_layout):
+    """
+    Decodes each table leaf cell into a row tuple laid out by row_layout.
+    """
+    decode = row_layout.decode
+    stats = current_stats.get()
+    if stats is not None:
+        decode = stats.counting_records(decode)
+    for page, cell_pointer in cells:
+        rowid, (buffer, offset, overflow) = read_table_cell(pager, page, cell_pointer)
+        yield decode(buffer, offset, rowid, overflow)
+
+def search_by_rowid(pager, page_number, k, row_layout):
+    for _rowid, row in search_by_rowids(pager, page_number, [k], row_layout):
+        return row
+    return None
+
+def search_by_rowids(pager, page_number, rowids, row_layout):
+    """
+    Yields (rowid, row) for a sorted list of rowids in a single descent of the table B-tree: each interior and leaf
+    page is visited at most once for the whole batch. Rowids that don't exist are skipped.
+    """
+    page, page_header = read_page(pager, page_number)
+    cell_pointers = read_cell_pointers(page, page_header)
+
+    if page_header.page_type == LEAF_TABLE_PAGE:
+        yield from read_leaf_by_rowids(pager, page, cell_pointers, rowids, row_layout)
+    elif page_header.page_type == INTERIOR_TABLE_PAGE:
+        yield from read_interior_page_by_rowids(pager, page, page_header, cell_pointers, rowids, row_layout)
+
+    else:
+        raise Exception(f"Unknown page type {page_header.page_type} on page {page_number}")
+
+def read_interior_page_by_rowids(pager, page, page_header, cell_pointers, rowids, row_layout):
+    def integer_key(cell_index):
+        return interior_cell_key(page, cell_pointers[cell_index])
+
+    start = 0
+    while start < len(rowids):
+        # the left child of the first cell whose key is >= the rowid holds it, the right most pointer holds the largest ones
+        child = bisect_cells(len(cell_pointers), integer_key, rowids[start])
+        if child == len(cell_pointers):
+            child_page_number, end = page_header.right_most_pointer, len(rowids)
+        else:
+            cell_pointer = cell_pointers[child]
+            child_page_number = int.from_bytes(page[cell_pointer:cell_pointer + 4], "big")
+            end = bisect.bisect_right(rowids, integer_key(child), start)
+
+        yield from search_by_rowids(pager, child_page_number, rowids[start:end], row_layout)
+        start = end
+
+def read_leaf_by_rowids(pager, page, cell_pointers, rowids, row_layout):
+    def cell_rowid(cell_index):
+        return leaf_cell_rowid(page, cell_pointers[cell_index])
+
+    decode = row_layout.decode
+    stats = current_stats.get()
+    if stats is not None:
+        decode = stats.counting_records(decode)
+
+    low = 0
+    for k in rowids:
+        # rowids are sorted, so each binary search can start where the previous one ended
+        low = bisect_cells(len(cell_pointers), cell_rowid, k, low)
+        if low < len(cell_pointers) and cell_rowid(low) == k:
+            _rowid, (buffer, offset, overflow) = read_table_cell(pager, page, cell_pointers[low])
+            yield k, decode(buffer, offset, k, overflow)
+
+def bisect_cells(number_of_cells, cell_key, key, low=0):
+    """
+    Index of the first cell whose key is >= key, cell_key reads the key of a cell on demand.
+    """
+    high = number_of_cells
+    while low < high:
+        middle = (low + high) // 2
+        if cell_key(middle) < key:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+# How the built-in collations besides BINARY fold TEXT before comparing it byte by byte
+COLLATIONS = {
+    'NOCASE': bytes.lower, # only the 26 ASCII letters, as in SQLite
+    'RTRIM': lambda text: text.rstrip(b' '),
+}
+
+def collation_name(collation):
+    """
+    The collation a column's COLLATE clause names as collate takes it: None for BINARY (or no COLLATE at all).
+    Collations SQLite doesn't build in are an error, as they are in SQLite without the application defining them.
+    """
+    if collation is None or collation == 'BINARY':
+        return None
+    elif collation not in COLLATIONS:
+        raise Exception(f"no such collation sequence: {collation}")
+    return collation
+
+def collate(value, collation):
+    """
+    value the way the collation named collation compares it: TEXT folded by COLLATIONS, other values as they are.
+    collation None stands for BINARY.
+    """
+    if collation is None or value is None or isinstance(value, (int, float)):
+        return value
+    return COLLATIONS[collation](materialize(value))
+
+def sort_key(value):
+    """
+    Orders values the way SQLite does: NULL < INTEGER/REAL < TEXT/BLOB, with TEXT compared byte by byte (the BINARY collation).
+    """
+    if value is None:
+        return (0, 0)
+    elif isinstance(value, (int, float)):
+        return (1, value)
+    return (2, materialize(value))
+
+def compare_keys(entry, key):
+    """
+    Compares the leading len(key) columns of an index entry against key, returning -1, 0 or 1.
+    """
+    for value, target in zip(entry, key):
+        value, target = sort_key(value), sort_key(target)
+        if value != target:
+            return -1 if value < target else 1
+    return 0
+
+class IndexCursor:
+    """
+    Walks the entries of an index B-tree in key order. Each entry is a list of the indexed column values
+    followed by the rowid.
+
+    The cursor keeps the path from the root to its current position as a stack of
+    [page, page_header, cell_pointers, cell_index] frames. On interior pages cell_index is the child currently
+    being visited, the right-most pointer being child number_of_cells.
+    """
+
+    def __init__(self, pager, rootpage, column_count):
+        self.pager = pager
+        self.rootpage = rootpage
+        self.column_count = column_count
+        self.stack = []
+        stats = current_stats.get()
+        if stats is not None:
+            self.read_entry = stats.counting_index_entries(self.read_entry)
+
+    def read_entry(self, page, page_header, cell_pointer):
+        offset = cell_pointer
+        if page_header.page_type == INTERIOR_INDEX_PAGE:
+            offset += 4 # skip the left pointer
+        number_of_bytes_in_payload, offset = parse_varint(page, offset)
+        buffer, offset, overflow = read_payload(self.pager, page, offset, number_of_bytes_in_payload, index_max_local(self.pager.usable_size))
+        if overflow is not None:
+            buffer, offset = overflow.read(0, overflow.size), 0
+        # memoryviews only support equality, keys need ordering
+        return [materialize(value) for value in parse_record(buffer, offset, self.column_count)]
+
+    def child_page(self, page, page_header, cell_pointers, cell_index):
+        if cell_index == len(cell_pointers):
+            return page_header.right_most_pointer
+        cell_pointer = cell_pointers[cell_index]
+        return int.from_bytes(page[cell_pointer:cell_pointer + 4], "big")
+
+    def seek(self, key=(), inclusive=True):
+        """
+        Positions the cursor on the first entry whose leading columns are >= key (> key when not inclusive),
+        binary searching the cell pointer array of every page on the way down.
+        """
+        self.stack = []
+        page_number = self.rootpage
+        while True:
+            page, page_header = read_page(self.pager, page_number)
+            if page_header.page_type not in (INTERIOR_INDEX_PAGE, LEAF_INDEX_PAGE):
+                raise Exception(f"Unexpected page type {page_header.page_type} in index b-tree")
+            cell_pointers = read_cell_pointers(page, page_header)
+
+            low, high = 0, len(cell_pointers)
+            while low < high:
+                middle = (low + high) // 2
+                comparison = compare_keys(self.read_entry(page, page_header, cell_pointers[middle]), key)
+                if comparison < 0 or (comparison == 0 and not inclusive):
+                    low = middle + 1
+                else:
+                    high = middle
+
+            self.stack.append([page, page_header, cell_pointers, low])
+            if page_header.page_type == LEAF_INDEX_PAGE:
+                return
+            page_number = self.child_page(page, page_header, cell_pointers, low)
+
+    def position(self):
+        """
+        Estimates how far through the index the cursor is, from 0.0 (first entry) to 1.0 (past the last one),
+        from where it sits on each page of its path. This assumes entries are spread evenly over the pages of a level.
+        """
+        position, width = 0.0, 1.0
+        for _page, page_header, cell_pointers, cell_index in self.stack:
+            if page_header.page_type == LEAF_INDEX_PAGE:
+                return position + width * cell_index / max(len(cell_pointers), 1)
+            width /= len(cell_pointers) + 1 # number of children
+            position += width * cell_index
+        return position
+
+    def descend_leftmost(self, page_number):
+        while True:
+            page, page_header = read_page(self.pager, page_number)
+            cell_pointers = read_cell_pointers(page, page_header)
+            self.stack.append([page, page_header, cell_pointers, 0])
+            if page_header.page_type == LEAF_INDEX_PAGE:
+                return
+            page_number = self.child_page(page, page_header, cell_pointers, 0)
+
+    def descend_rightmost(self, page_number):
+        """
+        Positions the cursor past the last entry under page_number, where backwards starts from the end of the index.
+        """
+        while True:
+            page, page_header = read_page(self.pager, page_number)
+            cell_pointers = read_cell_pointers(page, page_header)
+            self.stack.append([page, page_header, cell_pointers, len(cell_pointers)])
+            if page_header.page_type == LEAF_INDEX_PAGE:
+                return
+            page_number = page_header.right_most_pointer
+
+    def backwards(self):
+        """
+        Yields the entries before the current position, from the closest one back to the start of the index.
+        """
+        while self.stack:
+            frame = self.stack[-1]
+            page, page_header, cell_pointers, cell_index = frame
+
+            if cell_index == 0:
+                self.stack.pop()
+            elif page_header.page_type == LEAF_INDEX_PAGE:
+                frame[3] -= 1
+                yield self.read_entry(page, page_header, cell_pointers[cell_index - 1])
+            else:
+                # Back from the child left of cell_index: the previous cell's entry comes next, then the child before it
+                frame[3] -= 1
+                yield self.read_entry(page, page_header, cell_pointers[cell_index - 1])
+                self.descend_rightmost(self.child_page(page, page_header, cell_pointers, cell_index - 1))
+
+    def __iter__(self):
+        """
+        Yields entries from the current position to the end of the index.
+        """
+        while self.stack:
+            frame = self.stack[-1]
+            page, page_header, cell_pointers, cell_index = frame
+
+            if page_header.page_type == LEAF_INDEX_PAGE:
+                if cell_index < len(cell_pointers):
+                    frame[3] += 1
+                    yield self.read_entry(page, page_header, cell_pointers[cell_index])
+                else:
+                    self.stack.pop()
+            elif cell_index < len(cell_pointers):
+                # Back from the left child of this cell: the cell's own entry comes next, then the following child
+                frame[3] += 1
+                yield self.read_entry(page, page_header, cell_pointers[cell_index])
+                self.descend_leftmost(self.child_page(page, page_header, cell_pointers, cell_index + 1))
+            else:
+                self.stack.pop()
+
+def scan_index(pager, rootpage, column_count, lower=None, upper=None, reverse=False):
+    """
+    Yields the index entries between lower and upper, in index order or from upper down to lower with reverse.
+
+    Bounds are (key, inclusive) pairs, key holding values for the leading index columns. None leaves that side open.
+    """
+    cursor = IndexCursor(pager, rootpage, column_count)
+    if reverse:
+        if upper is None:
+            cursor.descend_rightmost(rootpage)
+        else:
+            # on the first entry past upper, everything before it is in range
+            cursor.seek(upper[0], not upper[1])
+
+        for entry in cursor.backwards():
+            if lower is not None:
+                comparison = compare_keys(entry, lower[0])
+                if comparison < 0 or (comparison == 0 and not lower[1]):
+                    return
+            yield entry
+        return
+
+    cursor.seek(*(lower or ()))
+
+    for entry in cursor:
+        if upper is not None:
+            comparison = compare_keys(entry, upper[0])
+            if comparison > 0 or (comparison == 0 and not upper[1]):
+                return
+        yield entry
@@ -0,0 +1,294 @@
+import re
+from dataclasses import dataclass, field
+
+from .btree import read_pages, read_table_cell_record
+
+FILE_CHANGE_COUNTER_OFFSET = 24
+SCHEMA_COOKIE_OFFSET = 40
+
+# Words that end the type name of a column definition and start its constraints
+COLUMN_CONSTRAINTS = {"CONSTRAINT", "PRIMARY", "NOT", "NULL", "UNIQUE", "CHECK", "DEFAULT", "COLLATE", "REFERENCES", "GENERATED", "AS"}
+# Words that start a table constraint rather than a column definition
+TABLE_CONSTRAINTS = {"CONSTRAINT", "PRIMARY", "UNIQUE", "CHECK", "FOREIGN"}
+
+QUOTES = {'"': '"', '`': '`', '[': ']', "'": "'"}
+IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z_0-9$]*')
+# What may follow the column name of an indexed column, anything else makes it an expression
+INDEX_COLUMN_SUFFIX = re.compile(r'(?:COLLATE\s+(\S+)\s*)?(ASC|DESC)?', re.IGNORECASE)
+
+# database path -> ((file change counter, schema cookie), Catalog)
+catalog_cache = {}
+
+@dataclass
+class Table:
+    name: str
+    rootpage: int
+    sql: str
+    columns: list
+    column_types: list
+    column_collations: list # the COLLATE of each column, None for the default BINARY
+    rowid_alias: str # the INTEGER PRIMARY KEY column, stored as the rowid rather than in the record
+    without_rowid: bool # stored as an index b-tree keyed on the primary key, which reads don't support yet
+
+    def affinity(self, column):
+        return column_affinity(self.column_types[self.columns.index(column)])
+
+    @property
+    def real_columns(self):
+        """
+        The columns of REAL affinity, whose whole numbers SQLite may store as INTEGERs to save space.
+        """
+        return [column for column in self.columns if self.affinity(column) == 'REAL']
+
+@dataclass
+class Index:
+    name: str
+    table: str
+    rootpage: int
+    columns: tuple
+    partial: bool # partial indexes (CREATE INDEX ... WHERE) only hold some of the rows
+    descending: tuple # whether each column is sorted DESC
+    collations: tuple # the COLLATE of each column, None when it takes the table column's
+    expressions: bool # some columns are expressions like lower(name), whose values aren't the column's
+
+@dataclass
+class Catalog:
+    """
+    Everything in sqlite_schema, with the CREATE statements parsed once.
+    """
+    schema_rows: list
+    tables: dict = field(default_factory=dict) # lower case name -> Table
+    indexes: list = field(default_factory=list)
+    statistics: dict = field(default_factory=dict) # rootpage -> TreeStatistics, collected by the planner when first needed
+    zone_maps: dict = None # lower case table name -> TableZoneMap, read from the sidecar file when first needed
+
+    @classmethod
+    def from_schema_rows(cls, schema_rows):
+        catalog = cls(schema_rows)
+        for row in schema_rows:
+            if row['type'] == b'table' and row['sql']:
+                table_sql = row['sql'].decode()
+                columns, column_types, column_collations, rowid_alias = parse_column_definitions(table_sql)
+                without_rowid = 'WITHOUT ROWID' in table_sql[parenthesized(table_sql)[1]:].upper()
+                catalog.tables[row['name'].decode().lower()] = Table(row['name'].decode(), row['rootpage'], table_sql, columns, column_types,
+                                                                     column_collations, rowid_alias, without_rowid)
+            elif row['type'] == b'index' and row['sql']:
+                # indexes without sql back UNIQUE / PRIMARY KEY constraints, there's nothing to parse for those
+                columns, partial, descending, collations, expressions = parse_index_definition(row['sql'].decode())
+                catalog.indexes.append(Index(row['name'].decode(), row['tbl_name'].decode(), row['rootpage'], columns, partial,
+                                             descending, collations, expressions))
+        return catalog
+
+    def get_table(self, table_name):
+        table = self.tables.get(table_name.lower())
+        if table is None:
+            raise Exception(f"no such table: {table_name}")
+        if table.without_rowid:
+            raise Exception(f"WITHOUT ROWID tables aren't supported: {table_name}")
+        return table
+
+    def get_indexes(self, table_name):
+        """
+        The indexes of a table that reads can go through: IndexCursor seeks and walks keys in ascending BINARY order,
+        so indexes sorting a column DESC or comparing it under another collation are left out, as are partial and
+        expression indexes.
+        """
+        table = self.tables.get(table_name.lower())
+        return [index for index in self.indexes if index.table.lower() == table_name.lower() and table is not None
+                and not index.partial and not index.expressions and not any(index.descending)
+                and all(collation == 'BINARY' for collation in index_collations(index, table))]
+
+def column_affinity(column_type):
+    """
+    The affinity of a declared column type, following https://www.sqlite.org/datatype3.html#determination_of_column_affinity
+    """
+    column_type = column_type.upper()
+    if 'INT' in column_type:
+        return 'INTEGER'
+    elif any(name in column_type for name in ('CHAR', 'CLOB', 'TEXT')):
+        return 'TEXT'
+    elif 'BLOB' in column_type or not column_type:
+        return 'BLOB'
+    elif any(name in column_type for name in ('REAL', 'FLOA', 'DOUB')):
+        return 'REAL'
+    return 'NUMERIC'
+
+def index_collations(index, table):
+    """
+    The collation each column of an index sorts by, the table column's when the index doesn't name one.
+    """
+    collations = []
+    for column, collation in zip(index.columns, index.collations):
+        if collation is None and column in table.columns:
+            collation = table.column_collations[table.columns.index(column)]
+        collations.append(collation or 'BINARY')
+    return collations
+
+def load_catalog(pager):
+    """
+    Returns the catalog of the database behind pager, reusing the one parsed earlier as long as the file change counter
+    and schema cookie in the database header haven't moved. Every pager keeps the version it last saw, so each one
+    drops its own cached pages once the file changes, whichever pager notices first.
+    """
+    header = pager.read_database_header()
+    version = (
+        int.from_bytes(header[FILE_CHANGE_COUNTER_OFFSET:FILE_CHANGE_COUNTER_OFFSET + 4], "big"),
+        int.from_bytes(header[SCHEMA_COOKIE_OFFSET:SCHEMA_COOKIE_OFFSET + 4], "big"),
+    )
+
+    if pager.database_version is not None and pager.database_version != version:
+        pager.clear() # the file changed underneath us, cached pages may be stale
+    pager.database_version = version
+
+    cached = catalog_cache.get(pager.database_path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    catalog = Catalog.from_schema_rows(generate_schema_rows(pager))
+    catalog_cache[pager.database_path] = (version, catalog)
+    return catalog
+
+def generate_schema_rows(pager):
+    """
+    Reads every row of sqlite_schema, whose B-tree is rooted at page 1 and may span many pages.
+    """
+    sqlite_schema_rows = []
+
+    for page, cell_pointer in read_pages(pager, 1):
+        record = read_table_cell_record(pager, page, cell_pointer, 5)
+
+        # Table contains columns: type, name, tbl_name, rootpage, sql
+        sqlite_schema_rows.append({
+            'type': record[0],
+            'name': record[1],
+            'tbl_name': record[2],
+            'rootpage': record[3],
+            'sql': record[4],
+        })
+
+    return sqlite_schema_rows
+
+def split_top_level(text):
+    """
+    Splits on the commas that aren't nested in parentheses or quotes, e.g. in DECIMAL(10,2) or DEFAULT 'a,b'.
+    """
+    parts = []
+    depth = 0
+    closing_quote = None
+    start = 0
+    for position, char in enumerate(text):
+        if closing_quote:
+            if char == closing_quote:
+                closing_quote = None
+        elif char in QUOTES:
+            closing_quote = QUOTES[char]
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            parts.append(text[start:position])
+            start = position + 1
+    parts.append(text[start:])
+    return parts
+
+def parenthesized(text, start=0):
+    """
+    The text inside the first parenthesis found from start, up to the matching closing one.
+    """
+    open_paren = text.index('(', start)
+    depth = 0
+    closing_quote = None
+    for position in range(open_paren, len(text)):
+        char = text[position]
+        if closing_quote:
+            if char == closing_quote:
+                closing_quote = None
+        elif char in QUOTES:
+            closing_quote = QUOTES[char]
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                return text[open_paren + 1:position], position + 1
+    raise Exception(f"Unbalanced parentheses in {text}")
+
+def split_identifier(definition):
+    """
+    Splits the leading identifier off a column definition, returning (name, rest, quoted).
+    Quoted names like "size range" may contain spaces.
+    """
+    definition = definition.strip()
+    if definition[0] in QUOTES:
+        closing = definition.index(QUOTES[definition[0]], 1)
+        return definition[1:closing], definition[closing + 1:], True
+
+    name, _, rest = definition.partition(' ')
+    if '(' in name:
+        # e.g. PRIMARY KEY(a) with no space before the parenthesis
+        name, _, rest = definition.partition('(')
+        rest = '(' + rest
+    return name, rest, False
+
+def parse_column_definitions(table_sql):
+    """
+    Returns the column names, their declared types and the name of the rowid alias column (None if there isn't one),
+    following https://www.sqlite.org/lang_createtable.html#rowid
+    """
+    columns = []
+    column_types = []
+    column_collations = []
+    primary_key = []
+
+    body, _ = parenthesized(table_sql)
+    for definition in split_top_level(body):
+        name, rest, quoted = split_identifier(definition)
+        words = rest.split()
+        if not quoted and name.upper() in TABLE_CONSTRAINTS:
+            constraint = (name + ' ' + rest).upper()
+            if 'PRIMARY KEY' in constraint:
+                primary_key = [split_identifier(column)[0] for column in split_top_level(parenthesized(name + ' ' + rest)[0])]
+            continue
+
+        type_words = []
+        for word in words:
+            if word.upper() in COLUMN_CONSTRAINTS:
+                break
+            type_words.append(word)
+        columns.append(name)
+        column_types.append(' '.join(type_words))
+        upper_words = [word.upper() for word in words]
+        collate = upper_words.index('COLLATE') if 'COLLATE' in upper_words[:-1] else None
+        column_collations.append(None if collate is None else split_identifier(words[collate + 1])[0].upper())
+
+        constraints = ' '.join(words[len(type_words):]).upper()
+        if 'PRIMARY KEY' in constraints and 'PRIMARY KEY DESC' not in constraints:
+            primary_key = [name]
+
+    rowid_alias = None
+    if len(primary_key) == 1 and primary_key[0] in columns:
+        if column_types[columns.index(primary_key[0])].upper() == 'INTEGER':
+            rowid_alias = primary_key[0]
+
+    return columns, column_types, column_collations, rowid_alias
+
+def parse_index_definition(index_sql):
+    """
+    Returns the indexed column names, whether the index is partial, whether each column is sorted DESC, the
+    collation each column names (None if it doesn't) and whether any column is an expression rather than a name.
+    """
+    _, _, after_on = index_sql.upper().partition(' ON ')
+    column_list, end = parenthesized(index_sql, len(index_sql) - len(after_on))
+    columns, descending, collations = [], [], []
+    expressions = False
+    for definition in split_top_level(column_list):
+        name, rest, quoted = split_identifier(definition)
+        suffix = INDEX_COLUMN_SUFFIX.fullmatch(rest.strip())
+        if suffix is None or not quoted and IDENTIFIER.fullmatch(name) is None:
+            expressions = True
+            suffix = INDEX_COLUMN_SUFFIX.fullmatch('')
+        columns.append(name)
+        collations.append(suffix.group(1) and split_identifier(suffix.group(1))[0].upper())
+        descending.append((suffix.group(2) or '').upper() == 'DESC')
+    return tuple(columns), 'WHERE' in index_sql[end:].upper(), tuple(descending), tuple(collations), expressions
@@ -0,0 +1,82 @@
+import asyncio
+import collections
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+from .main import query_rows
+from .overflow import materialize
+from .pager import DEFAULT_CACHE_SIZE, Pager
+
+DEFAULT_WORKERS = 4 # statements read in parallel, more of them queue up for a thread
+READ_AHEAD_THREADS = 2
+FETCH_SIZE = 256 # rows pulled from a statement per trip to the thread pool
+
+class Database:
+    """
+    An asyncio front end to the engine, for embedding it in an event loop:
+
+        async with Database("companies.db") as db:
+            async for row in await db.execute("select id, name from companies where country = 'chad'"):
+                ...
+
+    Statements are planned and read on a pool of threads, so the event loop never blocks on the file. Concurrent
+    statements share the one Pager and its page cache, which reads ahead of table scans on its own threads.
+    """
+
+    def __init__(self, database_path, cache_size=DEFAULT_CACHE_SIZE, use_mmap=False, workers=DEFAULT_WORKERS, vectorized=False):
+        self.pager = Pager(database_path, cache_size=cache_size, use_mmap=use_mmap, read_ahead_threads=READ_AHEAD_THREADS)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="statement")
+        self.vectorized = vectorized
+
+    async def execute(self, command):
+        """
+        Plans a SELECT or EXPLAIN QUERY PLAN statement, raising any error in it, and returns an AsyncRows over its
+        result rows. Nothing past the plan is read until the rows are iterated over.
+        """
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(self.executor, functools.partial(query_rows, self.pager, command, vectorized=self.vectorized))
+        return AsyncRows(loop, self.executor, result)
+
+    def close(self):
+        self.executor.shutdown()
+        self.pager.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+class AsyncRows:
+    """
+    The result rows of a statement as an async iterator of tuples. Rows are pulled from the engine on the thread
+    pool FETCH_SIZE at a time, so the event loop waits on the pool once per chunk rather than once per row.
+
+    TEXT and BLOB values come back as bytes, copied out of the pages they were read from.
+    """
+
+    def __init__(self, loop, executor, result):
+        self.loop = loop
+        self.executor = executor
+        self.rows = iter(result)
+        self.fetched = collections.deque()
+        self.exhausted = False
+
+    def fetch(self):
+        return [tuple(materialize(value) for value in row) for row in itertools.islice(self.rows, FETCH_SIZE)]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.fetched and not self.exhausted:
+            rows = await self.loop.run_in_executor(self.executor, self.fetch)
+            self.exhausted = len(rows) < FETCH_SIZE
+            self.fetched.extend(rows)
+        if not self.fetched:
+            raise StopAsyncIteration
+        return self.fetched.popleft()
+
+    async def fetchall(self):
+        return [row async for row in self]
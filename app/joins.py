@@ -0,0 +1,464 @@
+import itertools
+import pickle
+import tempfile
+from dataclasses import dataclass
+
+from .btree import RowLayout, scan_index, search_by_rowids
+from .overflow import materialize
+from .planner import (
+    INDEX_ENTRY_COST,
+    PAGE_COST,
+    ROW_COST,
+    ROWID_LOOKUP_COST,
+    explain_lines,
+    get_tree_statistics,
+    plan_query,
+)
+from .predicates import apply_affinities, apply_collations, compile_predicate, get_conjuncts, get_where_columns
+
+HASH_COST = 0.5 # adding a row to a join's hash table or probing it with one, on top of reading the row
+MAX_BUILD_ROWS = 200_000 # rows a hash join holds in memory before both of its sides are partitioned to temporary files
+JOIN_PARTITIONS = 16 # temporary files each side of a partitioned hash join is spread over by the hash of the key
+FIRST_PROBE_BATCH_SIZE = 16 # rows probing an index per batch, doubling up to PROBE_BATCH_SIZE so a LIMIT stops early
+PROBE_BATCH_SIZE = 4096
+PARTITION_BATCH_SIZE = 1024 # rows pickled together when writing a partition
+MAX_REORDERED_TABLES = 4 # inner joins of up to this many tables are planned in every order
+
+@dataclass
+class JoinStep:
+    """
+    How one table of the FROM clause is joined to the rows of the tables before it, with strategy being:
+
+    - 'hash': the table is read through plan and joined on left_keys = right_keys through a hash table, built over
+      the rows of the table or, with build_left, over the rows before it when there are fewer of those
+    - 'index': each row before it looks its matches up through index, or the table's rowid when index is None, on
+      the first of the keys
+
+    Column names are qualified with the table's alias on the joined side (left_keys, condition) and bare on the table's
+    side (right_keys, filter), where filter holds the predicates on the table alone. condition is the rest of the join
+    condition, checked on joined rows. Rows of a LEFT JOIN that match nothing get NULLs for the table's columns.
+    """
+    alias: str
+    table: object
+    left_join: bool
+    strategy: str
+    left_keys: list
+    right_keys: list
+    row_layout: RowLayout
+    plan: object
+    filter: dict
+    condition: dict
+    index: object = None
+    build_left: bool = False
+    rows: float = 0.0 # estimated rows joined so far
+    cost: float = 0.0
+
+@dataclass
+class JoinPlan:
+    """
+    Reads the first table through first, then joins the other tables one step at a time. where is what's left of
+    the WHERE clause once predicates were pushed into the steps, checked on the joined rows whose columns are named
+    alias.column in columns.
+    """
+    alias: str
+    first: object
+    row_layout: RowLayout
+    first_where: dict
+    steps: list
+    where: dict
+    columns: list
+    cost: float = 0.0
+
+    def explain(self, orderby, groupby=None):
+        steps = [self.first.describe(self.alias)]
+        for step in self.steps:
+            if step.strategy == 'index' and step.index is None:
+                steps.append(f"SEARCH {step.alias} USING INTEGER PRIMARY KEY (rowid=?)")
+            elif step.strategy == 'index':
+                steps.append(f"SEARCH {step.alias} USING INDEX {step.index.name} ({step.right_keys[0]}=?)")
+            elif step.right_keys:
+                keys = " AND ".join(f"{column}=?" for column in step.right_keys)
+                steps.append(f"SEARCH {step.alias} USING HASH TABLE ({keys})")
+            else:
+                steps.append(step.plan.describe(step.alias))
+            if step.left_join:
+                steps[-1] += " LEFT-JOIN"
+        if groupby:
+            steps.append("USE TEMP B-TREE FOR GROUP BY")
+        if orderby:
+            steps.append("USE TEMP B-TREE FOR ORDER BY")
+        return explain_lines(steps)
+
+def and_all(predicates):
+    """
+    The AND of a list of predicates, None when it's empty.
+    """
+    expr = None
+    for predicate in predicates:
+        expr = predicate if expr is None else {'type': 'binary_expr', 'operator': 'AND', 'left': expr, 'right': predicate}
+    return expr
+
+def rename_columns(expr, names):
+    """
+    A copy of expr with its column references renamed through the names dict.
+    """
+    if isinstance(expr, list):
+        return [rename_columns(item, names) for item in expr]
+    elif not isinstance(expr, dict):
+        return expr
+    elif expr.get('type') == 'column_ref':
+        return dict(expr, column=names.get(expr['column'], expr['column']))
+    return {key: rename_columns(value, names) for key, value in expr.items()}
+
+def resolve_columns(sql_ast, sources):
+    """
+    Returns a copy of sql_ast in which every column reference names a column of the rows the FROM clause produces.
+    sources are the (alias, Table) pairs of the FROM clause, the alias being the table name when it has none.
+
+    With a single table that's the bare column name and a lone * is left for the caller to expand. With joins columns
+    are named alias.column and * and alias.* are expanded. ORDER BY terms naming an output column alias are left alone.
+    The literals WHERE and ON compare columns with are converted to the columns' affinity by apply_affinities, and
+    their comparisons tagged with the columns' collation by apply_collations.
+    """
+    def column_name(alias, column):
+        return column if len(sources) == 1 else f"{alias}.{column}"
+
+    def find(node):
+        if 'table' in node:
+            for alias, table in sources:
+                if alias.lower() == node['table'].lower() and node['column'] in table.columns:
+                    return column_name(alias, node['column'])
+            raise Exception(f"no such column: {node['table']}.{node['column']}")
+        if len(sources) == 1:
+            return node['column']
+
+        aliases = [alias for alias, table in sources if node['column'] in table.columns]
+        if not aliases:
+            raise Exception(f"no such column: {node['column']}")
+        elif len(aliases) > 1:
+            raise Exception(f"ambiguous column name: {node['column']}")
+        return column_name(aliases[0], node['column'])
+
+    def resolve(node):
+        if isinstance(node, list):
+            return [resolve(item) for item in node]
+        elif not isinstance(node, dict):
+            return node
+        elif node.get('type') == 'column_ref':
+            return {'type': 'column_ref', 'column': find(node)}
+        return {key: resolve(value) for key, value in node.items()}
+
+    columns = []
+    for column in sql_ast['columns']:
+        expr = column['expr']
+        if expr['type'] != 'column_ref' or expr['column'] != '*':
+            columns.append(resolve(column))
+        elif len(sources) == 1 and 'table' not in expr:
+            columns.append(column)
+        else:
+            matching = [(alias, table) for alias, table in sources if 'table' not in expr or alias.lower() == expr['table'].lower()]
+            if not matching:
+                raise Exception(f"no such table: {expr['table']}")
+            for alias, table in matching:
+                columns.extend({'expr': {'type': 'column_ref', 'column': column_name(alias, name)}, 'as': None} for name in table.columns)
+
+    aliases = {column['as'] for column in sql_ast['columns'] if column['as']}
+    orderby = None
+    if sql_ast['orderby']:
+        orderby = [
+            term if term['expr'] == {'type': 'column_ref', 'column': term['expr'].get('column')} and term['expr']['column'] in aliases
+            else resolve(term)
+            for term in sql_ast['orderby']
+        ]
+
+    affinities = {column_name(alias, column): table.affinity(column) for alias, table in sources for column in table.columns}
+    collations = {column_name(alias, column): collation for alias, table in sources
+                  for column, collation in zip(table.columns, table.column_collations)}
+    def convert(expr):
+        return apply_collations(apply_affinities(expr, affinities), collations)
+
+    resolved = {key: resolve(sql_ast[key]) for key in ('from', 'where', 'groupby')}
+    resolved['from'] = [dict(table, on=convert(table.get('on'))) for table in resolved['from']]
+    resolved['where'] = convert(resolved['where'])
+    return dict(sql_ast, columns=columns, orderby=orderby, **resolved)
+
+def referenced_columns(sql_ast):
+    """
+    Every column a resolved statement refers to, in its output, FROM, WHERE, GROUP BY and ORDER BY clauses.
+    """
+    exprs = [column['expr'] for column in sql_ast['columns']] + [entry.get('on') for entry in sql_ast['from']]
+    exprs += [sql_ast['where']] + (sql_ast['groupby'] or []) + [term['expr'] for term in sql_ast['orderby'] or []]
+
+    columns = []
+    for expr in exprs:
+        if expr is None:
+            continue
+        elif expr['type'] == 'aggr_func':
+            expr = expr['args']['expr']
+        columns.extend(get_where_columns(expr))
+    return columns
+
+def split_column(name):
+    alias, _, column = name.partition('.')
+    return alias, column
+
+def predicate_aliases(predicate):
+    return {split_column(column)[0] for column in get_where_columns(predicate)}
+
+def join_key(predicate, joined_aliases, alias):
+    """
+    (left column, right column) when predicate is an equality between a column of alias and one of the tables
+    already joined, None otherwise. Equalities under a collation other than BINARY aren't keys, hashing compares
+    values byte by byte.
+    """
+    if predicate['type'] != 'binary_expr' or predicate['operator'] not in ('=', '==') or 'collation' in predicate:
+        return None
+    left, right = predicate['left'], predicate['right']
+    if left['type'] != 'column_ref' or right['type'] != 'column_ref':
+        return None
+    if split_column(left['column'])[0] == alias:
+        left, right = right, left
+    if split_column(right['column'])[0] == alias and split_column(left['column'])[0] in joined_aliases:
+        return left['column'], split_column(right['column'])[1]
+    return None
+
+def plan_table_read(pager, catalog, alias, table, predicates, needed_columns, processes):
+    """
+    How to read the rows of one table satisfying predicates on it alone, named alias.column, along with its
+    row layout and the predicates renamed to its bare column names.
+    """
+    bare_names = {f"{alias}.{column}": column for column in table.columns}
+    where = rename_columns(and_all(predicates), bare_names)
+    row_layout = RowLayout.for_columns(table.columns, needed_columns, table.rowid_alias, table.real_columns)
+    return plan_query(pager, catalog, table, where, None, processes=processes, needed_columns=row_layout.columns), row_layout, where
+
+def plan_join_order(pager, catalog, sources, joins, where_predicates, needed_columns, processes):
+    """
+    Plans joining sources in the order given, joins being the join type and ON predicates of every source but the first.
+    """
+    needed = {alias: [] for alias, _ in sources}
+    for name in needed_columns:
+        alias, column = split_column(name)
+        if alias in needed: # ORDER BY terms may name output column aliases instead
+            needed[alias].append(column)
+
+    first_alias, first_table = sources[0]
+    first_predicates = [predicate for predicate in where_predicates if predicate_aliases(predicate) == {first_alias}]
+    remaining = [predicate for predicate in where_predicates if predicate not in first_predicates]
+    first, row_layout, first_where = plan_table_read(pager, catalog, first_alias, first_table, first_predicates, needed[first_alias], processes)
+
+    rows, cost = first.rows, first.cost
+    joined_aliases = {first_alias}
+    columns = [f"{first_alias}.{column}" for column in row_layout.columns]
+    steps = []
+    for (alias, table), (join, on_predicates) in zip(sources[1:], joins):
+        left_join = join == 'LEFT JOIN'
+        predicates = list(on_predicates)
+        if not left_join:
+            # for inner joins WHERE and ON mean the same, WHERE predicates are checked as soon as their tables are joined
+            available = joined_aliases | {alias}
+            predicates += [predicate for predicate in remaining if alias in predicate_aliases(predicate) <= available]
+            remaining = [predicate for predicate in remaining if predicate not in predicates]
+        elif any(not predicate_aliases(predicate) <= joined_aliases | {alias} for predicate in predicates):
+            raise Exception("ON clause references tables to its right")
+
+        filter_predicates = [predicate for predicate in predicates if predicate_aliases(predicate) == {alias}]
+        key_predicates = [predicate for predicate in predicates if join_key(predicate, joined_aliases, alias) is not None]
+        keys = [join_key(predicate, joined_aliases, alias) for predicate in key_predicates]
+        other_predicates = [predicate for predicate in predicates if predicate not in filter_predicates and predicate not in key_predicates]
+        condition = and_all(other_predicates)
+
+        right_columns = needed[alias] + [right for _, right in keys]
+        plan, right_layout, right_filter = plan_table_read(pager, catalog, alias, table, filter_predicates, right_columns, processes)
+        table_statistics = get_tree_statistics(pager, catalog, table.rootpage)
+
+        # a hash join reads the table once and puts the smaller side in the hash table
+        step = JoinStep(alias, table, left_join, 'hash', [left for left, _ in keys], [right for _, right in keys], right_layout,
+                        plan, right_filter, condition, build_left=plan.rows > rows,
+                        rows=max(rows, plan.rows) if keys else rows * plan.rows, cost=plan.cost + (rows + plan.rows) * HASH_COST)
+
+        for key_predicate, (left, right) in zip(key_predicates, keys):
+            if right == table.rowid_alias:
+                index, matches = None, 1.0
+                probe_cost = table_statistics.depth * PAGE_COST + ROWID_LOOKUP_COST
+            else:
+                indexes = [index for index in catalog.get_indexes(table.name) if index.columns[0] == right]
+                if not indexes:
+                    continue
+                index = indexes[0]
+                index_statistics = get_tree_statistics(pager, catalog, index.rootpage)
+                # every row before is assumed to match about as many rows as there are per row of this table
+                matches = max(1.0, table_statistics.rows / max(rows, 1.0))
+                probe_cost = index_statistics.depth * PAGE_COST + matches * (INDEX_ENTRY_COST + table_statistics.depth * PAGE_COST + ROWID_LOOKUP_COST)
+            index_cost = rows * (probe_cost + matches * ROW_COST)
+            if index_cost < step.cost:
+                # the other keys are checked on the joined rows
+                index_condition = and_all(other_predicates + [predicate for predicate in key_predicates if predicate is not key_predicate])
+                step = JoinStep(alias, table, left_join, 'index', [left], [right], right_layout, None, right_filter, index_condition,
+                                index=index, rows=rows * matches, cost=index_cost)
+
+        if left_join:
+            step.rows = max(step.rows, rows)
+        steps.append(step)
+        rows, cost = step.rows, cost + step.cost
+        joined_aliases.add(alias)
+        columns += [f"{alias}.{column}" for column in right_layout.columns]
+
+    return JoinPlan(first_alias, first, row_layout, first_where, steps, and_all(remaining), columns, cost)
+
+def plan_join(pager, catalog, sources, sql_ast, processes=1):
+    """
+    Plans a SELECT over the (alias, Table) sources of its FROM clause, sql_ast being resolved by resolve_columns.
+    Predicates on a single table are pushed into how that table is read, equalities between tables become join keys.
+
+    Joins without a LEFT JOIN are planned in every order of their tables (for up to MAX_REORDERED_TABLES tables) and
+    the cheapest is kept, a LEFT JOIN keeps the order of the FROM clause.
+    """
+    needed_columns = referenced_columns(sql_ast)
+    where_predicates = get_conjuncts(sql_ast['where'])
+    joins = [(entry['join'], get_conjuncts(entry['on'])) for entry in sql_ast['from'][1:]]
+
+    if any(join == 'LEFT JOIN' for join, _ in joins) or len(sources) > MAX_REORDERED_TABLES:
+        return plan_join_order(pager, catalog, sources, joins, where_predicates, needed_columns, processes)
+
+    # ON predicates of inner joins are WHERE predicates that can be checked once their tables are joined
+    where_predicates += [predicate for _, on_predicates in joins for predicate in on_predicates]
+    inner_joins = [('INNER JOIN', [])] * (len(sources) - 1)
+    plans = [plan_join_order(pager, catalog, list(order), inner_joins, where_predicates, needed_columns, processes)
+             for order in itertools.permutations(sources)]
+    return min(plans, key=lambda plan: plan.cost)
+
+def join_key_values(row, positions):
+    return tuple([row[position] for position in positions])
+
+def join_rows(build_rows, probe_rows, build_keys, probe_keys, build_left, left_join, condition, right_width):
+    """
+    Joins probe_rows to the build_rows sharing their key through a hash table over build_rows. Joined rows are the
+    left row followed by the right row, the build side being the left one with build_left. NULL keys match nothing.
+    """
+    table = {}
+    for row in build_rows:
+        table.setdefault(join_key_values(row, build_keys), []).append(row)
+
+    nulls = (None,) * right_width
+    matched = set() # ids of the build rows that were joined, for a LEFT JOIN built on the left
+    for probe in probe_rows:
+        key = join_key_values(probe, probe_keys)
+        found = False
+        for build in (table.get(key, ()) if None not in key else ()):
+            row = build + probe if build_left else probe + build
+            if condition is None or condition(row) is True:
+                found = True
+                if build_left and left_join:
+                    matched.add(id(build))
+                yield row
+        if left_join and not build_left and not found:
+            yield probe + nulls
+
+    if build_left and left_join:
+        for rows in table.values():
+            for build in rows:
+                if id(build) not in matched:
+                    yield build + nulls
+
+def partition_rows(rows, key_positions):
+    """
+    Spreads rows over JOIN_PARTITIONS temporary files by the hash of their key, so equal keys land in the same file.
+    """
+    files = [tempfile.TemporaryFile() for _ in range(JOIN_PARTITIONS)]
+    partitions = [[] for _ in files]
+    for row in rows:
+        number = hash(join_key_values(row, key_positions)) % JOIN_PARTITIONS
+        partitions[number].append(row)
+        if len(partitions[number]) >= PARTITION_BATCH_SIZE:
+            pickle.dump(partitions[number], files[number])
+            partitions[number].clear()
+    for file, partition in zip(files, partitions):
+        if partition:
+            pickle.dump(partition, file)
+        file.seek(0)
+    return files
+
+def read_partition(file):
+    with file:
+        while True:
+            try:
+                yield from pickle.load(file)
+            except EOFError:
+                return
+
+def hash_join(left_rows, right_rows, left_keys, right_keys, right_width, left_join=False, condition=None, build_left=False,
+              max_build_rows=MAX_BUILD_ROWS):
+    """
+    Joins left_rows to right_rows on equal left_keys and right_keys (positions in the rows of each side), yielding the
+    left row followed by the right row. condition, a compiled predicate, is checked on the joined rows.
+
+    The hash table is built over the right rows, or the left ones with build_left, and rows are streamed from the other
+    side. Once the build side holds more than max_build_rows both sides are partitioned to temporary files by the hash
+    of their key and joined one partition at a time, which only holds one partition of the build side in memory.
+    """
+    build_rows, probe_rows = (left_rows, right_rows) if build_left else (right_rows, left_rows)
+    build_keys, probe_keys = (left_keys, right_keys) if build_left else (right_keys, left_keys)
+
+    # rows in the hash table outlive the pages they were read from
+    build_rows = (tuple([materialize(value) for value in row]) for row in build_rows)
+    first_rows = list(itertools.islice(build_rows, max_build_rows + 1))
+    if len(first_rows) <= max_build_rows:
+        yield from join_rows(first_rows, probe_rows, build_keys, probe_keys, build_left, left_join, condition, right_width)
+        return
+
+    build_files = partition_rows(itertools.chain(first_rows, build_rows), build_keys)
+    del first_rows
+    probe_files = partition_rows((tuple([materialize(value) for value in row]) for row in probe_rows), probe_keys)
+    for build_file, probe_file in zip(build_files, probe_files):
+        yield from join_rows(read_partition(build_file), read_partition(probe_file), build_keys, probe_keys, build_left,
+                             left_join, condition, right_width)
+
+def index_join(pager, left_rows, key_position, step, condition=None):
+    """
+    Joins each left row to the rows of step.table whose step.right_keys[0] equals its value at key_position, found
+    through step.index or the table's rowid. Left rows are taken in batches: every key of a batch is looked up, then
+    the matching rowids are read in one descent of the table B-tree. condition is checked on the joined rows.
+    """
+    rootpage = step.table.rootpage
+    right_filter = None
+    if step.filter is not None:
+        right_filter = compile_predicate(step.filter, {column: position for position, column in enumerate(step.row_layout.columns)})
+    nulls = (None,) * len(step.row_layout.columns)
+
+    left_rows = iter(left_rows)
+    batch_size = FIRST_PROBE_BATCH_SIZE
+    while True:
+        batch = list(itertools.islice(left_rows, batch_size))
+        if not batch:
+            return
+        batch_size = min(batch_size * 2, PROBE_BATCH_SIZE)
+
+        rowids_by_key = {}
+        for left in batch:
+            key = left[key_position]
+            if key is None or key in rowids_by_key:
+                continue
+            if step.index is None:
+                # rowids are integers, 3.0 finds rowid 3
+                is_integer = isinstance(key, int) or (isinstance(key, float) and key.is_integer())
+                rowids_by_key[key] = [int(key)] if is_integer else []
+            else:
+                bound = ((key,), True)
+                entries = scan_index(pager, step.index.rootpage, len(step.index.columns) + 1, bound, bound)
+                rowids_by_key[key] = [entry[-1] for entry in entries]
+
+        rowids = sorted({rowid for rowids in rowids_by_key.values() for rowid in rowids})
+        rows_by_rowid = dict(search_by_rowids(pager, rootpage, rowids, step.row_layout))
+        for left in batch:
+            found = False
+            for rowid in rowids_by_key.get(left[key_position], ()):
+                right = rows_by_rowid.get(rowid)
+                if right is None or (right_filter is not None and right_filter(right) is not True):
+                    continue
+                row = left + right
+                if condition is None or condition(row) is True:
+                    found = True
+                    yield row
+            if step.left_join and not found:
+                yield left + nulls
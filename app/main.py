@@ -1,241 +1,73 @@
-import re 
+import argparse
+import contextlib
+import itertools
+import shlex
 import sys
-from dataclasses import dataclass
-
-import sqlparse 
-from sqlparse.sql import IdentifierList, Function, Identifier, Comparison, Where
-
-from .record_parser import parse_record
-from .varint_parser import parse_varint
-from sql_parser import parse
-
-DATABASE_HEADER_LENGTH = 100
-LEAF_HEADER_LENGTH = 8
-INTERIOR_HEADER_LENGTH = 12
-
-INTERIOR_INDEX_PAGE = 2
-INTERIOR_TABLE_PAGE = 5
-LEAF_INDEX_PAGE = 10
-LEAF_TABLE_PAGE = 13
-
-def get_where_clause(tokens):
-    for token in tokens:
-        if type(token) == Where:
-            return token 
-
-    return None
-
-def get_comparison(tokens):
-    for token in tokens:
-        if type(token) == Comparison:
-            return token
-
-    return None
-
-def get_col_and_value(token):
-    return (token.left.value, token.right.value)
-
-def get_where_condition(tokens):
-    where_clause = get_where_clause(tokens)
-    if where_clause:
-        comparison = get_comparison(where_clause.tokens)
-        if comparison:
-            return get_col_and_value(comparison)
-
-    return None
-
-@dataclass(init=False)
-class PageHeader:
-    page_type: int
-    first_free_block_start: int
-    number_of_cells: int
-    start_of_content_area: int
-    fragmented_free_bytes: int
-    right_most_pointer: int
-
-    @classmethod
-    def parse_from(cls, database_file):
-        """
-        Parses a page header as mentioned here: https://www.sqlite.org/fileformat2.html#b_tree_pages
-        """
-        instance = cls()
-
-        instance.page_type = int.from_bytes(database_file.read(1), "big")
-        instance.first_free_block_start = int.from_bytes(database_file.read(2), "big")
-        instance.number_of_cells = int.from_bytes(database_file.read(2), "big")
-        instance.start_of_content_area = int.from_bytes(database_file.read(2), "big")
-        instance.fragmented_free_bytes = int.from_bytes(database_file.read(1), "big")
-
-        if instance.page_type in [INTERIOR_TABLE_PAGE, INTERIOR_INDEX_PAGE]:
-            instance.right_most_pointer = int.from_bytes(database_file.read(4), "big")
-        else:
-            instance.right_most_pointer = None
-
-        return instance
-
-def generate_schema_rows(database_path):
-    with open(database_path, "rb") as database_file:
-        database_file.seek(DATABASE_HEADER_LENGTH)  # Skip the header section
-        page_header = PageHeader.parse_from(database_file)
-        database_file.seek(DATABASE_HEADER_LENGTH + LEAF_HEADER_LENGTH)  # Skip the database header & b-tree page header, get to the cell pointer array
-        
-        cell_pointers = [int.from_bytes(database_file.read(2), "big") for _ in range(page_header.number_of_cells)]
-        sqlite_schema_rows = []
-
-        # Each of these cells represents a row in the sqlite_schema table.
-        for cell_pointer in cell_pointers:
-            database_file.seek(cell_pointer)
-            _number_of_bytes_in_payload = parse_varint(database_file)
-            rowid = parse_varint(database_file)
-            record = parse_record(database_file, 5)
-
-            # Table contains columns: type, name, tbl_name, rootpage, sql
-            sqlite_schema_rows.append({
-                'type': record[0],
-                'name': record[1],
-                'tbl_name': record[2],
-                'rootpage': record[3],
-                'sql': record[4],
-            })
-
-        return sqlite_schema_rows
-
-def read_pages(database_file, page_start, sql_tokens, column_count, page_size, columns):
-    database_file.seek(page_start)
-    page_header = PageHeader.parse_from(database_file)
-
-    table_rows = []
-    if page_header.page_type == LEAF_TABLE_PAGE:
-        table_rows.extend(get_table_rows(database_file, page_start, page_header, sql_tokens, column_count, page_size, columns))
-    elif page_header.page_type == INTERIOR_TABLE_PAGE:
-        table_rows.extend(read_interior_page(database_file, page_start, page_header, sql_tokens, column_count, page_size, columns))
-        right_page_number = page_header.right_most_pointer * page_size - page_size
-        table_rows.extend(read_pages(database_file, right_page_number, sql_tokens, column_count, page_size, columns))
-
-    else:
-        print("Unknown page type!", page_header.page_type)
-
-    return table_rows
-
-def read_interior_page(database_file, page_start, page_header, sql_tokens, column_count, page_size, columns):
-    database_file.seek(page_start+ INTERIOR_HEADER_LENGTH)
-    cell_pointers = [int.from_bytes(database_file.read(2), "big") for _ in range(page_header.number_of_cells)]
-
-    table_rows = []
-    for cell_pointer in cell_pointers:
-        database_file.seek(page_start + cell_pointer)
-        page_number = int.from_bytes(database_file.read(4), "big") # left pointer
-        _varint_integer_key = parse_varint(database_file)
-
-        new_page_start = page_number * page_size - page_size
-        table_rows.extend(read_pages(database_file, new_page_start, sql_tokens, column_count, page_size, columns)) 
-
+import time
+
+from .aggregates import AggregateCall, group_batches, group_rows
+from .btree import (
+    RowLayout,
+    as_real,
+    collation_name,
+    count_table_rows,
+    get_leaf_pages,
+    read_leaf_cells,
+    read_pages,
+    read_pages_in_range,
+    scan_index,
+    search_by_rowids,
+    sort_key,
+)
+from .catalog import load_catalog
+from .joins import hash_join, index_join, plan_join, resolve_columns
+from .output import WRITERS as OUTPUT_MODES, result_writer
+from .output import settings as output_settings
+from .pager import DEFAULT_CACHE_SIZE, Pager
+from .parallel import parallel_count, parallel_scan
+from .planner import plan_query
+from .predicates import compile_predicate, filter_rows, get_filtered_table_rows, get_where_columns
+from .server import repl, serve
+from .stats import collect_stats, profiling, record_plan
+from .stats import settings as stats_settings
+from .vectorized import read_batches
+from .zonemaps import add_zone_map, matching_leaf_pages
+from sql_parser import prepare
+
+ROWID_BATCH_SIZE = 4096 # rowids looked up per descent of the table b-tree by index scans
+FIRST_ROWID_BATCH_SIZE = 16 # batches start this small and double, so a LIMIT stops an index scan early
+TOP_ROWS_CHUNK_SIZE = 1024 # rows ORDER BY ... LIMIT sorts along with the best ones so far at a time
+
+def sort_rows(table_rows, orderby, positions):
+    """
+    Fallback for ORDER BY clauses no index can serve, this has to read every row before the first one is returned.
+    positions are where the value of each ORDER BY term is in the rows.
+    """
+    table_rows = list(table_rows)
+    # Stable sorts from the last ORDER BY term to the first give the combined ordering
+    for term, position in reversed(list(zip(orderby, positions))):
+        table_rows.sort(key=lambda row: sort_key(row[position]), reverse=term['type'] == 'DESC')
     return table_rows
 
-def get_table_rows(database_file, page_start, page_header, sql_tokens, column_count, page_size, columns):
-    # begin function - page start, database file, page header number of cells, tokens, column count
-    database_file.seek(page_start + LEAF_HEADER_LENGTH) # move to the cell pointer array on the current page
-    cell_pointers = [int.from_bytes(database_file.read(2), "big") for _ in range(page_header.number_of_cells)]
+def top_rows(table_rows, orderby, positions, count):
+    """
+    The first count rows in ORDER BY order, for ORDER BY ... LIMIT. Rows are sorted a chunk at a time together with
+    the best count rows so far, of which only the best count are kept, instead of holding and sorting every row.
+    """
+    # Sorting in C with sort_rows beats a heapq heap, whose loop runs in Python once per row: by far the most on rows
+    # that are nearly in order already, like TEXT keys numbered in rowid order
+    if count == 0:
+        return []
+    chunk_size = max(TOP_ROWS_CHUNK_SIZE, count)
+    table_rows = iter(table_rows)
+    best = []
+    while True:
+        chunk = list(itertools.islice(table_rows, chunk_size))
+        if not chunk:
+            return best
+        # the best rows so far come first, so the stable sort keeps the scan order between equal rows
+        best = sort_rows(best + chunk, orderby, positions)[:count]
 
-    where_condition = get_where_condition(sql_tokens)
-
-    table_rows = []
-    for cell_pointer in cell_pointers:
-        database_file.seek(page_start + cell_pointer)
-        _number_of_bytes_in_payload = parse_varint(database_file)
-        rowid = parse_varint(database_file)
-        record = parse_record(database_file, column_count)
-
-        row_dict = {}
-        for i, column in enumerate(columns):
-            if column == 'id':
-                row_dict[column] = rowid
-            else:
-                row_dict[column] = record[i]
-        if where_condition:
-            if where_condition[0] == 'id':
-                if rowid == int(where_condition[1]):
-                    table_rows.append(row_dict)
-            else:
-                if row_dict[where_condition[0]] and row_dict[where_condition[0]].decode() == where_condition[1].strip('"').strip("'"):
-                    table_rows.append(row_dict)
-        else:
-            table_rows.append(row_dict)
-
-    return table_rows
-
-def get_table_columns(table_name, sqlite_schema_rows):
-    table_record = [record for record in sqlite_schema_rows if record['tbl_name'].decode() == table_name][0]
-    table_sql = table_record['sql'].decode()
-
-    open_paren = table_sql.find('(')
-    table_sql = table_sql[open_paren + 1:len(table_sql) - 1].strip().split(',')
-    columns = []
-    for column_def in table_sql:
-        column_name = column_def.strip().split()[0]
-        columns.append(column_name)
-    return table_record, columns
-
-def read_from_index(database_file, page_number, page_size, value):
-    page_start = page_number * page_size - page_size
-    database_file.seek(page_start)
-    page_header = PageHeader.parse_from(database_file)
-    if page_header.page_type == INTERIOR_INDEX_PAGE: 
-        database_file.seek(page_start + INTERIOR_HEADER_LENGTH) 
-    elif page_header.page_type == LEAF_INDEX_PAGE:
-        database_file.seek(page_start + LEAF_HEADER_LENGTH)
-    cell_pointers = [int.from_bytes(database_file.read(2), "big") for _ in range(page_header.number_of_cells)]
-    
-   
-    rowids = []
-    value_less_than_first = False
-    found_in_node = False
-    found_last = False # a match has been found and there exists an additional nonmatch
-
-    for i, cell_pointer in enumerate(cell_pointers):
-        database_file.seek(page_start + cell_pointer)
-        if page_header.page_type == INTERIOR_INDEX_PAGE: 
-            left_pointer = int.from_bytes(database_file.read(4), "big")
-        _number_of_bytes_in_payload = parse_varint(database_file)
-        record = parse_record(database_file, 2) # number of columns in the index + the one column for rowid
-
-        if found_in_node and record[0] != value:
-            # we just passed the last matched value. go into the left pointer (which is right pointer of last match) but don't add rowid
-            found_last = True
-            break
-
-        if record[0] and record[0] >= value:
-            if record[0] == value: # if match found, add rowid to list and then go into left pointer 
-                #go into left pointer
-                found_in_node = True
-                if page_header.page_type == INTERIOR_INDEX_PAGE: 
-                    rowids.extend(read_from_index(database_file, left_pointer, page_size, value))
-                
-                rowids.append(record[1])
-            else:
-                if i == 0:
-                    value_less_than_first = True
-
-                if page_header.page_type == INTERIOR_INDEX_PAGE: 
-                    rowids.extend(read_from_index(database_file, left_pointer, page_size, value))
-                
-                break
-            # we're not going to find the value in the rest of the list
-    if not value_less_than_first : # ignore the right pointer stuff completely if the left most pointer was used or if the value has alreayd been found in a parent node
-
-        # if we made it through the list without finding the value, go into the right most pointer
-        # we want to go into the right pointer when no matches are found or we found a match as the last item
-
-        if not found_in_node and page_header.page_type == INTERIOR_INDEX_PAGE:
-            rowids.extend(read_from_index(database_file, page_header.right_most_pointer, page_size, value))
-
-        if found_in_node and not found_last and page_header.page_type == INTERIOR_INDEX_PAGE:
-            rowids.extend(read_from_index(database_file, page_header.right_most_pointer, page_size, value))
-
-    # can an interior node not have a right most pointer?
-    return rowids
-
-    # need to check if its a leaf node or interior node. if leaf, we don't have to search any further
 def get_number_of_tables(schema_rows):
     row_count = 0
     for row in schema_rows:
@@ -244,89 +76,53 @@ def get_number_of_tables(schema_rows):
 
     return row_count
 
-def search_by_rowid(database_file, page_number, column_count, page_size, k, columns):
-
-
-    page_start = page_number * page_size - page_size 
-    database_file.seek(page_start)
-    page_header = PageHeader.parse_from(database_file)
-
-    if page_header.page_type == LEAF_TABLE_PAGE:
-        return read_leaf_by_by_rowid(database_file, page_start, page_header, column_count, page_size, k, columns)
-    elif page_header.page_type == INTERIOR_TABLE_PAGE:
-        return read_interior_page_by_rowid(database_file, page_start, page_header, column_count, page_size, k, columns)
-
-    else:
-        print("Unknown page type!", page_header.page_type)
-
-def read_interior_page_by_rowid(database_file, page_start, page_header, column_count, page_size, rowid, columns):
-    database_file.seek(page_start+ INTERIOR_HEADER_LENGTH)
-    cell_pointers = [int.from_bytes(database_file.read(2), "big") for _ in range(page_header.number_of_cells)]
-
-    for cell_pointer in cell_pointers:
-        database_file.seek(page_start + cell_pointer)
-        page_number = int.from_bytes(database_file.read(4), "big") # left pointer
-        integer_key = parse_varint(database_file)
-
-        if rowid <= integer_key:
-            # search the left
-            return search_by_rowid(database_file, page_number, column_count, page_size, rowid, columns)
-
-    # if nothing found search the right most pointer
-    return search_by_rowid(database_file, page_header.right_most_pointer, column_count, page_size, rowid, columns) 
-
-def read_leaf_by_by_rowid(database_file, page_start, page_header, column_count, page_size, k, columns):
-    database_file.seek(page_start + LEAF_HEADER_LENGTH) # move to the cell pointer array on the current page
-    cell_pointers = [int.from_bytes(database_file.read(2), "big") for _ in range(page_header.number_of_cells)]
-
-    for cell_pointer in cell_pointers:
-        database_file.seek(page_start + cell_pointer)
-        _number_of_bytes_in_payload = parse_varint(database_file)
-        rowid = parse_varint(database_file)
-        record = parse_record(database_file, column_count)
-
-        if k == rowid:
-
-            row_dict = {}
-            for i, column in enumerate(columns):
-                if column == 'id':
-                    row_dict[column] = rowid
-                else:
-                    row_dict[column] = record[i]
-
-            return row_dict
-    # since this is a leaf, if the key isn't found in this node, return None
-    return None
-
-def get_indexes(sqlite_schema_rows):
-    indexes = {}
-    for row in sqlite_schema_rows:
-        if row['type'].decode() == 'index':
-            if row['sql']:
-                column = re.findall("\((.*?)\)", row['sql'].decode())[0]
-                indexes[(row['tbl_name'].decode(), column)] = row['rootpage']
-
-    return indexes
-
-def query_index(database_file, index_rootpage, page_size, value, columns, rootpage):
-    rowids = read_from_index(database_file, index_rootpage, page_size, value)
-    table_rows = []
-
-    for rowid in rowids:
-        row = search_by_rowid(database_file, rootpage, len(columns), page_size, rowid, columns) 
-        table_rows.append(row)
-
-    return table_rows  
-
-def command_dot_dbinfo(database_file_path):
-    sqlite_schema_rows = generate_schema_rows(database_file_path)
+def query_index(pager, index_entries, row_layout, rootpage, keep_index_order=False):
+    """
+    Fetches the table rows for index entries. Rowids are gathered in batches, sorted and looked up with one merged
+    descent of the table B-tree per batch, so pages shared by many rowids are read once rather than once per rowid.
+
+    Rows come back in rowid order within each batch, or in index order with keep_index_order.
+    """
+    index_entries = iter(index_entries)
+    batch_size = FIRST_ROWID_BATCH_SIZE
+    while True:
+        batch = list(itertools.islice(index_entries, batch_size))
+        if not batch:
+            return
+        batch_size = min(batch_size * 2, ROWID_BATCH_SIZE)
+
+        rowids = sorted({entry[-1] for entry in batch}) # the rowid is the last column of an index entry
+        rows = search_by_rowids(pager, rootpage, rowids, row_layout)
+        if keep_index_order:
+            rows_by_rowid = dict(rows)
+            for entry in batch:
+                yield rows_by_rowid[entry[-1]]
+        else:
+            for _rowid, row in rows:
+                yield row
+
+def index_rows(index_entries, index, row_layout):
+    """
+    Lays out the entries of an index holding every column of row_layout as table rows, for index-only plans.
+    """
+    # a column the index doesn't hold is the INTEGER PRIMARY KEY, which is the rowid at the end of each entry
+    positions = [index.columns.index(column) if column in index.columns else -1 for column in row_layout.columns]
+    if row_layout.real_positions:
+        # index entries store REALs like table records do, whole numbers as INTEGERs
+        reals = [position in row_layout.real_positions for position in range(len(positions))]
+        return (tuple(as_real(entry[position]) if real else entry[position] for position, real in zip(positions, reals))
+                for entry in index_entries)
+    return (tuple(entry[position] for position in positions) for entry in index_entries)
+
+def command_dot_dbinfo(pager):
+    sqlite_schema_rows = load_catalog(pager).schema_rows
    # You can use print statements as follows for debugging, they'll be visible when running tests.
     print("Logs from your program will appear here!")
     # Uncomment this to pass the first stage
     print(f"number of tables: {get_number_of_tables(sqlite_schema_rows)}")
 
-def command_dot_tables(database_file_path):
-    sqlite_schema_rows = generate_schema_rows(database_file_path)
+def command_dot_tables(pager):
+    sqlite_schema_rows = load_catalog(pager).schema_rows
     output = ""
     for row in sqlite_schema_rows:
         tbl_name = row['tbl_name'].decode()
@@ -334,64 +130,503 @@ def command_dot_tables(database_file_path):
             output += tbl_name + ' '
     print(output)
 
-def select_statement(database_file_path):
-    sql_tokens = sqlparse.parse(command)[0].tokens
-
-    sql_ast = parse(command)
-
-    table = sql_ast["from"][0]["table"]
-
-    sqlite_schema_rows = generate_schema_rows(database_file_path)
-    indexes = get_indexes(sqlite_schema_rows)
-    table_record, columns = get_table_columns(table, sqlite_schema_rows)
-    column_count = len(columns) 
-
-    with open(database_file_path, "rb") as database_file:
-        database_file.seek(16)
-        page_size = int.from_bytes(database_file.read(2), "big")
-
-        page_start = table_record['rootpage'] * page_size - page_size
-
-        # return table rows
-        # if where clause uses index, search there instead
-        where_condition = get_where_condition(sql_tokens)
-        if where_condition and (table, where_condition[0]) in indexes:
-            index_rootpage = indexes[table, where_condition[0]]
-            table_rows = query_index(database_file, index_rootpage, page_size, where_condition[1].strip('"').strip("'").encode(), columns, table_record['rootpage'])
+def command_dot_stats(command, settings):
+    setting = command[len(".stats"):].strip().lower()
+    if setting not in ("on", "off"):
+        print("Usage: .stats on|off")
+        return
+    settings['stats'] = setting == "on"
+
+def command_dot_zonemap(pager, command):
+    arguments = shlex.split(command)[1:] # "quoted" names can hold spaces
+    if len(arguments) < 2:
+        print("Usage: .zonemap TABLE COLUMN...")
+        return
+    add_zone_map(pager, arguments[0], arguments[1:])
+
+def command_dot_mode(command, settings):
+    mode = command[len(".mode"):].strip().lower()
+    if mode not in OUTPUT_MODES:
+        print(f"Usage: .mode {'|'.join(OUTPUT_MODES)}")
+        return
+    settings['mode'] = mode
+
+def session_settings():
+    """
+    A copy of the settings .mode and .stats change, for one REPL or socket connection to change without touching
+    any other's. It starts from what --mode, --stats and --profile set.
+    """
+    return {**output_settings, **stats_settings}
+
+def is_aggregate_query(sql_ast):
+    return bool(sql_ast["groupby"]) or any(column["expr"]["type"] == "aggr_func" for column in sql_ast["columns"])
+
+def get_selected_columns(sql_ast, table_columns):
+    """
+    Returns whether the statement is a lone COUNT(*), along with the names of the columns it outputs (* expanded).
+    For other aggregates those are the columns the aggregates read.
+    """
+    columns = sql_ast["columns"]
+    if not sql_ast["groupby"] and len(columns) == 1 and columns[0]["expr"]["type"] == "aggr_func":
+        if columns[0]["expr"]["name"] == "COUNT" and columns[0]["expr"]["args"]["expr"]["type"] == "star":
+            return True, []
+
+    selected_columns = []
+    for column in columns:
+        expr = column["expr"]
+        if expr["type"] == "aggr_func":
+            argument = expr["args"]["expr"]
+            selected_columns.extend([argument["column"]] if argument["type"] == "column_ref" else [])
         else:
-            table_rows = read_pages(database_file, page_start, sql_tokens, column_count, page_size, columns)
-        identifiers = sql_tokens[2] 
-
-        if type(identifiers) == Function:
-            # count
-            print(len(table_rows))
+            selected_columns.extend(table_columns if expr["column"] == "*" else [expr["column"]])
+    return False, selected_columns
+
+def limit_range(limit):
+    """
+    The (offset, stop) slice of the result rows LIMIT and OFFSET keep, stop being None when all of them are kept.
+    A negative limit means no limit, as in SQLite.
+    """
+    if not limit:
+        return 0, None
+    offset = max(limit['offset'], 0)
+    return offset, offset + limit['value'] if limit['value'] >= 0 else None
+
+def get_sources(catalog, sql_ast):
+    """
+    The (alias, Table) pairs of the FROM clause, a table without an alias going by its name.
+    """
+    sources = []
+    for entry in sql_ast["from"]:
+        alias = entry["as"] or entry["table"]
+        if any(alias.lower() == other.lower() for other, _ in sources):
+            raise Exception(f"ambiguous table name: {alias}")
+        sources.append((alias, catalog.get_table(entry["table"])))
+    return sources
+
+def select_statement(pager, command, processes=1, vectorized=False, mode=None):
+    result = query_rows(pager, command, processes, vectorized)
+    writer = result_writer(mode=mode)
+    try:
+        if isinstance(result, BatchedRows):
+            writer.write_batches(result.batches(), result.positions)
         else:
-            for row in table_rows:
-                output = ""
-                for col in sql_ast["columns"]:
-                    # if type == column_ref
-                    data = row[col["expr"]["column"]]
-                    datatype = type(data)
-                    if datatype == int:
-                        output += str(data)
-                    elif data is None:
-                        output += ""
-                    else:
-                        output += data.decode()
-                    output += '|'
-                output = output[:-1]
-                print(output)
-
-if __name__ == "__main__":
-    database_file_path = sys.argv[1]
-    command = sys.argv[2]
-
+            writer.write_rows(result)
+    finally:
+        writer.close() # the rows before an error still get written
+
+def traced_select_statement(pager, command, processes=1, vectorized=False, mode=None, profile=None):
+    """
+    select_statement with the QueryStats of the statement printed on stderr after its rows, run under cProfile
+    too when --profile asked for it (profile being its path). Time spent getting the next row or batch is execute
+    time, the rest of the time the rows take is output time.
+    """
+    with contextlib.ExitStack() as stack:
+        if profile is not None:
+            stack.enter_context(profiling(profile))
+        stats = stack.enter_context(collect_stats(pager))
+
+        with stats.timed('parse'):
+            prepare(command)
+        with stats.timed('plan'):
+            result = query_rows(pager, command, processes, vectorized)
+        start = time.perf_counter()
+        writer = result_writer(mode=mode)
+        try:
+            if isinstance(result, BatchedRows):
+                writer.write_batches(stats.timed_iteration(result.batches(), 'execute', size=lambda batch: batch.length), result.positions)
+            else:
+                writer.write_rows(stats.timed_iteration(result, 'execute'))
+        finally:
+            writer.close()
+        stats.stages['output'] = time.perf_counter() - start - stats.stages.get('execute', 0.0)
+    print("\n".join(stats.report()), file=sys.stderr)
+
+def query_rows(pager, command, processes=1, vectorized=False):
+    """
+    Plans a SELECT or EXPLAIN QUERY PLAN statement and returns its result rows as a lazy iterable of value lists.
+    Rows are only read from the database as they're iterated over, errors in the statement are raised right away.
+    """
+    sql_ast = prepare(command)
+
+    catalog = load_catalog(pager)
+    sources = get_sources(catalog, sql_ast)
+    sql_ast = resolve_columns(sql_ast, sources)
+    if len(sources) > 1:
+        return join_statement(pager, catalog, sources, sql_ast, processes)
+    alias, table_record = sources[0]
+
+    where = sql_ast["where"]
+    orderby = sql_ast["orderby"]
+    limit = sql_ast["limit"]
+    is_count, selected_columns = get_selected_columns(sql_ast, table_record.columns)
+    if not is_count and is_aggregate_query(sql_ast):
+        return aggregate_statement(pager, catalog, table_record, sql_ast, processes, vectorized)
+    aggregate_terms = [term['expr']['name'] for term in orderby or [] if term['expr']['type'] == 'aggr_func']
+    if is_count:
+        orderby = None # there's only the one row
+    elif aggregate_terms:
+        raise Exception(f"misuse of aggregate: {aggregate_terms[0]}()")
+
+    # only the projected columns and the columns WHERE and ORDER BY look at are ever decoded
+    orderby_columns = [term['expr']['column'] for term in orderby or []]
+    for column in selected_columns + get_where_columns(where) + orderby_columns:
+        if column not in table_record.columns:
+            raise Exception(f"no such column: {column}")
+    row_layout = RowLayout.for_columns(table_record.columns, selected_columns + get_where_columns(where) + orderby_columns, table_record.rowid_alias,
+                                      table_record.real_columns)
+
+    offset, stop = limit_range(limit)
+    needed_rows = None if is_count else stop
+
+    plan = plan_query(pager, catalog, table_record, where, orderby, is_count, processes, needed_rows, row_layout.columns)
+    if sql_ast["explain"]:
+        return explain_rows(plan.explain(orderby, name=alias))
+    record_plan(lambda: plan.explain(orderby, name=alias))
+
+    if is_count:
+        return count_rows(pager, plan, row_layout, where, processes, vectorized)
+
+    orderby_positions = [row_layout.columns.index(column) for column in orderby_columns]
+    output_positions = [row_layout.columns.index(column) for column in selected_columns]
+    if vectorized and reads_batches(plan, processes):
+        batches = read_table_batches(pager, plan, row_layout, where)
+        if not orderby or plan.sorted:
+            return BatchedRows(batches, output_positions, offset, stop)
+        table_rows = itertools.chain.from_iterable(batch.rows() for batch in batches)
+    else:
+        table_rows = read_table_rows(pager, plan, row_layout, where, processes, ordered=not orderby or plan.sorted)
+    return result_rows(table_rows, orderby, orderby_positions, limit, output_positions, plan.sorted)
+
+def explain_rows(lines):
+    return [[line.encode()] for line in lines]
+
+def count_rows(pager, plan, row_layout, where, processes=1, vectorized=False):
+    """
+    The one row of a lone COUNT(*), counted from page headers, index entries or rowid ranges whenever possible.
+    Nothing is counted until the row is asked for.
+    """
+    rootpage = plan.table.rootpage
+    if not where:
+        count = count_table_rows(pager, rootpage)
+    elif plan.index_only and plan.exact:
+        count = sum(1 for _ in scan_plan_index(pager, plan))
+    elif plan.access == 'rowid' and plan.exact:
+        count = sum(1 for _ in read_pages_in_range(pager, rootpage, *plan.bounds))
+    elif plan.access == 'scan' and processes > 1:
+        count = parallel_count(pager, rootpage, row_layout, where, processes, matching_leaf_pages(pager, plan.table, where))
+    elif vectorized and reads_batches(plan, processes):
+        count = sum(batch.length for batch in read_table_batches(pager, plan, row_layout, where))
+    else:
+        count = sum(1 for _ in read_table_rows(pager, plan, row_layout, where))
+    yield [count]
+
+def result_rows(table_rows, orderby, orderby_positions, limit, output_positions, presorted=False):
+    """
+    Sorts rows for ORDER BY unless they're presorted, then yields the values at output_positions of the rows
+    LIMIT and OFFSET keep.
+    """
+    offset, stop = limit_range(limit)
+    if orderby and not presorted and stop is not None:
+        # LIMIT 0 keeps no rows whatever the OFFSET, so none need sorting
+        table_rows = top_rows(table_rows, orderby, orderby_positions, stop if stop > offset else 0)
+    elif orderby and not presorted:
+        table_rows = sort_rows(table_rows, orderby, orderby_positions)
+
+    # the pipeline is lazy, so nothing past the last row needed is read
+    return project_rows(itertools.islice(table_rows, offset, stop), output_positions)
+
+def get_aggregate_expressions(sql_ast, table_columns):
+    """
+    What an aggregate query computes for each group: its output columns (* expanded to table_columns) followed by the
+    ORDER BY terms that aren't one of them. Returns the expressions, how many of them are output and where the value
+    of each ORDER BY term is among them.
+    """
+    expressions = []
+    aliases = {}
+    for column in sql_ast["columns"]:
+        if column["expr"] == {'type': 'column_ref', 'column': '*'}:
+            expressions.extend({'type': 'column_ref', 'column': name} for name in table_columns)
+            continue
+        if column["as"]:
+            aliases[column["as"]] = len(expressions)
+        expressions.append(column["expr"])
+    output_count = len(expressions)
+
+    orderby_positions = []
+    for term in sql_ast["orderby"] or []:
+        expr = term['expr']
+        if expr['type'] == 'column_ref' and expr['column'] in aliases:
+            orderby_positions.append(aliases[expr['column']])
+        else:
+            if expr not in expressions:
+                expressions.append(expr)
+            orderby_positions.append(expressions.index(expr))
+    return expressions, output_count, orderby_positions
+
+def group_result_rows(table_rows, row_columns, group_columns, expressions, collations, batches=False):
+    """
+    Streams rows named by row_columns through group_rows, or ColumnBatches through group_batches with batches,
+    yielding the values of expressions for each group. collations maps column names to their COLLATE, which
+    GROUP BY, MIN, MAX and DISTINCT compare TEXT under.
+    """
+    group_collations = [collation_name(collations.get(column)) for column in group_columns]
+
+    # group_rows yields each group's key followed by its aggregates, sources say where each expression is in that
+    calls = []
+    sources = []
+    for expr in expressions:
+        if expr['type'] == 'column_ref' and expr['column'] in group_columns and group_collations[group_columns.index(expr['column'])] is None:
+            sources.append(group_columns.index(expr['column']))
+            continue
+        if expr['type'] == 'column_ref':
+            # also a column grouped on under a collation, whose key holds its TEXT folded: it's output as it's stored
+            calls.append(AggregateCall(None, row_columns.index(expr['column'])))
+        else:
+            argument = expr['args']['expr']
+            position = row_columns.index(argument['column']) if argument['type'] == 'column_ref' else None
+            collation = collation_name(collations.get(argument['column'])) if argument['type'] == 'column_ref' else None
+            calls.append(AggregateCall(expr['name'], position, expr['args']['distinct'], collation))
+        sources.append(len(group_columns) + len(calls) - 1)
+
+    grouping = group_batches if batches else group_rows
+    groups = grouping(table_rows, [row_columns.index(column) for column in group_columns], calls, group_collations=group_collations)
+    return ([(key + tuple(results))[source] for source in sources] for key, results in groups)
+
+def aggregate_statement(pager, catalog, table_record, sql_ast, processes=1, vectorized=False):
+    """
+    SELECTs with GROUP BY or aggregates other than a lone COUNT(*). The matching rows are streamed through group_rows,
+    which only keeps one set of aggregate states per group, then ORDER BY and LIMIT apply to the groups.
+    """
+    where = sql_ast["where"]
+    group_columns = [column['column'] for column in sql_ast["groupby"] or []]
+    expressions, output_count, orderby_positions = get_aggregate_expressions(sql_ast, table_record.columns)
+
+    read_columns = list(group_columns)
+    for expr in expressions:
+        if expr['type'] == 'column_ref':
+            read_columns.append(expr['column'])
+        elif expr['args']['expr']['type'] == 'column_ref':
+            read_columns.append(expr['args']['expr']['column'])
+    for column in read_columns + get_where_columns(where):
+        if column not in table_record.columns:
+            raise Exception(f"no such column: {column}")
+    row_layout = RowLayout.for_columns(table_record.columns, read_columns + get_where_columns(where), table_record.rowid_alias,
+                                      table_record.real_columns)
+
+    collations = dict(zip(table_record.columns, table_record.column_collations))
+    plan = plan_query(pager, catalog, table_record, where, None, processes=processes, needed_columns=row_layout.columns)
+    if sql_ast["explain"]:
+        return explain_rows(plan.explain(sql_ast["orderby"], group_columns, name=sql_ast["from"][0]["as"]))
+    record_plan(lambda: plan.explain(sql_ast["orderby"], group_columns, name=sql_ast["from"][0]["as"]))
+
+    if vectorized and reads_batches(plan, processes):
+        batches = read_table_batches(pager, plan, row_layout, where)
+        group_values = group_result_rows(batches, row_layout.columns, group_columns, expressions, collations, batches=True)
+    else:
+        table_rows = read_table_rows(pager, plan, row_layout, where, processes, ordered=False)
+        group_values = group_result_rows(table_rows, row_layout.columns, group_columns, expressions, collations)
+    return result_rows(group_values, sql_ast["orderby"], orderby_positions, sql_ast["limit"], range(output_count))
+
+def join_statement(pager, catalog, sources, sql_ast, processes=1):
+    """
+    SELECTs over several tables, with the columns of sql_ast resolved to the alias.column names of the joined rows.
+    Rows are joined through hash tables or index lookups as plan_join picks, then grouped, sorted and limited like
+    the rows of a single table.
+    """
+    join_plan = plan_join(pager, catalog, sources, sql_ast, processes)
+    orderby = sql_ast["orderby"]
+    group_columns = [column['column'] for column in sql_ast["groupby"] or []]
+    if sql_ast["explain"]:
+        return explain_rows(join_plan.explain(orderby, group_columns))
+    record_plan(lambda: join_plan.explain(orderby, group_columns))
+
+    joined_rows = read_joined_rows(pager, join_plan, processes)
+    if is_aggregate_query(sql_ast):
+        expressions, output_count, orderby_positions = get_aggregate_expressions(sql_ast, [])
+        collations = {f"{alias}.{column}": collation for alias, table in sources
+                      for column, collation in zip(table.columns, table.column_collations)}
+        group_values = group_result_rows(joined_rows, join_plan.columns, group_columns, expressions, collations)
+        return result_rows(group_values, orderby, orderby_positions, sql_ast["limit"], range(output_count))
+
+    selected_columns = [column['expr']['column'] for column in sql_ast["columns"]]
+    aliases = {column['as']: column['expr']['column'] for column in sql_ast["columns"] if column['as']}
+    orderby_positions = []
+    for term in orderby or []:
+        if term['expr']['type'] == 'aggr_func':
+            raise Exception(f"misuse of aggregate: {term['expr']['name']}()")
+        column = term['expr']['column']
+        orderby_positions.append(join_plan.columns.index(aliases.get(column, column)))
+    return result_rows(joined_rows, orderby, orderby_positions, sql_ast["limit"], [join_plan.columns.index(column) for column in selected_columns])
+
+def read_joined_rows(pager, join_plan, processes=1):
+    """
+    Runs a JoinPlan as a lazy pipeline: the rows of its first table flow through one join per step, what's left of
+    the WHERE clause is checked on the joined rows.
+    """
+    joined_rows = read_table_rows(pager, join_plan.first, join_plan.row_layout, join_plan.first_where, processes, ordered=False)
+    columns = [f"{join_plan.alias}.{column}" for column in join_plan.row_layout.columns]
+    for step in join_plan.steps:
+        right_columns = [f"{step.alias}.{column}" for column in step.row_layout.columns]
+        condition = None
+        if step.condition is not None:
+            condition = compile_predicate(step.condition, {column: position for position, column in enumerate(columns + right_columns)})
+
+        if step.strategy == 'index':
+            joined_rows = index_join(pager, joined_rows, columns.index(step.left_keys[0]), step, condition)
+        else:
+            right_rows = read_table_rows(pager, step.plan, step.row_layout, step.filter, processes, ordered=False)
+            joined_rows = hash_join(joined_rows, right_rows, [columns.index(key) for key in step.left_keys],
+                                    [step.row_layout.columns.index(key) for key in step.right_keys], len(right_columns),
+                                    step.left_join, condition, step.build_left)
+        columns += right_columns
+
+    if join_plan.where is None:
+        return joined_rows
+    predicate = compile_predicate(join_plan.where, {column: position for position, column in enumerate(columns)})
+    return (row for row in joined_rows if predicate(row) is True)
+
+def scan_plan_index(pager, plan):
+    lower, upper, _, _ = plan.bounds or (None, None, 0, False)
+    return scan_index(pager, plan.index.rootpage, len(plan.index.columns) + 1, lower, upper, reverse=plan.reverse)
+
+def read_table_rows(pager, plan, row_layout, where, processes=1, ordered=True):
+    """
+    Reads the rows matching where through the access path of plan, as a lazy pipeline: B-tree cells -> decoded rows
+    -> filtered rows, nothing is held in memory. ordered=False lets a parallel scan return rows in any order.
+    Plans for ORDER BY ... DESC walk their B-tree backwards.
+    """
+    rootpage = plan.table.rootpage
+    where = None if plan.exact else where
+    if plan.access == 'index':
+        if plan.index_only:
+            table_rows = index_rows(scan_plan_index(pager, plan), plan.index, row_layout)
+        else:
+            table_rows = query_index(pager, scan_plan_index(pager, plan), row_layout, rootpage, keep_index_order=plan.sorted)
+        return filter_rows(table_rows, where, row_layout)
+    elif plan.access == 'rowid':
+        first_rowid, last_rowid = plan.bounds
+        if first_rowid is not None and first_rowid == last_rowid:
+            table_rows = (row for _rowid, row in search_by_rowids(pager, rootpage, [first_rowid], row_layout))
+            return filter_rows(table_rows, where, row_layout)
+        cells = read_pages_in_range(pager, rootpage, first_rowid, last_rowid, reverse=plan.reverse)
+    elif plan.reverse:
+        cells = read_pages_in_range(pager, rootpage, reverse=True)
+    elif processes > 1:
+        return parallel_scan(pager, rootpage, row_layout, where, processes, ordered, matching_leaf_pages(pager, plan.table, where))
+    else:
+        # zone maps of the columns where compares rule out leaf pages without reading them
+        leaf_pages = matching_leaf_pages(pager, plan.table, where)
+        cells = read_pages(pager, rootpage) if leaf_pages is None else read_leaf_cells(pager, leaf_pages)
+
+    # WHERE is checked on the columns it reads before the rest of each row is decoded
+    return get_filtered_table_rows(pager, cells, row_layout, where)
+
+def reads_batches(plan, processes=1):
+    """
+    Whether read_table_batches can run plan: full scans and rowid ranges read in rowid order by a single process.
+    """
+    return plan.access in ('scan', 'rowid') and not plan.reverse and processes == 1
+
+def read_table_batches(pager, plan, row_layout, where):
+    """
+    read_table_rows for vectorized execution, yielding ColumnBatches of the matching rows instead of rows.
+    """
+    where = None if plan.exact else where
+    if plan.access == 'rowid':
+        cells = read_pages_in_range(pager, plan.table.rootpage, *plan.bounds)
+    else:
+        leaf_pages = matching_leaf_pages(pager, plan.table, where)
+        cells = read_leaf_cells(pager, get_leaf_pages(pager, plan.table.rootpage) if leaf_pages is None else leaf_pages)
+    return read_batches(pager, cells, row_layout, where)
+
+def project_rows(table_rows, positions):
+    for row in table_rows:
+        yield [row[position] for position in positions]
+
+class BatchedRows:
+    """
+    Result rows still held in ColumnBatches: the values at positions of the rows between offset and stop. They can
+    be iterated over like any other result rows, or written a batch at a time by a ResultWriter.
+    """
+    def __init__(self, batches, positions, offset=0, stop=None):
+        self.source = batches
+        self.positions = positions
+        self.offset = offset
+        self.stop = stop
+
+    def batches(self):
+        row_number = 0
+        for batch in self.source:
+            start, end = row_number, row_number + batch.length
+            row_number = end
+            if end <= self.offset:
+                continue
+            if start < self.offset or self.stop is not None and end > self.stop:
+                batch = batch.slice(max(self.offset - start, 0), batch.length if self.stop is None else self.stop - start)
+            yield batch
+            if self.stop is not None and row_number >= self.stop:
+                return
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield from project_rows(batch.rows(), self.positions)
+
+def run_command(pager, command, processes=1, vectorized=False, settings=None):
+    """
+    Runs a statement or dot command. settings are the session_settings of the connection it came from, the ones
+    --mode, --stats and --profile set when there isn't one.
+    """
+    settings = settings if settings is not None else session_settings()
     if command == ".dbinfo":
-        command_dot_dbinfo(database_file_path)
+        command_dot_dbinfo(pager)
     elif command == ".tables":
-        command_dot_tables(database_file_path)
-    elif command.lower().startswith('select'):
-        select_statement(database_file_path)
+        command_dot_tables(pager)
+    elif command.startswith(".zonemap"):
+        command_dot_zonemap(pager, command)
+    elif command.startswith(".mode"):
+        command_dot_mode(command, settings)
+    elif command.startswith(".stats"):
+        command_dot_stats(command, settings)
+    elif command.lower().startswith(('select', 'explain')):
+        if settings['stats']:
+            traced_select_statement(pager, command, processes, vectorized, settings['mode'], settings['profile'])
+        else:
+            select_statement(pager, command, processes, vectorized, settings['mode'])
     else:
         print(f"Invalid command: {command}")
 
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(prog="your_sqlite3.sh")
+    parser.add_argument("database_file_path")
+    parser.add_argument("command", nargs="?", help="statement to run, statements are read from stdin when left out")
+    parser.add_argument("--mmap", action="store_true", help="memory-map the database file instead of reading pages into a cache")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE, help="bytes of page data to keep cached")
+    parser.add_argument("--parallel", type=int, default=1, metavar="PROCESSES", help="spread full table scans over this many processes")
+    parser.add_argument("--vectorized", action="store_true", help="decode, filter and aggregate scanned rows a batch of columns at a time")
+    parser.add_argument("--mode", choices=OUTPUT_MODES, default="list", help="how result rows are written, like .mode")
+    parser.add_argument("--stats", action="store_true", help="print what each statement read and decoded and where its time went on stderr, like .stats on")
+    parser.add_argument("--profile", metavar="PATH", help="run statements under cProfile and dump the profile to PATH, - prints it on stderr")
+    parser.add_argument("--serve", metavar="SOCKET_PATH", help="keep the database open and run statements sent to this Unix socket")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    arguments = parse_arguments(sys.argv[1:])
+    output_settings['mode'] = arguments.mode
+    stats_settings['stats'] = arguments.stats or arguments.profile is not None
+    stats_settings['profile'] = arguments.profile
+
+    with Pager(arguments.database_file_path, cache_size=arguments.cache_size, use_mmap=arguments.mmap) as pager:
+        # Long running sessions keep the pager, catalog and parsed statements warm between statements
+        def connect():
+            # every connection gets its own .mode and .stats settings, like a sqlite3 shell of its own
+            settings = session_settings()
+            def execute(command):
+                run_command(pager, command, arguments.parallel, arguments.vectorized, settings)
+            return execute
+
+        if arguments.serve:
+            serve(connect, arguments.serve)
+        elif arguments.command is None:
+            repl(connect())
+        else:
+            connect()(arguments.command)
@@ -0,0 +1,346 @@
+import itertools
+import json
+import math
+import re
+import struct
+import sys
+from array import array
+
+from .overflow import LazyValue, materialize
+
+OUTPUT_BUFFER_SIZE = 1 << 16 # bytes of formatted rows collected before a write
+COLUMNAR_BATCH_SIZE = 1024 # rows of columnar output encoded together when they don't come in batches already
+
+# What --mode picked, the mode every connection starts from before its own .mode
+settings = {'mode': 'list'}
+
+# The sqlite3 shell quotes CSV fields holding spaces, quotes, control characters, commas or anything past ASCII
+CSV_QUOTE = re.compile(rb'[\x00-\x20"\',\x7f-\xff]')
+JSON_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), allow_nan=False)
+TEXT_TYPES = {bytes, memoryview, LazyValue}
+
+# Columnar output, every number little-endian:
+#   stream:  b"SQLC", version (u8), column count (u32), batches, a row count of 0
+#   batch:   row count (u32), then a kind (u8) and the data of each column
+#   kinds:   NULL has no data. INTEGER, REAL and TEXT/BLOB columns start with a validity bitmap of a bit per row,
+#            least significant bit first, when they hold NULLs: the kind has NULLABLE set then. INTEGER and REAL
+#            columns are then an int64 or float64 per row (0 for NULLs), TEXT/BLOB columns row count + 1 uint64
+#            offsets into the value bytes that follow. MIXED columns are a kind (u8) per row followed by each
+#            non-NULL value: an int64, a float64 or a uint64 length and the bytes.
+COLUMNAR_MAGIC = b"SQLC"
+COLUMNAR_VERSION = 1
+NULL_KIND, INTEGER_KIND, REAL_KIND, BYTES_KIND, MIXED_KIND = range(5)
+NULLABLE = 0x80
+BYTES_TYPES = {bytes, memoryview}
+LITTLE_ENDIAN = sys.byteorder == "little"
+
+def format_real(value):
+    """
+    A REAL the way the sqlite3 shell prints it (printf's %!.15g): 15 significant digits, always with a decimal
+    point, infinities as Inf and -Inf.
+    """
+    if math.isinf(value):
+        return "Inf" if value > 0 else "-Inf"
+    text = "%.15g" % (value + 0.0) # + 0.0 turns -0.0 into 0.0
+    mantissa, e, exponent = text.partition("e")
+    if "." not in mantissa:
+        mantissa += ".0"
+    return mantissa + e + exponent
+
+def binary_stdout():
+    """
+    The binary stream under sys.stdout, flushed of any text printed before. Text streams without one (io.StringIO)
+    are written to through a TextStream.
+    """
+    sys.stdout.flush()
+    stream = getattr(sys.stdout, "buffer", None)
+    return stream if stream is not None else TextStream(sys.stdout)
+
+class TextStream:
+    def __init__(self, text):
+        self.text = text
+
+    def write(self, data):
+        self.text.write(bytes(data).decode("utf-8", "replace"))
+
+    def flush(self):
+        self.text.flush()
+
+def result_writer(stream=None, mode=None):
+    """
+    A ResultWriter for the output mode (settings['mode'] unless given) writing to stream, standard output by default.
+    """
+    mode = mode or settings['mode']
+    if mode not in WRITERS:
+        raise Exception(f"Unknown output mode: {mode}, it can be one of {', '.join(WRITERS)}")
+    return WRITERS[mode](binary_stdout() if stream is None else stream)
+
+class ResultWriter:
+    """
+    Writes result rows to a binary stream. Rows are formatted into bytes by format_row and written
+    OUTPUT_BUFFER_SIZE bytes at a time, which close() finishes off.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.pending = []
+        self.pending_size = 0
+
+    def format_row(self, values):
+        raise NotImplementedError
+
+    def write_rows(self, rows):
+        format_row = self.format_row
+        pending = self.pending
+        for values in rows:
+            line = format_row(values)
+            pending.append(line)
+            self.pending_size += len(line)
+            if self.pending_size >= OUTPUT_BUFFER_SIZE:
+                self.flush()
+
+    def write_batches(self, batches, positions):
+        """
+        Writes the values at positions of the rows of ColumnBatches.
+        """
+        for batch in batches:
+            self.write_rows([row[position] for position in positions] for row in batch.rows())
+
+    def flush(self):
+        if self.pending:
+            self.stream.write(b"".join(self.pending))
+            self.pending.clear()
+            self.pending_size = 0
+
+    def close(self):
+        self.flush()
+        self.stream.flush()
+
+def list_value(value):
+    value_type = type(value)
+    if value_type is memoryview or value_type is bytes:
+        return value
+    elif value_type is int:
+        return b"%d" % value
+    elif value is None:
+        return b""
+    elif value_type is float:
+        return format_real(value).encode()
+    return bytes(value)
+
+class ListWriter(ResultWriter):
+    """
+    The sqlite3 shell's default list mode: values separated by |, TEXT and BLOB values written as they're stored.
+    TEXT and BLOB values that run onto overflow pages are written a page at a time rather than read into memory.
+    """
+
+    def format_row(self, values):
+        return b"|".join(map(list_value, values)) + b"\n"
+
+    def write_rows(self, rows):
+        format_row = self.format_row
+        pending = self.pending
+        for values in rows:
+            if LazyValue in map(type, values):
+                self.write_lazy_row(values)
+                continue
+            line = format_row(values)
+            pending.append(line)
+            self.pending_size += len(line)
+            if self.pending_size >= OUTPUT_BUFFER_SIZE:
+                self.flush()
+
+    def write_lazy_row(self, values):
+        self.flush()
+        for i, value in enumerate(values):
+            if i:
+                self.stream.write(b"|")
+            if type(value) is LazyValue:
+                for chunk in value.chunks():
+                    self.stream.write(chunk)
+            else:
+                self.stream.write(list_value(value))
+        self.stream.write(b"\n")
+
+    def write_batches(self, batches, positions):
+        """
+        Formats each batch a column at a time, batches holding values that run onto overflow pages row by row.
+        """
+        for batch in batches:
+            if not batch.length:
+                continue
+            if any(LazyValue in batch.types[position] for position in positions):
+                self.write_rows([row[position] for position in positions] for row in batch.rows())
+                continue
+            columns = [list_column(batch.column(position), batch.types[position]) for position in positions]
+            lines = map(b"|".join, zip(*columns)) if columns else [b""] * batch.length
+            text = b"\n".join(lines) + b"\n"
+            self.pending.append(text)
+            self.pending_size += len(text)
+            if self.pending_size >= OUTPUT_BUFFER_SIZE:
+                self.flush()
+
+def list_column(values, types):
+    if types == {int}:
+        return list(map(b"%d".__mod__, values))
+    elif types <= BYTES_TYPES:
+        return values
+    return list(map(list_value, values))
+
+def csv_value(value):
+    value_type = type(value)
+    if value_type is memoryview or value_type is bytes:
+        if value and CSV_QUOTE.search(value) is None:
+            return value
+        return b'"' + bytes(value).replace(b'"', b'""') + b'"'
+    elif value_type is LazyValue:
+        return csv_value(bytes(value))
+    return list_value(value)
+
+class CSVWriter(ResultWriter):
+    """
+    The sqlite3 shell's csv mode: comma separated values, NULL as an empty field, TEXT and BLOB values in double
+    quotes when they're empty or hold anything that could be mistaken for CSV syntax.
+    """
+
+    def format_row(self, values):
+        return b",".join(map(csv_value, values)) + b"\n"
+
+def json_value(value):
+    value_type = type(value)
+    if value_type is int:
+        return b"%d" % value
+    elif value is None:
+        return b"null"
+    elif value_type is float:
+        return b"9.0e+999" if value == math.inf else b"-9.0e+999" if value == -math.inf else repr(value).encode()
+    return JSON_ENCODER.encode(str(bytes(value), "utf-8", "replace")).encode()
+
+class NDJSONWriter(ResultWriter):
+    """
+    A JSON array of the values of each row per line. REALs are written with every digit they need to round trip,
+    infinities as the out of range 9.0e+999 the sqlite3 shell's json mode uses.
+    """
+
+    def format_row(self, values):
+        row = [str(materialize(value), "utf-8", "replace") if type(value) in TEXT_TYPES else value for value in values]
+        try:
+            return JSON_ENCODER.encode(row).encode() + b"\n"
+        except ValueError: # infinities
+            return b"[" + b",".join(map(json_value, values)) + b"]\n"
+
+class ColumnarWriter(ResultWriter):
+    """
+    The binary columnar format described at COLUMNAR_MAGIC. Rows are encoded COLUMNAR_BATCH_SIZE at a time, the
+    INTEGER and REAL columns of ColumnBatches straight from their arrays.
+    """
+
+    def __init__(self, stream):
+        super().__init__(stream)
+        self.rows = []
+        self.column_count = None
+
+    def write_rows(self, rows):
+        for values in rows:
+            self.rows.append(values)
+            if len(self.rows) >= COLUMNAR_BATCH_SIZE:
+                self.write_buffered_rows()
+
+    def write_buffered_rows(self):
+        if self.rows:
+            columns = [list(column) for column in zip(*self.rows)]
+            self.write_columns(len(self.rows), [(column, set(map(type, column))) for column in columns], len(self.rows[0]))
+            self.rows = []
+
+    def write_batches(self, batches, positions):
+        self.write_buffered_rows()
+        for batch in batches:
+            if batch.length:
+                columns = [(batch.column(position), batch.types[position]) for position in positions]
+                self.write_columns(batch.length, columns, len(positions))
+
+    def write_columns(self, length, columns, column_count):
+        if self.column_count is None:
+            self.column_count = column_count
+            self.write(COLUMNAR_MAGIC + struct.pack("<BI", COLUMNAR_VERSION, column_count))
+        self.write(struct.pack("<I", length))
+        for values, types in columns:
+            self.write(encode_column(values, types))
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= OUTPUT_BUFFER_SIZE:
+            self.flush()
+
+    def close(self):
+        self.write_buffered_rows()
+        if self.column_count is None:
+            self.write(COLUMNAR_MAGIC + struct.pack("<BI", COLUMNAR_VERSION, 0))
+        self.write(struct.pack("<I", 0))
+        super().close()
+
+def little_endian(values):
+    if not LITTLE_ENDIAN:
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+def validity_bitmap(values):
+    bitmap = bytearray((len(values) + 7) // 8)
+    for i, value in enumerate(values):
+        if value is not None:
+            bitmap[i >> 3] |= 1 << (i & 7)
+    return bytes(bitmap)
+
+def encode_column(values, types):
+    """
+    The kind and data of a column of a columnar batch, types being the set of the types of values.
+    """
+    lazy = LazyValue in types
+    types = {bytes if value_type in TEXT_TYPES else value_type for value_type in types}
+    nullable = type(None) in types
+    types.discard(type(None))
+    if not types:
+        return bytes([NULL_KIND])
+
+    value_type = types.pop() if len(types) == 1 else None
+    prefix = bytes([{int: INTEGER_KIND, float: REAL_KIND, bytes: BYTES_KIND}.get(value_type, MIXED_KIND) | (NULLABLE if nullable and value_type else 0)])
+    if nullable and value_type:
+        prefix += validity_bitmap(values)
+
+    if value_type is int or value_type is float:
+        typecode = 'q' if value_type is int else 'd'
+        if not (isinstance(values, array) and values.typecode == typecode):
+            values = array(typecode, [0 if value is None else value for value in values])
+        return prefix + little_endian(values)
+
+    if value_type is bytes:
+        if nullable or lazy:
+            values = [b"" if value is None else materialize(value) for value in values]
+        offsets = array('Q', itertools.accumulate(map(len, values), initial=0))
+        return prefix + little_endian(offsets) + b"".join(values)
+
+    kinds = bytearray()
+    data = []
+    for value in values:
+        if value is None:
+            kinds.append(NULL_KIND)
+        elif type(value) is int:
+            kinds.append(INTEGER_KIND)
+            data.append(struct.pack("<q", value))
+        elif type(value) is float:
+            kinds.append(REAL_KIND)
+            data.append(struct.pack("<d", value))
+        else:
+            value = bytes(value)
+            kinds.append(BYTES_KIND)
+            data.append(struct.pack("<Q", len(value)) + value)
+    return prefix + bytes(kinds) + b"".join(data)
+
+WRITERS = {
+    'list': ListWriter,
+    'csv': CSVWriter,
+    'ndjson': NDJSONWriter,
+    'columnar': ColumnarWriter,
+}
@@ -0,0 +1,145 @@
+from .record_parser import parse_column_value
+
+
+def table_leaf_max_local(usable_size):
+    """
+    Largest payload stored entirely on a table leaf page, see https://www.sqlite.org/fileformat2.html#b_tree_pages
+    """
+    return usable_size - 35
+
+
+def index_max_local(usable_size):
+    """
+    Largest payload stored entirely on an index page (leaf or interior).
+    """
+    return ((usable_size - 12) * 64 // 255) - 23
+
+
+def min_local(usable_size):
+    return ((usable_size - 12) * 32 // 255) - 23
+
+
+def local_payload_size(payload_size, usable_size, max_local):
+    """
+    Number of payload bytes kept on the b-tree page itself, the rest spills onto overflow pages.
+    """
+    if payload_size <= max_local:
+        return payload_size
+
+    minimum = min_local(usable_size)
+    local_size = minimum + (payload_size - minimum) % (usable_size - 4)
+    return local_size if local_size <= max_local else minimum
+
+
+def read_payload(pager, page, offset, payload_size, max_local):
+    """
+    Returns (buffer, offset, overflow) to decode the payload of a cell starting at offset.
+
+    Payloads that fit on the page are decoded in place and overflow is None. Larger ones come back as their
+    local part (starting at offset 0) along with an OverflowPayload that reads the rest on demand.
+    """
+    if payload_size <= max_local:
+        return page, offset, None
+
+    local_size = local_payload_size(payload_size, pager.usable_size, max_local)
+    first_overflow_page = int.from_bytes(page[offset + local_size:offset + local_size + 4], "big")
+    overflow = OverflowPayload(pager, page[offset:offset + local_size], first_overflow_page, payload_size)
+    return overflow.local, 0, overflow
+
+
+def materialize(value):
+    """
+    Copies TEXT and BLOB values (page slices or LazyValues) into bytes, other values are returned as is.
+    """
+    if isinstance(value, (memoryview, LazyValue)):
+        return bytes(value)
+    return value
+
+
+class OverflowPayload:
+    """
+    A cell payload that runs onto a chain of overflow pages, as described here:
+    https://www.sqlite.org/fileformat2.html#ovflpgs
+
+    The chain is only followed as far as the requested bytes need it.
+    """
+
+    def __init__(self, pager, local, first_overflow_page, size):
+        self.pager = pager
+        self.local = local
+        self.size = size
+        self.overflow_page_numbers = [first_overflow_page]
+
+    @property
+    def local_size(self):
+        return len(self.local)
+
+    def overflow_page(self, index):
+        while len(self.overflow_page_numbers) <= index:
+            # The first 4 bytes of every overflow page point at the next page in the chain
+            previous_page = self.pager.get_page(self.overflow_page_numbers[-1])
+            self.overflow_page_numbers.append(int.from_bytes(previous_page[:4], "big"))
+
+        return self.pager.get_page(self.overflow_page_numbers[index])
+
+    def iter_chunks(self, start, length):
+        """
+        Yields the payload bytes in [start, start + length) as slices of the pages they live on.
+        """
+        end = start + length
+        if start < self.local_size:
+            yield self.local[start:min(end, self.local_size)]
+            start = self.local_size
+
+        content_size = self.pager.usable_size - 4
+        while start < end:
+            index, page_offset = divmod(start - self.local_size, content_size)
+            chunk_length = min(end - start, content_size - page_offset)
+            yield self.overflow_page(index)[4 + page_offset:4 + page_offset + chunk_length]
+            start += chunk_length
+
+    def read(self, start, length):
+        return b"".join(self.iter_chunks(start, length))
+
+    def column_value(self, start, serial_type, width):
+        """
+        Value of a column whose bytes run past the local part of the payload.
+        """
+        if serial_type >= 12:
+            return LazyValue(self, start, width)
+
+        # Numbers are at most 8 bytes, just read them
+        return parse_column_value(self.read(start, width), 0, serial_type)
+
+
+class LazyValue:
+    """
+    A TEXT or BLOB value that runs onto overflow pages. Nothing past the local part of the cell is read until the
+    value is compared, copied with bytes() or streamed with chunks().
+    """
+    __slots__ = ("payload", "start", "length")
+
+    def __init__(self, payload, start, length):
+        self.payload = payload
+        self.start = start
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __bytes__(self):
+        return self.payload.read(self.start, self.length)
+
+    def chunks(self):
+        return self.payload.iter_chunks(self.start, self.length)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyValue):
+            other = bytes(other)
+        if not isinstance(other, (bytes, bytearray, memoryview)):
+            return NotImplemented
+        # Most comparisons are settled by the length, without touching the overflow chain
+        return len(other) == self.length and bytes(self) == other
+
+    def __hash__(self):
+        return hash(bytes(self))
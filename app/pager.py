@@ -0,0 +1,163 @@
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+PAGE_SIZE_OFFSET = 16
+RESERVED_SPACE_OFFSET = 20
+DATABASE_HEADER_LENGTH = 100
+
+DEFAULT_CACHE_SIZE = 2 * 1024 * 1024  # bytes of page data kept in memory
+READ_AHEAD_PAGES = 8  # pages a scan asks to have read ahead of it at a time
+
+
+class Pager:
+    """
+    Reads whole database pages and keeps the most recently used ones in an LRU cache.
+
+    Page numbers start at 1, as described here: https://www.sqlite.org/fileformat2.html#pages
+
+    With use_mmap the whole file is memory-mapped instead and pages are returned as zero-copy
+    memoryview slices of the mapping, so the cache (and its hit/miss counters) is bypassed.
+
+    A pager can be shared by threads: pages are read with pread, which doesn't move a shared file position, and the
+    cache is only touched under a lock. With read_ahead_threads, scans can have the pages they're about to visit read
+    into the cache in the background through read_ahead.
+    """
+
+    def __init__(self, database_path, cache_size=DEFAULT_CACHE_SIZE, use_mmap=False, read_ahead_threads=0):
+        self.database_path = database_path
+        self.cache_size = cache_size
+        self.database_file = open(database_path, "rb")
+        self.database_file.seek(PAGE_SIZE_OFFSET)
+        self.page_size = int.from_bytes(self.database_file.read(2), "big")
+        if self.page_size == 1:
+            # A value of 1 represents a page size of 65536
+            self.page_size = 65536
+
+        # Bytes at the end of every page reserved for extensions, cells never use them
+        self.database_file.seek(RESERVED_SPACE_OFFSET)
+        self.usable_size = self.page_size - self.database_file.read(1)[0]
+
+        self.max_pages = max(1, cache_size // self.page_size)
+        self.pages = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.reading = set() # pages being read ahead
+        self.generation = 0 # bumped by clear, pages read before then are left out of the cache
+        self.database_version = None # the header version load_catalog last saw through this pager
+
+        self.read_ahead_executor = None
+        self.read_ahead_futures = set() # loads submitted and not done yet, cancelled by close
+        if read_ahead_threads and not use_mmap:
+            self.read_ahead_executor = ThreadPoolExecutor(read_ahead_threads, thread_name_prefix="read-ahead")
+
+        self.mmap = None
+        self.mapped = None
+        if use_mmap:
+            self.map_file()
+
+    def map_file(self):
+        # the old mapping, if any, is unmapped once the slices handed out of it are dropped
+        self.mmap = mmap.mmap(self.database_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.mapped = memoryview(self.mmap)
+
+    def get_page(self, page_number):
+        if self.mapped is not None:
+            page_start = (page_number - 1) * self.page_size
+            return self.mapped[page_start:page_start + self.page_size]
+
+        with self.lock:
+            page = self.pages.get(page_number)
+            if page is not None:
+                self.hits += 1
+                self.pages.move_to_end(page_number)
+                return page
+            self.misses += 1
+            generation = self.generation
+
+        # read outside the lock, so other threads keep getting cached pages meanwhile
+        page = self.read_page(page_number)
+        self.cache_page(page_number, page, generation)
+        return page
+
+    def read_page(self, page_number):
+        return memoryview(os.pread(self.database_file.fileno(), self.page_size, (page_number - 1) * self.page_size))
+
+    def cache_page(self, page_number, page, generation):
+        with self.lock:
+            if generation != self.generation:
+                return # read before a clear(), it may be stale
+            self.pages[page_number] = page
+            if len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+
+    def read_ahead(self, page_numbers):
+        """
+        Reads the first READ_AHEAD_PAGES of page_numbers that aren't cached or already on their way into the cache on
+        the read-ahead threads, without waiting for them. Does nothing when there are no read-ahead threads.
+        """
+        if self.read_ahead_executor is None:
+            return
+        with self.lock:
+            pending = [page_number for page_number in page_numbers if page_number not in self.pages and page_number not in self.reading]
+            pending = pending[:READ_AHEAD_PAGES]
+            self.reading.update(pending)
+            generation = self.generation
+        if pending:
+            future = self.read_ahead_executor.submit(self.load_pages, pending, generation)
+            self.read_ahead_futures.add(future)
+            future.add_done_callback(self.read_ahead_futures.discard)
+
+    def load_pages(self, page_numbers, generation):
+        for page_number in page_numbers:
+            try:
+                self.cache_page(page_number, self.read_page(page_number), generation)
+            finally:
+                with self.lock:
+                    self.reading.discard(page_number)
+
+    def read_database_header(self):
+        """
+        Reads the 100 byte database header straight from the file, bypassing the cache, so changes made by
+        other connections since the page was cached are seen.
+        """
+        return os.pread(self.database_file.fileno(), DATABASE_HEADER_LENGTH, 0)
+
+    def clear(self):
+        """
+        Drops every cached page, e.g. once the file has been changed by another connection. Pages still being read,
+        by read-ahead or another thread, don't make it into the cache afterwards. A memory-mapped file that has grown
+        or shrunk since it was mapped is mapped again.
+        """
+        with self.lock:
+            self.pages.clear()
+            self.reading.clear()
+            self.generation += 1
+            if self.mmap is not None and os.fstat(self.database_file.fileno()).st_size != len(self.mmap):
+                self.map_file()
+
+    def close(self):
+        if self.read_ahead_executor is not None:
+            # shutdown(cancel_futures=True) is Python 3.9 and later. Loads already running are waited for, they'd read
+            # from the file closed below otherwise, but that's at most READ_AHEAD_PAGES pages each
+            for future in list(self.read_ahead_futures):
+                future.cancel()
+            self.read_ahead_executor.shutdown(wait=True)
+        self.pages.clear()
+        if self.mmap is not None:
+            self.mapped.release()
+            try:
+                self.mmap.close()
+            except BufferError:
+                # Values handed out as slices still reference the mapping, it is unmapped once they are dropped
+                pass
+        self.database_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
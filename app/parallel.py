@@ -0,0 +1,63 @@
+import math
+import multiprocessing
+
+from .btree import get_leaf_pages, read_pages
+from .overflow import materialize
+from .pager import Pager
+from .predicates import get_filtered_table_rows
+
+CHUNKS_PER_PROCESS = 4 # more chunks than processes keeps every process busy when some chunks filter faster
+
+# Set up once in every pool process by init_worker
+worker = {}
+
+def init_worker(database_path, cache_size, use_mmap, row_layout, where):
+    worker['pager'] = Pager(database_path, cache_size=cache_size, use_mmap=use_mmap)
+    worker['row_layout'] = row_layout
+    worker['where'] = where
+
+def filter_leaf_pages(leaf_page_numbers):
+    pager, row_layout = worker['pager'], worker['row_layout']
+    cells = (cell for page_number in leaf_page_numbers for cell in read_pages(pager, page_number))
+    return get_filtered_table_rows(pager, cells, row_layout, worker['where'])
+
+def scan_chunk(leaf_page_numbers):
+    # page slices and lazy overflow values can't leave the process, copy them out
+    return [tuple(materialize(value) for value in row) for row in filter_leaf_pages(leaf_page_numbers)]
+
+def count_chunk(leaf_page_numbers):
+    return sum(1 for _ in filter_leaf_pages(leaf_page_numbers))
+
+def split_leaf_pages(pager, rootpage, processes, leaf_pages=None):
+    """
+    Splits the leaf pages of a table (or the ones listed of them) into contiguous chunks, so chunk order is rowid
+    order.
+    """
+    if leaf_pages is None:
+        leaf_pages = get_leaf_pages(pager, rootpage)
+    chunk_size = max(1, math.ceil(len(leaf_pages) / (processes * CHUNKS_PER_PROCESS)))
+    return [leaf_pages[start:start + chunk_size] for start in range(0, len(leaf_pages), chunk_size)]
+
+def create_pool(pager, processes, row_layout, where):
+    initargs = (pager.database_path, pager.cache_size, pager.mmap is not None, row_layout, where)
+    return multiprocessing.Pool(processes, initializer=init_worker, initargs=initargs)
+
+def parallel_scan(pager, rootpage, row_layout, where, processes, ordered=True, leaf_pages=None):
+    """
+    Full table scan with decoding and filtering spread over a pool of processes, each working through a share of
+    the leaf pages (all of them unless listed). Rows come back in rowid order when ordered, otherwise in whatever
+    order the chunks finish.
+    """
+    chunks = split_leaf_pages(pager, rootpage, processes, leaf_pages)
+    with create_pool(pager, processes, row_layout, where) as pool:
+        results = pool.imap(scan_chunk, chunks) if ordered else pool.imap_unordered(scan_chunk, chunks)
+        for table_rows in results:
+            yield from table_rows
+
+def parallel_count(pager, rootpage, row_layout, where, processes, leaf_pages=None):
+    """
+    COUNT over a filtered full table scan, each process counts its share of the leaf pages and the counts are summed.
+    """
+    chunks = split_leaf_pages(pager, rootpage, processes, leaf_pages)
+    with create_pool(pager, processes, row_layout, where) as pool:
+        return sum(pool.imap_unordered(count_chunk, chunks))
@@ -0,0 +1,254 @@
+import math
+from dataclasses import dataclass
+
+from .btree import (
+    INTERIOR_INDEX_PAGE,
+    INTERIOR_TABLE_PAGE,
+    LEAF_TABLE_PAGE,
+    IndexCursor,
+    get_leaf_pages,
+    leaf_cell_rowid,
+    read_cell_pointers,
+    read_page,
+)
+from .predicates import index_bounds, rowid_bounds
+
+# Costs are in units of decoding one table row, the work that dominates most queries here
+PAGE_COST = 2.0 # reading a page and its header
+ROW_COST = 1.0 # decoding a table row and checking it against the WHERE clause
+INDEX_ENTRY_COST = 1.0 # decoding an index entry
+ROWID_LOOKUP_COST = 0.5 # finding a rowid on a leaf page already read, on top of ROW_COST
+SORT_COST = 0.05 # one comparison of an ORDER BY sort
+
+SAMPLED_LEAVES = 8 # leaf pages read to estimate how many rows a B-tree holds
+
+@dataclass
+class TreeStatistics:
+    depth: int
+    leaf_pages: int
+    rows: int # estimated from SAMPLED_LEAVES leaf pages spread over the tree
+    min_rowid: int # table B-trees only, None when empty
+    max_rowid: int
+
+@dataclass
+class QueryPlan:
+    """
+    How a SELECT reads its table. access is one of:
+
+    - 'scan': every row of the table B-tree, in rowid order
+    - 'rowid': the rows with a rowid in bounds = (first_rowid, last_rowid), both inclusive and None when open
+    - 'index': the rows index points at, bounds being what index_bounds returns or None to walk the whole index
+
+    exact means the access path alone satisfies the WHERE clause, sorted that rows already come out in ORDER BY
+    order (walking the B-tree backwards when reverse, for ORDER BY ... DESC) and index_only that the query is
+    answered from index entries without reading the table: the index holds every column it reads, or it's a COUNT.
+    """
+    table: object
+    access: str
+    index: object = None
+    bounds: tuple = None
+    exact: bool = False
+    sorted: bool = False
+    reverse: bool = False
+    index_only: bool = False
+    rows: float = 0.0 # estimated rows read
+    cost: float = 0.0
+
+    def describe(self, name=None):
+        """
+        How the table is read in the words of SQLite's EXPLAIN QUERY PLAN, name being what the query calls the table.
+        """
+        name = name or self.table.name
+        if self.access == 'scan':
+            return f"SCAN {name}"
+        elif self.access == 'rowid':
+            first_rowid, last_rowid = self.bounds
+            if first_rowid is not None and first_rowid == last_rowid:
+                constraints = ["rowid=?"]
+            else:
+                constraints = (["rowid>?"] if first_rowid is not None else []) + (["rowid<?"] if last_rowid is not None else [])
+            return f"SEARCH {name} USING INTEGER PRIMARY KEY ({' AND '.join(constraints)})"
+        using = f"USING {'COVERING ' if self.index_only else ''}INDEX {self.index.name}"
+        if self.bounds is None:
+            return f"SCAN {name} {using}"
+        lower, upper, equal_columns, _ = self.bounds
+        constraints = [f"{column}=?" for column in self.index.columns[:equal_columns]]
+        if equal_columns < len(self.index.columns):
+            range_column = self.index.columns[equal_columns]
+            if lower is not None and len(lower[0]) > equal_columns:
+                constraints.append(f"{range_column}>?")
+            if upper is not None and len(upper[0]) > equal_columns:
+                constraints.append(f"{range_column}<?")
+        return f"SEARCH {name} {using} ({' AND '.join(constraints)})"
+
+    def explain(self, orderby, groupby=None, name=None):
+        """
+        The plan described the way SQLite's EXPLAIN QUERY PLAN does.
+        """
+        steps = [self.describe(name)]
+        if groupby:
+            steps.append("USE TEMP B-TREE FOR GROUP BY")
+        if orderby and not self.sorted:
+            steps.append("USE TEMP B-TREE FOR ORDER BY")
+        return explain_lines(steps)
+
+def explain_lines(steps):
+    lines = ["QUERY PLAN"]
+    for i, step in enumerate(steps):
+        lines.append(("`--" if i == len(steps) - 1 else "|--") + step)
+    return lines
+
+def collect_tree_statistics(pager, rootpage):
+    """
+    Measures a B-tree while reading only its interior pages and a sample of its leaves.
+    """
+    leaf_pages = get_leaf_pages(pager, rootpage)
+
+    depth = 1
+    page, page_header = read_page(pager, rootpage)
+    while page_header.page_type in (INTERIOR_INDEX_PAGE, INTERIOR_TABLE_PAGE):
+        depth += 1
+        cell_pointer = read_cell_pointers(page, page_header)[0]
+        page, page_header = read_page(pager, int.from_bytes(page[cell_pointer:cell_pointer + 4], "big"))
+
+    step = max(1, len(leaf_pages) // SAMPLED_LEAVES)
+    sample = leaf_pages[::step][:SAMPLED_LEAVES]
+    sampled_cells = sum(read_page(pager, page_number)[1].number_of_cells for page_number in sample)
+    rows = round(sampled_cells / len(sample) * len(leaf_pages))
+
+    min_rowid = max_rowid = None
+    last_page, last_header = read_page(pager, leaf_pages[-1])
+    if page_header.page_type == LEAF_TABLE_PAGE and page_header.number_of_cells and last_header.number_of_cells:
+        # page is the left most leaf
+        min_rowid = leaf_cell_rowid(page, read_cell_pointers(page, page_header)[0])
+        max_rowid = leaf_cell_rowid(last_page, read_cell_pointers(last_page, last_header)[-1])
+
+    return TreeStatistics(depth, len(leaf_pages), rows, min_rowid, max_rowid)
+
+def get_tree_statistics(pager, catalog, rootpage):
+    """
+    Statistics are kept on the catalog, so they're collected again once the database file changes.
+    """
+    statistics = catalog.statistics.get(rootpage)
+    if statistics is None:
+        statistics = catalog.statistics[rootpage] = collect_tree_statistics(pager, rootpage)
+    return statistics
+
+def index_selectivity(pager, index, lower, upper):
+    """
+    Estimates the fraction of index entries between two scan_index bounds from where seeks to them land.
+    """
+    cursor = IndexCursor(pager, index.rootpage, len(index.columns) + 1)
+    start = 0.0
+    if lower is not None:
+        cursor.seek(*lower)
+        start = cursor.position()
+    end = 1.0
+    if upper is not None:
+        # past every entry equal to an inclusive bound, on the first one equal to an exclusive bound
+        cursor.seek(upper[0], not upper[1])
+        end = cursor.position()
+    return max(end - start, 0.0)
+
+def sort_cost(rows):
+    return SORT_COST * rows * math.log2(max(rows, 2))
+
+def orderby_direction(orderby):
+    """
+    'ASC' or 'DESC' when every ORDER BY term sorts that way, None for mixed directions. A B-tree walked forwards or
+    backwards can only give one direction.
+    """
+    directions = {term['type'] for term in orderby or []}
+    return directions.pop() if len(directions) == 1 else None
+
+def index_satisfies_orderby(index_columns, equal_columns, orderby):
+    """
+    Whether reading an index in key order, or in reverse for DESC, returns rows in ORDER BY order. Columns pinned by
+    equality don't affect the order.
+    """
+    if orderby_direction(orderby) is None or any(term['expr']['type'] != 'column_ref' for term in orderby):
+        return False
+    pinned = set(index_columns[:equal_columns])
+    ordered_columns = [term['expr']['column'] for term in orderby if term['expr']['column'] not in pinned]
+    return list(index_columns[equal_columns:equal_columns + len(ordered_columns)]) == ordered_columns
+
+def rowid_satisfies_orderby(table, orderby):
+    return bool(orderby) and table.rowid_alias is not None and [term['expr']['column'] for term in orderby] == [table.rowid_alias]
+
+def index_covers(index, columns, rowid_alias):
+    """
+    Whether the entries of index hold every one of columns, the rowid at the end of each entry included.
+    """
+    return columns is not None and all(column in index.columns or column == rowid_alias for column in columns)
+
+def plan_query(pager, catalog, table, where, orderby, is_count=False, processes=1, limit=None, needed_columns=None):
+    """
+    Picks the cheapest way to read table for a query: a full scan, a rowid seek or range when WHERE constrains the
+    INTEGER PRIMARY KEY, or one of the table's indexes. Costs come from the B-tree statistics of the table and index
+    and, for index ranges, the fraction of the index the range covers.
+
+    limit is how many rows the query returns at most (LIMIT plus OFFSET), None when it returns them all.
+    needed_columns are all the columns the query reads, indexes holding every one of them are read without
+    touching the table, even from end to end. None only lets exact COUNTs skip the table.
+    """
+    table_statistics = get_tree_statistics(pager, catalog, table.rootpage)
+    rowid_ordered = rowid_satisfies_orderby(table, orderby)
+    reverse = orderby_direction(orderby) == 'DESC'
+    orderby_columns = [term['expr']['column'] for term in orderby or []]
+    table_rows = table_statistics.rows
+
+    def finish(plan):
+        if orderby and not plan.sorted:
+            # with a limit, top_rows sorts rows a chunk at a time along with the best limit rows so far, which
+            # costs each row a number of comparisons that grows with the limit rather than with every row
+            plan.cost += sort_cost(plan.rows) if limit is None else SORT_COST * plan.rows * math.log2(max(min(limit, plan.rows), 2))
+        elif limit is not None and plan.exact and plan.rows > limit:
+            # rows come out in the order they're returned in, reading stops after the first limit of them
+            plan.cost *= limit / plan.rows
+        return plan
+
+    # the full scan is what every other plan has to beat
+    scan_cost = table_statistics.leaf_pages * PAGE_COST + table_rows * ROW_COST
+    candidates = [finish(QueryPlan(table, 'scan', exact=not where, sorted=rowid_ordered, reverse=rowid_ordered and reverse,
+                                   rows=table_rows, cost=scan_cost / processes))]
+
+    bounds = rowid_bounds(where, table.rowid_alias) if table.rowid_alias else None
+    if bounds is not None:
+        first_rowid, last_rowid, exact = bounds
+        low = table_statistics.min_rowid if first_rowid is None else first_rowid
+        high = table_statistics.max_rowid if last_rowid is None else last_rowid
+        if table_statistics.min_rowid is None or low > high:
+            fraction = 0.0
+        else:
+            # rowids are assumed to be spread evenly between the smallest and the largest
+            fraction = min(1.0, (high - low + 1) / (table_statistics.max_rowid - table_statistics.min_rowid + 1))
+        rows = fraction * table_rows
+        row_cost = 0 if is_count and exact else rows * ROW_COST # exact counts only count cells
+        cost = table_statistics.depth * PAGE_COST + fraction * table_statistics.leaf_pages * PAGE_COST + row_cost
+        candidates.append(finish(QueryPlan(table, 'rowid', bounds=(first_rowid, last_rowid), exact=exact, sorted=rowid_ordered,
+                                           reverse=rowid_ordered and reverse, rows=rows, cost=cost)))
+
+    for index in catalog.get_indexes(table.name):
+        bounds = index_bounds(where, index.columns)
+        equal_columns = bounds[2] if bounds is not None else 0
+        sorted_by_index = index_satisfies_orderby(index.columns, equal_columns, orderby)
+        covering = index_covers(index, needed_columns, table.rowid_alias)
+        if bounds is None and not sorted_by_index and not covering:
+            continue
+
+        index_statistics = get_tree_statistics(pager, catalog, index.rootpage)
+        fraction = index_selectivity(pager, index, bounds[0], bounds[1]) if bounds is not None else 1.0
+        entries = fraction * index_statistics.rows
+        exact = not where or (bounds is not None and bounds[3])
+        # ORDER BY columns all pinned by equality are satisfied either way, the index is read forwards then
+        reverse_index = sorted_by_index and reverse and any(column not in index.columns[:equal_columns] for column in orderby_columns)
+        cost = (index_statistics.depth + fraction * index_statistics.leaf_pages) * PAGE_COST + entries * INDEX_ENTRY_COST
+
+        index_only = covering or (is_count and exact)
+        if not index_only:
+            # rowids are looked up in sorted batches, so each table leaf page is read at most about once
+            cost += entries * (ROW_COST + ROWID_LOOKUP_COST) + min(entries, table_statistics.leaf_pages) * PAGE_COST
+        candidates.append(finish(QueryPlan(table, 'index', index=index, bounds=bounds, exact=exact, sorted=sorted_by_index,
+                                           reverse=reverse_index, index_only=index_only, rows=entries, cost=cost)))
+
+    return min(candidates, key=lambda plan: plan.cost)
@@ -0,0 +1,526 @@
+import math
+import operator
+import re
+from functools import lru_cache
+
+from .btree import collate, collation_name, get_table_rows, read_table_cell, sort_key
+from .output import format_real
+from .overflow import materialize, table_leaf_max_local
+from .stats import current as current_stats
+from .varint_parser import parse_varint
+
+COMPARISONS = {
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<>': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+# What a comparison turns into when its operands are swapped, e.g. 5 < age is age > 5
+FLIPPED_COMPARISONS = {'=': '=', '==': '=', '<': '>', '<=': '>=', '>': '<', '>=': '<='}
+
+# Text that INTEGER, REAL and NUMERIC affinity turn into a number, surrounding spaces allowed
+NUMERIC_TEXT = re.compile(r'[ \t\n\f\r\v]*([+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)[ \t\n\f\r\v]*')
+NUMERIC_AFFINITIES = {'INTEGER', 'REAL', 'NUMERIC'}
+
+def literal_value(node):
+    if node['type'] == 'single_quote_string':
+        return node['value'].encode()
+    return node['value']
+
+@lru_cache(maxsize=None)
+def like_pattern(pattern):
+    """
+    Compiles a LIKE pattern. As in SQLite, % matches any run of characters, _ matches one and ASCII letters
+    match regardless of case.
+    """
+    regex = "".join(".*" if char == "%" else "." if char == "_" else re.escape(char) for char in pattern)
+    return re.compile(regex, re.IGNORECASE | re.ASCII | re.DOTALL)
+
+def like_prefix(pattern):
+    """
+    The literal text a LIKE pattern starts with, before its first wildcard.
+    """
+    return re.split("[%_]", pattern, maxsplit=1)[0]
+
+def coerce_literal(node, affinity):
+    """
+    A literal node converted the way SQLite converts a value without affinity before comparing it with a column
+    of affinity: TEXT that reads as a number becomes one for INTEGER, REAL and NUMERIC columns, numbers become
+    TEXT for TEXT columns. BLOB columns compare values as they are. The node remembers the affinity it was
+    compared under.
+    """
+    if affinity is None or node['type'] not in ('number', 'single_quote_string'):
+        return node
+    value = node['value']
+    if affinity in NUMERIC_AFFINITIES and node['type'] == 'single_quote_string':
+        match = NUMERIC_TEXT.fullmatch(value)
+        if match is not None:
+            number = match.group(1)
+            if number.lstrip('+-').isdigit() and -2**63 <= int(number) < 2**63:
+                value = int(number)
+            else:
+                value = float(number) # a fraction, an exponent or too big for an INTEGER
+            return {'type': 'number', 'value': value, 'affinity': affinity}
+    elif affinity == 'TEXT' and node['type'] == 'number':
+        text = str(value) if isinstance(value, int) else format_real(value)
+        return {'type': 'single_quote_string', 'value': text, 'affinity': affinity}
+    return dict(node, affinity=affinity)
+
+def apply_affinities(expr, affinities):
+    """
+    Returns a copy of a WHERE expression with every literal compared with a column (by a comparison, BETWEEN or IN)
+    run through coerce_literal, affinities mapping column names to the affinity of their declared type. Done once,
+    before compiling predicates or working out index, rowid and zone map bounds, so they all compare the same values.
+    LIKE patterns are left as they are, only tagged with the affinity of the column they match.
+    """
+    if expr is None:
+        return None
+    elif expr['type'] == 'unary_expr':
+        return dict(expr, expr=apply_affinities(expr['expr'], affinities))
+    elif expr['type'] != 'binary_expr':
+        return expr
+
+    operator_name = expr['operator']
+    left, right = expr['left'], expr['right']
+    if operator_name in ('AND', 'OR'):
+        return dict(expr, left=apply_affinities(left, affinities), right=apply_affinities(right, affinities))
+
+    def affinity_of(node):
+        return affinities.get(node['column']) if node['type'] == 'column_ref' else None
+
+    if operator_name in COMPARISONS:
+        return dict(expr, left=coerce_literal(left, affinity_of(right)), right=coerce_literal(right, affinity_of(left)))
+    elif operator_name.replace('NOT ', '') in ('BETWEEN', 'IN') and affinity_of(left) is not None:
+        # x IN (a, b) compares like x = a OR x = b
+        return dict(expr, right=dict(right, value=[coerce_literal(item, affinity_of(left)) for item in right['value']]))
+    elif operator_name == 'LIKE' and right['type'] == 'single_quote_string':
+        return dict(expr, right=dict(right, affinity=affinity_of(left)))
+    return expr
+
+def apply_collations(expr, collations):
+    """
+    Returns a copy of a WHERE expression in which every comparison, BETWEEN and IN comparing TEXT under a collation
+    other than BINARY is tagged with its name, collations mapping column names to the COLLATE of their declaration
+    (None for BINARY). As in SQLite that's the collation of the left operand when it's a column, else of the right one.
+    """
+    if expr is None:
+        return None
+    elif expr['type'] == 'unary_expr':
+        return dict(expr, expr=apply_collations(expr['expr'], collations))
+    elif expr['type'] != 'binary_expr':
+        return expr
+
+    operator_name = expr['operator']
+    left, right = expr['left'], expr['right']
+    if operator_name in ('AND', 'OR'):
+        return dict(expr, left=apply_collations(left, collations), right=apply_collations(right, collations))
+    elif operator_name not in COMPARISONS and operator_name.replace('NOT ', '') not in ('BETWEEN', 'IN'):
+        return expr
+
+    column = next((node['column'] for node in (left, right) if node['type'] == 'column_ref'), None)
+    collation = collation_name(collations.get(column))
+    return expr if collation is None else dict(expr, collation=collation)
+
+# What a comparison between a column and a literal of another storage class returns: NULL < numbers < TEXT/BLOB
+LITERAL_IS_NUMBER = {'<': False, '<=': False, '>': True, '>=': True}
+LITERAL_IS_TEXT = {'<': True, '<=': True, '>': False, '>=': False}
+
+def compile_predicate(expr, positions):
+    """
+    Compiles a WHERE expression into a function of a row tuple, positions mapping column names to their place in
+    the row. The function returns True, False or None (NULL) following SQL's three valued logic, only rows it
+    returns True for match.
+
+    Literals are encoded once: TEXT literals become bytes compared straight against the page slices rows hold,
+    so matching never decodes text. Comparisons apply_collations tagged fold TEXT by their collation first.
+    """
+    if expr['type'] == 'unary_expr':
+        inner = compile_predicate(expr['expr'], positions)
+        def negation(row):
+            result = inner(row)
+            return None if result is None else not result
+        return negation
+
+    operator_name = expr['operator']
+    if operator_name in ('AND', 'OR'):
+        left, right = compile_predicate(expr['left'], positions), compile_predicate(expr['right'], positions)
+        # the result that settles the expression whatever the other side is
+        deciding = operator_name == 'OR'
+        def connective(row):
+            left_result = left(row)
+            if left_result is deciding:
+                return deciding
+            right_result = right(row)
+            if right_result is deciding:
+                return deciding
+            return None if left_result is None or right_result is None else not deciding
+        return connective
+
+    if operator_name.startswith('NOT '):
+        positive = dict(expr, operator=operator_name[4:])
+        return compile_predicate({'type': 'unary_expr', 'operator': 'NOT', 'expr': positive}, positions)
+
+    left, right = expr['left'], expr['right']
+    if operator_name in FLIPPED_COMPARISONS and left['type'] != 'column_ref' and right['type'] == 'column_ref':
+        # 5 < age is age > 5
+        left, right, operator_name = right, left, FLIPPED_COMPARISONS[operator_name]
+
+    if operator_name in ('IS', 'IS NOT'):
+        value_of = compile_operand(left, positions)
+        if operator_name == 'IS':
+            return lambda row: value_of(row) is None
+        return lambda row: value_of(row) is not None
+    elif operator_name == 'BETWEEN':
+        low, high = right['value']
+        return compile_predicate({
+            'type': 'binary_expr', 'operator': 'AND',
+            'left': dict(expr, operator='>=', left=left, right=low),
+            'right': dict(expr, operator='<=', left=left, right=high),
+        }, positions)
+
+    collation = expr.get('collation')
+    if operator_name == 'IN':
+        return compile_in(left, right['value'], positions, collation)
+    elif operator_name == 'LIKE':
+        return compile_like(left, right, positions)
+    elif left['type'] == 'column_ref' and right['type'] in ('number', 'single_quote_string', 'null') and collation is None:
+        return compile_column_comparison(positions[left['column']], operator_name, literal_value(right))
+
+    left_value, right_value = compile_operand(left, positions, collation), compile_operand(right, positions, collation)
+    compare = COMPARISONS[operator_name]
+    def comparison(row):
+        value, other = left_value(row), right_value(row)
+        if value is None or other is None:
+            return None
+        return compare(sort_key(value), sort_key(other))
+    return comparison
+
+def compile_operand(node, positions, collation=None):
+    if node['type'] == 'column_ref':
+        value_of = operator.itemgetter(positions[node['column']])
+        if collation is None:
+            return value_of
+        return lambda row: collate(value_of(row), collation)
+    value = collate(literal_value(node), collation)
+    return lambda row: value
+
+def compile_column_comparison(position, operator_name, literal):
+    """
+    A column compared with a literal, specialized on the operator and on the literal's storage class.
+    """
+    if literal is None:
+        return lambda row: None # comparing with NULL is always NULL
+
+    if operator_name in ('=', '==', '!=', '<>'):
+        # values of different storage classes are never equal and == says so without converting them: a page slice
+        # equals a bytes literal holding the same bytes, and never an int
+        equal = operator_name in ('=', '==')
+        def equality(row):
+            value = row[position]
+            if value is None:
+                return None
+            return (value == literal) is equal
+        return equality
+
+    compare = COMPARISONS[operator_name]
+    if isinstance(literal, bytes):
+        number_result = LITERAL_IS_TEXT[operator_name]
+        def text_comparison(row):
+            value = row[position]
+            if value is None:
+                return None
+            if isinstance(value, (int, float)):
+                return number_result
+            return compare(bytes(value), literal)
+        return text_comparison
+
+    text_result = LITERAL_IS_NUMBER[operator_name]
+    def number_comparison(row):
+        value = row[position]
+        if value is None:
+            return None
+        if isinstance(value, (int, float)):
+            return compare(value, literal)
+        return text_result
+    return number_comparison
+
+def compile_in(left, items, positions, collation=None):
+    value_of = compile_operand(left, positions, collation)
+    if any(item['type'] == 'column_ref' for item in items) or collation is not None:
+        # folded TEXT is bytes, which the set lookup below would never find page slices in either
+        others = [compile_operand(item, positions, collation) for item in items]
+        def membership(row):
+            value = value_of(row)
+            if value is None:
+                return None
+            other_values = [other(row) for other in others]
+            if any(other is not None and sort_key(other) == sort_key(value) for other in other_values):
+                return True
+            return None if None in other_values else False
+        return membership
+
+    # page slices hash and compare like the bytes they hold, so a set lookup matches TEXT without copying it
+    literals = {literal_value(item) for item in items}
+    has_null = None in literals
+    def literal_membership(row):
+        value = value_of(row)
+        if value is None:
+            return None
+        if value in literals:
+            return True
+        return None if has_null else False
+    return literal_membership
+
+def compile_like(left, right, positions):
+    value_of = compile_operand(left, positions)
+    if right['type'] == 'null':
+        return lambda row: None
+    pattern = like_pattern(str(right['value']))
+    def like(row):
+        value = value_of(row)
+        if value is None:
+            return None
+        text = str(value) if isinstance(value, (int, float)) else str(materialize(value), "utf-8")
+        return pattern.fullmatch(text) is not None
+    return like
+
+def filter_rows(table_rows, where, row_layout):
+    if not where:
+        yield from table_rows
+        return
+
+    predicate = compile_predicate(where, {column: position for position, column in enumerate(row_layout.columns)})
+    for row in table_rows:
+        if predicate(row) is True:
+            yield row
+
+def get_required_bytes(where):
+    """
+    Byte strings a record has to contain to match where: for every column = 'text' predicate AND-ed at the top
+    level, a tuple of the encoded literal (or of each one for IN lists), at least one of which must appear.
+
+    Only columns of TEXT affinity count, with literals apply_affinities left as TEXT: the other affinities let a
+    TEXT literal match values stored as numbers, whose record bytes look nothing like it. Neither do comparisons
+    under a collation, which match other spellings of the literal.
+    """
+    def text_literal(node):
+        return node['type'] == 'single_quote_string' and node.get('affinity') == 'TEXT'
+
+    required = []
+    for predicate in get_conjuncts(where):
+        if predicate['type'] != 'binary_expr' or predicate['left']['type'] != 'column_ref' or 'collation' in predicate:
+            continue
+        if predicate['operator'] in ('=', '==') and text_literal(predicate['right']):
+            literals = (literal_value(predicate['right']),)
+        elif predicate['operator'] == 'IN' and all(map(text_literal, predicate['right']['value'])):
+            literals = tuple(literal_value(item) for item in predicate['right']['value'])
+        else:
+            continue
+        if all(literals):
+            required.append(literals)
+    return required
+
+def has_required_bytes(page, cell_pointer, required_bytes, max_local):
+    """
+    Whether a table leaf cell holds the byte strings get_required_bytes lists. Cells running onto overflow pages
+    aren't searched and always might.
+    """
+    payload_size, _ = parse_varint(page, cell_pointer)
+    if payload_size > max_local:
+        return True
+    # the payload follows two varints of at most 9 bytes each, reading a little past it can't cause a miss
+    cell = bytes(page[cell_pointer:cell_pointer + 18 + payload_size])
+    return all(any(literal in cell for literal in literals) for literals in required_bytes)
+
+def get_filtered_table_rows(pager, cells, row_layout, where):
+    """
+    Decodes the table leaf cells matching where into rows laid out by row_layout. The columns where reads are
+    decoded and checked first, the rest of a record is only decoded once it matches.
+
+    Before that, records are searched for the encoded bytes of the TEXT literals they must equal, which rules out
+    most rows of selective scans without parsing their record header at all.
+    """
+    if not where:
+        yield from get_table_rows(pager, cells, row_layout)
+        return
+
+    filter_layout = row_layout.subset(get_where_columns(where))
+    predicate = compile_predicate(where, {column: position for position, column in enumerate(filter_layout.columns)})
+    decode_filter_columns = filter_layout.decode
+    decode = None if filter_layout == row_layout else row_layout.decode
+    stats = current_stats.get()
+    if stats is not None:
+        decode_filter_columns = stats.counting_records(decode_filter_columns)
+        decode = decode and stats.counting_records(decode)
+    required_bytes = get_required_bytes(where)
+    max_local = table_leaf_max_local(pager.usable_size)
+
+    for page, cell_pointer in cells:
+        if required_bytes and not has_required_bytes(page, cell_pointer, required_bytes, max_local):
+            continue
+
+        rowid, (buffer, offset, overflow) = read_table_cell(pager, page, cell_pointer)
+        filter_row = decode_filter_columns(buffer, offset, rowid, overflow)
+        if predicate(filter_row) is True:
+            yield filter_row if decode is None else decode(buffer, offset, rowid, overflow)
+
+def get_conjuncts(expr):
+    """
+    Splits a WHERE expression into the list of predicates AND-ed together at its top level.
+    """
+    if expr is None:
+        return []
+    if expr['operator'] == 'AND':
+        return get_conjuncts(expr['left']) + get_conjuncts(expr['right'])
+    return [expr]
+
+def get_where_columns(expr):
+    if expr is None:
+        return []
+    elif expr['type'] == 'column_ref':
+        return [expr['column']]
+    elif expr['type'] == 'binary_expr':
+        return get_where_columns(expr['left']) + get_where_columns(expr['right'])
+    elif expr['type'] == 'unary_expr':
+        return get_where_columns(expr['expr'])
+    elif expr['type'] == 'expr_list':
+        return [column for item in expr['value'] for column in get_where_columns(item)]
+    return []
+
+def column_comparison(predicate):
+    """
+    Returns (column, operator, value) for predicates comparing a column with a literal, otherwise None. Comparisons
+    under a collation other than BINARY don't count: index, rowid and zone map bounds all order values byte by byte.
+    """
+    if predicate['type'] != 'binary_expr' or 'collation' in predicate:
+        return None
+    left, right, operator_name = predicate['left'], predicate['right'], predicate['operator']
+    if left['type'] == 'column_ref' and right['type'] in ('number', 'single_quote_string'):
+        return left['column'], operator_name, literal_value(right)
+    if right['type'] == 'column_ref' and left['type'] in ('number', 'single_quote_string') and operator_name in FLIPPED_COMPARISONS:
+        return right['column'], FLIPPED_COMPARISONS[operator_name], literal_value(left)
+    if left['type'] == 'column_ref' and right['type'] == 'expr_list' and operator_name == 'BETWEEN':
+        return left['column'], operator_name, tuple(literal_value(bound) for bound in right['value'])
+    return None
+
+def index_bounds(where, index_columns):
+    """
+    Turns the WHERE predicates on the leading columns of an index into (lower, upper, equal_columns, exact) for
+    scan_index: equality on a prefix of the index columns, optionally followed by a range (<, >, BETWEEN or a
+    LIKE prefix) on the next one. exact is True when the bounds capture the whole WHERE clause, so entries in
+    range don't need to be checked again.
+
+    Returns None when the index can't narrow the scan.
+    """
+    comparisons = [(predicate, column_comparison(predicate)) for predicate in get_conjuncts(where)]
+    comparisons = [(predicate, comparison) for predicate, comparison in comparisons if comparison is not None]
+    used_predicates = []
+
+    equal_values = []
+    for column in index_columns:
+        match = next(((predicate, comparison) for predicate, comparison in comparisons
+                      if comparison[0] == column and comparison[1] in ('=', '==')), None)
+        if match is None:
+            break
+        used_predicates.append(match[0])
+        equal_values.append(match[1][2])
+
+    lower = upper = None
+    exact = True
+    if len(equal_values) < len(index_columns):
+        range_column = index_columns[len(equal_values)]
+        for predicate, (column, operator_name, value) in comparisons:
+            if column != range_column:
+                continue
+            if operator_name in ('>', '>=', 'BETWEEN') and lower is not None or operator_name in ('<', '<=', 'BETWEEN') and upper is not None:
+                exact = False # only the last bound on each side is used, the rest get checked row by row
+            if operator_name in ('>', '>='):
+                lower = (value, operator_name == '>=')
+            elif operator_name in ('<', '<='):
+                upper = (value, operator_name == '<=')
+            elif operator_name == 'BETWEEN':
+                lower, upper = (value[0], True), (value[1], True)
+            elif operator_name == 'LIKE' and isinstance(value, bytes):
+                # Only TEXT columns hold their values as the text LIKE matches: a number like 123 is stored as one
+                # and sorts before every TEXT key, so a prefix range would never reach it
+                if predicate['right'].get('affinity') != 'TEXT':
+                    continue
+                prefix = like_prefix(value.decode())
+                if not prefix or not prefix.isascii():
+                    continue
+                # Every case variant of the prefix sorts between its upper and lower case spellings
+                lower, upper = (prefix.upper().encode(), True), (prefix.lower().encode() + b'\xff', False)
+                exact = False
+            else:
+                continue
+            used_predicates.append(predicate)
+
+    if not equal_values and lower is None and upper is None:
+        return None
+
+    equal_key = tuple(equal_values)
+    if lower is not None:
+        lower_bound = (equal_key + (lower[0],), lower[1])
+    elif upper is not None:
+        lower_bound = (equal_key + (None,), False) # skip NULLs, they sort first
+    else:
+        lower_bound = (equal_key, True)
+
+    if upper is not None:
+        upper_bound = (equal_key + (upper[0],), upper[1])
+    else:
+        upper_bound = (equal_key, True) if equal_key else None
+
+    exact = exact and len(used_predicates) == len(get_conjuncts(where))
+    return lower_bound, upper_bound, len(equal_values), exact
+
+def rowid_bounds(where, rowid_alias):
+    """
+    Turns the WHERE predicates comparing the rowid alias column with numbers into (first_rowid, last_rowid, exact),
+    inclusive integer bounds for read_pages_in_range (None leaves a side open). exact is True when those predicates
+    are the whole WHERE clause.
+
+    Returns None when no predicate narrows the rowid.
+    """
+    first_rowid = last_rowid = None
+    used_predicates = 0
+    for predicate in get_conjuncts(where):
+        comparison = column_comparison(predicate)
+        if comparison is None or comparison[0] != rowid_alias:
+            continue
+        _, operator_name, value = comparison
+        values = value if operator_name == 'BETWEEN' else (value,)
+        if not all(isinstance(bound, (int, float)) for bound in values):
+            continue # rowids are integers, never equal to text
+
+        # rowids are integers, so every bound can be made inclusive by rounding towards the inside of the range
+        low = high = None
+        if operator_name in ('=', '=='):
+            low, high = math.ceil(value), math.floor(value)
+        elif operator_name == '>':
+            low = math.floor(value) + 1
+        elif operator_name == '>=':
+            low = math.ceil(value)
+        elif operator_name == '<':
+            high = math.ceil(value) - 1
+        elif operator_name == '<=':
+            high = math.floor(value)
+        elif operator_name == 'BETWEEN':
+            low, high = math.ceil(value[0]), math.floor(value[1])
+        else:
+            continue
+
+        used_predicates += 1
+        if low is not None:
+            first_rowid = low if first_rowid is None else max(first_rowid, low)
+        if high is not None:
+            last_rowid = high if last_rowid is None else min(last_rowid, high)
+
+    if not used_predicates:
+        return None
+    return first_rowid, last_rowid, used_predicates == len(get_conjuncts(where))
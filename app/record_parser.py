@@ -1,40 +1,155 @@
+import struct
+
 from .varint_parser import parse_varint
 
-def parse_record(stream, column_count):
+# Number of bytes each serial type below 12 takes up in the record body. 10 and 11 are reserved.
+SERIAL_TYPE_WIDTHS = (0, 1, 2, 3, 4, 6, 8, 8, 0, 0, 0, 0)
+
+INT8 = struct.Struct(">b")
+INT16 = struct.Struct(">h")
+INT32 = struct.Struct(">i")
+INT64 = struct.Struct(">q")
+FLOAT64 = struct.Struct(">d")
+
+
+def serial_type_width(serial_type):
+    if serial_type >= 12:
+        # TEXT (odd) and BLOB (even) both encode their length in the serial type
+        return (serial_type - 12) >> 1
+    return SERIAL_TYPE_WIDTHS[serial_type]
+
+
+# Body width of every serial type that fits in a single header byte, TEXT and BLOB values up to 57 bytes included
+SINGLE_BYTE_WIDTHS = tuple(serial_type_width(serial_type) for serial_type in range(0x80))
+
+
+def parse_record(buffer, offset, column_count):
     """
     Parses SQLite's "Record Format" as mentioned here: https://www.sqlite.org/fileformat.html#record_format
+
+    The header and the body are walked together in a single pass. TEXT and BLOB values are returned as
+    slices of the buffer, so a memoryview over a page hands them out without copying; call bytes() on
+    them once a copy is actually needed.
     """
-    initial_position = stream.tell()
-    _number_of_bytes_in_header = parse_varint(stream)
-    body_start = initial_position + _number_of_bytes_in_header
+    header_size, header_offset = parse_varint(buffer, offset)
+    body_offset = header_end = offset + header_size
+
+    values = []
+    for _ in range(column_count):
+        if header_offset >= header_end:
+            # Columns added after this row was written aren't stored in it
+            values.append(None)
+            continue
+
+        serial_type = buffer[header_offset]
+        if serial_type < 0x80:
+            header_offset += 1
+        else:
+            serial_type, header_offset = parse_varint(buffer, header_offset)
+
+        if serial_type >= 12:
+            width = (serial_type - 12) >> 1
+            values.append(buffer[body_offset:body_offset + width])
+        else:
+            width = SERIAL_TYPE_WIDTHS[serial_type]
+            values.append(parse_column_value(buffer, body_offset, serial_type))
+        body_offset += width
 
-    serial_types = [parse_varint(stream) for i in range(column_count)]
-    stream.seek(body_start) # added this because for some reason there is empty space at the end of the header
-    return [parse_column_value(stream, serial_type) for serial_type in serial_types]
+    return values
 
 
-def parse_column_value(stream, serial_type):
-    if (serial_type >= 13) and (serial_type % 2 == 1):
-        # Text encoding
-        n_bytes = (serial_type - 13) // 2
-        result = stream.read(n_bytes)
-        return result
+def parse_column_value(buffer, offset, serial_type):
+    if serial_type >= 12:
+        width = (serial_type - 12) >> 1
+        return buffer[offset:offset + width]
 
     elif serial_type == 0:
         return None
     elif serial_type == 1:
         # 8 bit twos-complement integer
-        return int.from_bytes(stream.read(1), "big")
+        return INT8.unpack_from(buffer, offset)[0]
     elif serial_type == 2:
-        return int.from_bytes(stream.read(2), "big")
+        return INT16.unpack_from(buffer, offset)[0]
     elif serial_type == 3:
-        return int.from_bytes(stream.read(3), "big")
-    elif serial_type ==4:
-        return int.from_bytes(stream.read(4), "big")
+        return int.from_bytes(buffer[offset:offset + 3], "big", signed=True)
+    elif serial_type == 4:
+        return INT32.unpack_from(buffer, offset)[0]
+    elif serial_type == 5:
+        return int.from_bytes(buffer[offset:offset + 6], "big", signed=True)
+    elif serial_type == 6:
+        return INT64.unpack_from(buffer, offset)[0]
+    elif serial_type == 7:
+        return FLOAT64.unpack_from(buffer, offset)[0]
     elif serial_type == 8:
         return int(0)
     elif serial_type == 9:
         return int(1)
     else:
-        # There are more cases to handle, fill this in as you encounter them.
         raise Exception(f"Unhandled serial_type {serial_type}")
+
+
+def parse_record_columns(buffer, offset, column_indexes, overflow=None):
+    """
+    Like parse_record, but only decodes the columns at column_indexes (which must be in ascending order).
+    Every other column is stepped over using the width of its serial type and never materialized.
+
+    When the record spills onto overflow pages, buffer holds its local part and overflow (an OverflowPayload)
+    supplies the columns that don't fit, large TEXT and BLOB values come back as LazyValues.
+    """
+    header_size, header_offset = parse_varint(buffer, offset)
+    if overflow is not None and header_size > overflow.local_size:
+        # The header itself doesn't fit on the page, this takes hundreds of columns so just read the whole record
+        buffer, offset, overflow = overflow.read(0, overflow.size), 0, None
+    body_offset = header_end = offset + header_size
+    if not column_indexes:
+        return []
+
+    serial_types = bytes(buffer[header_offset:min(header_end, header_offset + column_indexes[-1] + 1)])
+    if serial_types.isascii():
+        # Every serial type up to the last wanted column is a single byte, the usual case, so the header is read
+        # as is and the offset of each wanted column is the sum of the widths before it
+        values = []
+        column = 0
+        for wanted_column in column_indexes:
+            if wanted_column >= len(serial_types):
+                values.append(None)  # Columns added after this row was written aren't stored in it
+                continue
+
+            body_offset += sum(map(SINGLE_BYTE_WIDTHS.__getitem__, serial_types[column:wanted_column]))
+            serial_type = serial_types[wanted_column]
+            width = SINGLE_BYTE_WIDTHS[serial_type]
+            if overflow is not None and body_offset + width > overflow.local_size:
+                values.append(overflow.column_value(body_offset, serial_type, width))
+            else:
+                values.append(parse_column_value(buffer, body_offset, serial_type))
+            body_offset += width
+            column = wanted_column + 1
+        return values
+
+    values = []
+    column = 0
+    for wanted_column in column_indexes:
+        while True:
+            if header_offset >= header_end:
+                serial_type = 0  # Columns added after this row was written aren't stored in it
+            else:
+                serial_type = buffer[header_offset]
+                if serial_type < 0x80:
+                    header_offset += 1
+                else:
+                    serial_type, header_offset = parse_varint(buffer, header_offset)
+
+            width = (serial_type - 12) >> 1 if serial_type >= 12 else SERIAL_TYPE_WIDTHS[serial_type]
+            if column == wanted_column:
+                if overflow is not None and body_offset + width > overflow.local_size:
+                    values.append(overflow.column_value(body_offset, serial_type, width))
+                else:
+                    values.append(parse_column_value(buffer, body_offset, serial_type))
+                body_offset += width
+                column += 1
+                break
+
+            body_offset += width
+            column += 1
+
+    return values
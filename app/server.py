@@ -0,0 +1,111 @@
+import io
+import os
+import socketserver
+import stat
+import sys
+import traceback
+from contextlib import redirect_stdout
+
+PROMPT = "sqlite> "
+EXIT_COMMANDS = (".exit", ".quit")
+
+QUOTES = {"'", '"', '`'}
+
+def split_statements(text):
+    """
+    Splits a batch of statements on the semicolons that aren't inside quotes.
+    """
+    statements = []
+    quote = None
+    start = 0
+    for position, char in enumerate(text):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in QUOTES:
+            quote = char
+        elif char == ';':
+            statements.append(text[start:position])
+            start = position + 1
+    statements.append(text[start:])
+    return [statement.strip() for statement in statements if statement.strip()]
+
+def run_batch(execute, text):
+    """
+    Runs every statement in text, a failing statement reports its error and the rest of the batch still runs.
+    Returns False once an exit command is seen.
+    """
+    for statement in split_statements(text):
+        if statement.lower() in EXIT_COMMANDS:
+            return False
+        try:
+            execute(statement)
+        except Exception as error:
+            print(f"Error: {error}")
+            if os.environ.get("SQLITE_DEBUG"):
+                traceback.print_exc()
+    return True
+
+def repl(execute, input_stream=sys.stdin):
+    """
+    Reads statements from input_stream until it ends or .exit, running each line as a batch against the open database.
+    """
+    interactive = input_stream.isatty()
+    while True:
+        if interactive:
+            print(PROMPT, end="", flush=True)
+        line = input_stream.readline()
+        if not line:
+            return
+        if not run_batch(execute, line):
+            return
+        sys.stdout.flush()
+
+class StatementHandler(socketserver.StreamRequestHandler):
+    """
+    Runs each line a client sends as a batch of statements and writes the output back on the same connection.
+    The connection stays open for more batches until the client closes its side.
+    """
+
+    def handle(self):
+        execute = self.server.connect()
+        output = io.TextIOWrapper(self.wfile, encoding="utf-8", write_through=True)
+        with redirect_stdout(output):
+            for line in self.rfile:
+                try:
+                    keep_going = run_batch(execute, line.decode("utf-8"))
+                    output.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                if not keep_going:
+                    break
+        output.detach()
+
+class StatementServer(socketserver.UnixStreamServer):
+    """
+    Connections are served one at a time: their output reaches them through redirect_stdout, which swaps sys.stdout
+    for the whole process, and .stats counts pages by wrapping the get_page of the pager they all share. connect()
+    returns the function each connection runs its statements with.
+    """
+
+    def __init__(self, socket_path, connect):
+        self.connect = connect
+        super().__init__(socket_path, StatementHandler)
+
+def serve(connect, socket_path):
+    """
+    Serves statements on a Unix socket until interrupted, each connection running them with its own function from
+    connect(), e.g. with
+
+        printf 'select count(*) from apples\\n' | nc -UN /tmp/sqlite.sock
+    """
+    if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+        os.unlink(socket_path) # left behind by a server that didn't shut down cleanly
+
+    with StatementServer(socket_path, connect) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(socket_path)
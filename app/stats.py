@@ -0,0 +1,136 @@
+import contextlib
+import contextvars
+import sys
+import time
+from dataclasses import dataclass, field
+
+# B-tree page types by the first byte of their header, anything else a statement reads is an overflow page
+PAGE_TYPES = {2: 'interior index', 5: 'interior table', 10: 'leaf index', 13: 'leaf table'}
+
+# What --stats and --profile turned on, the settings every connection starts from before its own .stats on|off.
+# profile is None when not profiling, a path to dump pstats to or - to print the report on stderr.
+settings = {'stats': False, 'profile': None}
+
+# The QueryStats of the statement running in this context, None (nothing is counted) unless collect_stats set it
+current = contextvars.ContextVar('current_stats', default=None)
+
+@dataclass
+class QueryStats:
+    """
+    What one statement did, gathered by collect_stats.
+    """
+    pages: dict = field(default_factory=dict) # page type -> pages touched, a page counting once per visit
+    cache_hits: int = 0
+    cache_misses: int = 0
+    bytes_read: int = 0
+    records_decoded: int = 0 # table records decoded, those a filter matches twice: for its columns, then whole
+    index_entries_decoded: int = 0
+    rows_emitted: int = 0
+    leaf_pages_skipped: int = 0 # by zone maps
+    plan: list = field(default_factory=list)
+    stages: dict = field(default_factory=dict) # stage -> seconds
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[stage] = self.stages.get(stage, 0.0) + time.perf_counter() - start
+
+    def timed_iteration(self, items, stage, size=None):
+        """
+        Yields items, adding the time spent getting each one to stage and their number (or the sum of size(item))
+        to rows_emitted.
+        """
+        items = iter(items)
+        while True:
+            with self.timed(stage):
+                item = next(items, None)
+            if item is None:
+                return
+            self.rows_emitted += 1 if size is None else size(item)
+            yield item
+
+    def counting_records(self, decode):
+        def counted(*args):
+            self.records_decoded += 1
+            return decode(*args)
+        return counted
+
+    def counting_index_entries(self, read_entry):
+        def counted(*args):
+            self.index_entries_decoded += 1
+            return read_entry(*args)
+        return counted
+
+    def report(self):
+        lines = [f"{stage.capitalize()} time (ms):".ljust(32) + f"{seconds * 1000:.3f}" for stage, seconds in self.stages.items()]
+        for page_type in list(PAGE_TYPES.values()) + ['overflow']:
+            if page_type in self.pages:
+                lines.append(f"Pages touched ({page_type}):".ljust(32) + str(self.pages[page_type]))
+        lines.append("Page cache hits/misses:".ljust(32) + f"{self.cache_hits}/{self.cache_misses}")
+        lines.append("Bytes read from file:".ljust(32) + str(self.bytes_read))
+        lines.append("Table records decoded:".ljust(32) + str(self.records_decoded))
+        lines.append("Index entries decoded:".ljust(32) + str(self.index_entries_decoded))
+        lines.append("Rows emitted:".ljust(32) + str(self.rows_emitted))
+        if self.leaf_pages_skipped:
+            lines.append("Leaf pages skipped (zone map):".ljust(32) + str(self.leaf_pages_skipped))
+        lines.extend(f"Plan: {line}" for line in self.plan)
+        return lines
+
+def record_plan(explain):
+    """
+    Keeps the EXPLAIN QUERY PLAN lines explain() returns when stats are being collected.
+    """
+    stats = current.get()
+    if stats is not None:
+        stats.plan = explain()
+
+@contextlib.contextmanager
+def collect_stats(pager):
+    """
+    Collects the QueryStats of what runs inside the block on pager. Every page read goes through a counting
+    get_page set on the pager for the duration of the block, other statements sharing the pager meanwhile are
+    counted too. Pages of a parallel scan are read by other processes and aren't counted.
+    """
+    stats = QueryStats()
+    token = current.set(stats)
+    hits, misses = pager.hits, pager.misses
+    get_page = pager.get_page
+
+    def counting_get_page(page_number):
+        page = get_page(page_number)
+        page_type = PAGE_TYPES.get(page[100 if page_number == 1 else 0], 'overflow')
+        stats.pages[page_type] = stats.pages.get(page_type, 0) + 1
+        return page
+
+    pager.get_page = counting_get_page
+    try:
+        yield stats
+    finally:
+        del pager.get_page
+        current.reset(token)
+        stats.cache_hits, stats.cache_misses = pager.hits - hits, pager.misses - misses
+        # memory-mapped pagers never read, pages are faulted in by the OS and can't be counted
+        stats.bytes_read = stats.cache_misses * pager.page_size
+
+@contextlib.contextmanager
+def profiling(path):
+    """
+    Runs the block under cProfile, dumping the profile to path or printing the functions that took longest on
+    stderr when path is -.
+    """
+    import cProfile
+    import pstats
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        if path == "-":
+            pstats.Stats(profile, stream=sys.stderr).sort_stats('cumulative').print_stats(20)
+        else:
+            profile.dump_stats(path)
@@ -2,41 +2,33 @@ IS_FIRST_BIT_ZERO_MASK = 0b10000000
 LAST_SEVEN_BITS_MASK = 0b01111111
 
 
-def parse_varint(stream):
+def parse_varint(buffer, offset):
     """
     Parses SQLite's "varint" (short for variable-length integer) as mentioned here: https://www.sqlite.org/fileformat2.html#varint
-    """
-    usable_bytes = read_usable_bytes(stream)
-
-    value = 0
-
-    for index, usable_byte in enumerate(usable_bytes):
-        # For all bytes except the 9th one, the first bit is ignored
-        usable_size = 8 if index == 8 else 7
-
-        shifted = value << usable_size
-        value = shifted + usable_value(usable_size, usable_byte)
-
-    return value
 
+    Decodes from a bytes-like object (e.g. a memoryview over a page) and returns the value along with
+    the offset just past the varint.
+    """
+    byte = buffer[offset]
+    if byte < IS_FIRST_BIT_ZERO_MASK:
+        # Fast path: serial types, header sizes and small rowids nearly always fit in a single byte
+        return byte, offset + 1
 
-def usable_value(usable_size, byte):
-    """Usable_size is either 8 or 7."""
-    return byte if usable_size == 8 else  byte & LAST_SEVEN_BITS_MASK
-
-
-def read_usable_bytes(stream):
-    usable_bytes = []
-
-    for i in range(8):
-        byte = int.from_bytes(stream.read(1), "big")
-        usable_bytes.append(byte)
+    second_byte = buffer[offset + 1]
+    value = (byte & LAST_SEVEN_BITS_MASK) << 7
+    if second_byte < IS_FIRST_BIT_ZERO_MASK:
+        return value | second_byte, offset + 2
 
-        if starts_with_zero(byte):
-            break
+    value |= second_byte & LAST_SEVEN_BITS_MASK
 
-    return usable_bytes
+    for index in range(2, 8):
+        byte = buffer[offset + index]
+        # The first bit only says whether another byte follows
+        value = (value << 7) | (byte & LAST_SEVEN_BITS_MASK)
+        if byte < IS_FIRST_BIT_ZERO_MASK:
+            return value, offset + index + 1
 
+    # All 8 bits of the 9th byte are used, making a 64-bit two's complement value: negative rowids take 9 bytes
+    value = (value << 8) | buffer[offset + 8]
+    return (value - (1 << 64) if value >= 1 << 63 else value), offset + 9
 
-def starts_with_zero(byte):
-    return (byte & IS_FIRST_BIT_ZERO_MASK) == 0
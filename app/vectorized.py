@@ -0,0 +1,398 @@
+import itertools
+import operator
+from array import array
+from dataclasses import dataclass
+
+from .btree import as_real
+from .overflow import read_payload, table_leaf_max_local
+from .predicates import (
+    COMPARISONS,
+    FLIPPED_COMPARISONS,
+    compile_column_comparison,
+    compile_predicate,
+    get_required_bytes,
+    get_where_columns,
+    has_required_bytes,
+    literal_value,
+)
+from .record_parser import SINGLE_BYTE_WIDTHS, parse_column_value
+from .stats import current as current_stats
+from .varint_parser import parse_varint
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # columns and masks stay arrays and lists, which still skips most of the per row work
+
+BATCH_SIZE = 1024 # table rows decoded together, from as many leaf pages as that takes
+FIRST_BATCH_SIZE = 64 # batches start this small and double, so a LIMIT doesn't decode a whole batch for a few rows
+
+# The array typecode of a column holding nothing but values of one of these types
+TYPECODES = {int: 'q', float: 'd'}
+NUMERIC_TYPES = {int, float}
+TEXT_TYPES = {bytes, memoryview}
+# Types == compares and hashes properly, lazy overflow values aren't one of them
+EQUALITY_TYPES = {int, float, bytes, memoryview, type(None)}
+LITERAL_TYPES = ('number', 'single_quote_string', 'null')
+
+def column_vector(values):
+    """
+    Stores one column of a batch, returning it along with the set of the types of its values: an array('q') when
+    they're all INTEGERs, an array('d') when they're all REALs (NumPy arrays when NumPy is installed) and the list
+    of values as they are otherwise.
+    """
+    types = set(map(type, values))
+    typecode = TYPECODES.get(next(iter(types))) if len(types) == 1 else None
+    if typecode is None:
+        return values, types
+    if numpy is not None:
+        return numpy.array(values, dtype=typecode), types
+    return array(typecode, values), types
+
+def values_of(vector):
+    """
+    The values of a vector as Python objects, NumPy arrays hand out NumPy scalars otherwise.
+    """
+    if numpy is not None and isinstance(vector, numpy.ndarray):
+        return vector.tolist()
+    return vector
+
+@dataclass
+class ColumnBatch:
+    """
+    Table rows decoded column by column: vectors holds a column_vector for each column of a RowLayout, types the
+    set of value types of each and every vector is length long.
+    """
+    vectors: list
+    types: list
+    length: int
+
+    def column(self, position):
+        """
+        The vector at position as a list or an array, never a NumPy array.
+        """
+        vector = self.vectors[position]
+        if numpy is not None and isinstance(vector, numpy.ndarray):
+            column = array('q' if vector.dtype.kind == 'i' else 'd')
+            column.frombytes(vector.tobytes())
+            return column
+        return vector
+
+    def rows(self):
+        if not self.vectors:
+            return itertools.repeat((), self.length)
+        return zip(*[values_of(vector) for vector in self.vectors])
+
+    def select(self, mask):
+        """
+        The batch of the rows mask is True for.
+        """
+        flags = mask_flags(mask)
+        length = sum(flags)
+        if length == self.length:
+            return self
+
+        vectors = []
+        for vector in self.vectors:
+            if numpy is not None and isinstance(vector, numpy.ndarray):
+                vectors.append(vector[mask])
+            elif isinstance(vector, array):
+                vectors.append(array(vector.typecode, itertools.compress(vector, flags)))
+            else:
+                vectors.append(list(itertools.compress(vector, flags)))
+        return ColumnBatch(vectors, self.types, length)
+
+    def slice(self, start, stop):
+        stop = min(stop, self.length)
+        return ColumnBatch([vector[start:stop] for vector in self.vectors], self.types, max(stop - start, 0))
+
+def record_plan(serial_types, record_indexes):
+    """
+    Where the columns at record_indexes are in the body of records whose header starts with serial_types (single
+    byte serial types): a (start, end, serial_type) triple per column, serial type 0 (NULL) for columns that aren't
+    stored and None indexes. Records with the same header prefix share a plan.
+    """
+    plan = []
+    for record_index in record_indexes:
+        if record_index is None or record_index >= len(serial_types):
+            plan.append((0, 0, 0)) # Columns added after this row was written aren't stored in it
+            continue
+        start = sum(map(SINGLE_BYTE_WIDTHS.__getitem__, serial_types[:record_index]))
+        serial_type = serial_types[record_index]
+        plan.append((start, start + SINGLE_BYTE_WIDTHS[serial_type], serial_type))
+    return plan
+
+def decode_batch(pager, cells, row_layout):
+    """
+    Decodes table leaf cells into a ColumnBatch laid out by row_layout. Records that fit on their page and whose
+    header is single byte serial types, nearly all of them, are decoded right here through the record_plan of their
+    header, the rest go through row_layout.decode.
+    """
+    record_indexes = list(row_layout.record_indexes)
+    if row_layout.rowid_position is not None:
+        record_indexes[row_layout.rowid_position] = None # stored as NULL, the rowid goes there instead
+    columns = [[] for _ in record_indexes]
+    appends = [column.append for column in columns]
+    serial_types_needed = max([index + 1 for index in record_indexes if index is not None], default=0)
+    max_local = table_leaf_max_local(pager.usable_size)
+    plans = {}
+    rowids = []
+
+    for page, cell_pointer in cells:
+        # the varints in front of the record nearly always fit in one byte
+        payload_size = page[cell_pointer]
+        if payload_size < 0x80:
+            offset = cell_pointer + 1
+        else:
+            payload_size, offset = parse_varint(page, cell_pointer)
+        rowid = page[offset]
+        if rowid < 0x80:
+            offset += 1
+        else:
+            rowid, offset = parse_varint(page, offset)
+        rowids.append(rowid)
+
+        header_size = page[offset]
+        plan = None
+        if payload_size <= max_local and header_size < 0x80:
+            serial_types = bytes(page[offset + 1:offset + min(header_size, serial_types_needed + 1)])
+            plan = plans.get(serial_types)
+            if plan is None and serial_types.isascii():
+                plan = plans[serial_types] = record_plan(serial_types, record_indexes)
+        if plan is None:
+            buffer, record_offset, overflow = read_payload(pager, page, offset, payload_size, max_local)
+            for append, value in zip(appends, row_layout.decode(buffer, record_offset, rowid, overflow)):
+                append(value)
+            continue
+
+        body_offset = offset + header_size
+        for (start, end, serial_type), append in zip(plan, appends):
+            if serial_type >= 12:
+                append(page[body_offset + start:body_offset + end])
+            elif serial_type == 0:
+                append(None)
+            elif serial_type < 7:
+                append(int.from_bytes(page[body_offset + start:body_offset + end], "big", signed=True))
+            else:
+                append(parse_column_value(page, body_offset + start, serial_type))
+
+    if row_layout.rowid_position is not None:
+        columns[row_layout.rowid_position] = rowids
+    for position in row_layout.real_positions:
+        columns[position] = list(map(as_real, columns[position]))
+    stats = current_stats.get()
+    if stats is not None:
+        stats.records_decoded += len(rowids)
+
+    vectors, types = [], []
+    for column in columns:
+        vector, column_types = column_vector(column)
+        vectors.append(vector)
+        types.append(column_types)
+    return ColumnBatch(vectors, types, len(rowids))
+
+def mask_of(flags):
+    """
+    A mask from an iterable of bools: a NumPy bool array when NumPy is installed, a list otherwise.
+    """
+    flags = list(flags)
+    return numpy.array(flags, dtype=bool) if numpy is not None else flags
+
+def mask_flags(mask):
+    return mask.tolist() if numpy is not None and isinstance(mask, numpy.ndarray) else mask
+
+def constant_mask(flag, length):
+    return numpy.full(length, flag) if numpy is not None else [flag] * length
+
+def mask_and(left, right):
+    return left & right if numpy is not None else list(map(operator.and_, left, right))
+
+def mask_or(left, right):
+    return left | right if numpy is not None else list(map(operator.or_, left, right))
+
+def mask_not(mask):
+    return ~mask if numpy is not None else list(map(operator.not_, mask))
+
+def results_masks(results):
+    """
+    The (true, null) masks of a list of True, False or None results.
+    """
+    null = mask_of(map(operator.is_, results, itertools.repeat(None))) if None in results else None
+    return mask_of(map(operator.is_, results, itertools.repeat(True))), null
+
+def null_mask(batch, position):
+    if type(None) not in batch.types[position]:
+        return None
+    return mask_of(map(operator.is_, batch.vectors[position], itertools.repeat(None)))
+
+def or_masks(left, right):
+    """
+    mask_or with None standing for a mask that's False for every row.
+    """
+    if left is None or right is None:
+        return right if left is None else left
+    return mask_or(left, right)
+
+def and_results(left, right):
+    (left_true, left_null), (right_true, right_null) = left, right
+    true = mask_and(left_true, right_true)
+    if left_null is None and right_null is None:
+        return true, None
+    # NULL when one side is NULL and neither is False
+    not_false = mask_and(or_masks(left_true, left_null), or_masks(right_true, right_null))
+    return true, mask_and(not_false, or_masks(left_null, right_null))
+
+def or_results(left, right):
+    (left_true, left_null), (right_true, right_null) = left, right
+    true = mask_or(left_true, right_true)
+    if left_null is None and right_null is None:
+        return true, None
+    # NULL when one side is NULL and neither is True
+    return true, mask_and(or_masks(left_null, right_null), mask_not(true))
+
+def compile_batch_predicate(expr, positions):
+    """
+    compile_predicate for ColumnBatches: the compiled function takes a batch and returns (true, null), the masks of
+    the rows expr is True and NULL for, null being None when it can't be NULL for any of them.
+
+    Comparisons between a column and literals run over the whole column at once, through NumPy for numeric columns
+    when it's installed. Other expressions, and columns holding values of types these can't handle, fall back to
+    compile_predicate on the rows of the batch.
+    """
+    row_predicate = compile_predicate(expr, positions)
+    def row_by_row(batch):
+        return results_masks(list(map(row_predicate, batch.rows())))
+
+    if expr['type'] == 'unary_expr':
+        inner = compile_batch_predicate(expr['expr'], positions)
+        def negation(batch):
+            true, null = inner(batch)
+            false = mask_not(true) if null is None else mask_and(mask_not(true), mask_not(null))
+            return false, null
+        return negation
+
+    operator_name = expr['operator']
+    if operator_name in ('AND', 'OR'):
+        left, right = compile_batch_predicate(expr['left'], positions), compile_batch_predicate(expr['right'], positions)
+        combine = and_results if operator_name == 'AND' else or_results
+        return lambda batch: combine(left(batch), right(batch))
+
+    if operator_name.startswith('NOT '):
+        positive = dict(expr, operator=operator_name[4:])
+        return compile_batch_predicate({'type': 'unary_expr', 'operator': 'NOT', 'expr': positive}, positions)
+
+    left, right = expr['left'], expr['right']
+    if operator_name in FLIPPED_COMPARISONS and left['type'] != 'column_ref' and right['type'] == 'column_ref':
+        left, right, operator_name = right, left, FLIPPED_COMPARISONS[operator_name]
+    if left['type'] != 'column_ref' or 'collation' in expr:
+        return row_by_row
+    position = positions[left['column']]
+
+    if operator_name in ('IS', 'IS NOT'):
+        is_null = operator_name == 'IS'
+        def null_test(batch):
+            null = null_mask(batch, position)
+            if null is None:
+                null = constant_mask(False, batch.length)
+            return null if is_null else mask_not(null), None
+        return null_test
+    elif operator_name == 'BETWEEN':
+        low, high = right['value']
+        return compile_batch_predicate({
+            'type': 'binary_expr', 'operator': 'AND',
+            'left': {'type': 'binary_expr', 'operator': '>=', 'left': left, 'right': low},
+            'right': {'type': 'binary_expr', 'operator': '<=', 'left': left, 'right': high},
+        }, positions)
+    elif operator_name == 'IN' and all(item['type'] in LITERAL_TYPES for item in right['value']):
+        return compile_batch_in(position, {literal_value(item) for item in right['value']}, row_by_row)
+    elif operator_name in COMPARISONS and right['type'] in LITERAL_TYPES:
+        return compile_batch_comparison(position, operator_name, literal_value(right), row_by_row)
+    return row_by_row
+
+def compile_batch_comparison(position, operator_name, literal, fallback):
+    """
+    A column compared with a literal over a whole batch, with the results compile_column_comparison gives row by row.
+    """
+    if literal is None:
+        return lambda batch: (constant_mask(False, batch.length), constant_mask(True, batch.length))
+
+    compare = COMPARISONS[operator_name]
+    equality = operator_name in ('=', '==', '!=', '<>')
+    number_literal = not isinstance(literal, bytes)
+    # NumPy can't hold integers past 64 bits
+    numpy_literal = number_literal and (isinstance(literal, float) or -2**63 <= literal < 2**63)
+    row_comparison = compile_column_comparison(0, operator_name, literal)
+
+    def comparison(batch):
+        vector, types = batch.vectors[position], batch.types[position]
+        if numpy is not None and isinstance(vector, numpy.ndarray) and numpy_literal:
+            return compare(vector, literal), None
+
+        values = values_of(vector)
+        if equality and types <= EQUALITY_TYPES:
+            # as row by row, values of different storage classes are never equal and NULL is never equal to anything
+            equal = mask_of(map(operator.eq, values, itertools.repeat(literal)))
+            null = null_mask(batch, position)
+            if operator_name in ('=', '=='):
+                return equal, null
+            return (mask_not(equal) if null is None else mask_and(mask_not(equal), mask_not(null))), null
+        elif not equality and number_literal and types <= NUMERIC_TYPES:
+            return mask_of(map(compare, values, itertools.repeat(literal))), None
+        elif not equality and not number_literal and types <= TEXT_TYPES:
+            return mask_of(map(compare, map(bytes, values), itertools.repeat(literal))), None
+        elif types <= EQUALITY_TYPES:
+            return results_masks(list(map(row_comparison, zip(values))))
+        return fallback(batch)
+    return comparison
+
+def compile_batch_in(position, literals, fallback):
+    """
+    A column IN a list of literals over a whole batch, each value looked up in a set.
+    """
+    has_null = None in literals
+    literals = literals - {None}
+
+    def membership(batch):
+        types = batch.types[position]
+        if not types <= EQUALITY_TYPES:
+            return fallback(batch)
+        found = mask_of(map(literals.__contains__, values_of(batch.vectors[position])))
+        # a value that isn't in the list is NULL rather than False when the list holds a NULL
+        null = mask_not(found) if has_null else null_mask(batch, position)
+        return found, null
+    return membership
+
+def read_batches(pager, cells, row_layout, where):
+    """
+    get_filtered_table_rows in batches: cells are decoded FIRST_BATCH_SIZE, then up to BATCH_SIZE at a time into
+    ColumnBatches of the rows matching where. The columns where reads are decoded and checked for the whole batch
+    first, the others only for the cells that matched.
+    """
+    if where:
+        filter_layout = row_layout.subset(get_where_columns(where))
+        predicate = compile_batch_predicate(where, {column: position for position, column in enumerate(filter_layout.columns)})
+        required_bytes = get_required_bytes(where)
+        max_local = table_leaf_max_local(pager.usable_size)
+
+    cells = iter(cells)
+    batch_size = FIRST_BATCH_SIZE
+    while True:
+        chunk = list(itertools.islice(cells, batch_size))
+        if not chunk:
+            return
+        batch_size = min(batch_size * 2, BATCH_SIZE)
+
+        if not where:
+            yield decode_batch(pager, chunk, row_layout)
+            continue
+
+        if required_bytes:
+            chunk = [(page, cell_pointer) for page, cell_pointer in chunk if has_required_bytes(page, cell_pointer, required_bytes, max_local)]
+        filter_batch = decode_batch(pager, chunk, filter_layout)
+        matches, _ = predicate(filter_batch)
+        if filter_layout == row_layout:
+            batch = filter_batch.select(matches)
+        else:
+            batch = decode_batch(pager, list(itertools.compress(chunk, mask_flags(matches))), row_layout)
+        if batch.length:
+            yield batch
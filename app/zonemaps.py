@@ -0,0 +1,285 @@
+import hashlib
+import os
+import struct
+from dataclasses import dataclass
+
+from .btree import RowLayout, get_leaf_pages, read_cell_pointers, read_page, read_table_cell, sort_key
+from .catalog import FILE_CHANGE_COUNTER_OFFSET, load_catalog
+from .overflow import materialize
+from .predicates import column_comparison, get_conjuncts, literal_value
+from .stats import current as current_stats
+
+ZONE_MAP_SUFFIX = "-zonemap" # the sidecar file sits next to the database, like SQLite's -journal and -wal files
+ZONE_MAP_MAGIC = b"SQLZ"
+ZONE_MAP_VERSION = 1
+BLOOM_BITS_PER_VALUE = 10 # with BLOOM_HASHES, about 1% of the values a leaf doesn't hold get through its filter
+BLOOM_HASHES = 4
+MIN_BLOOM_BITS = 64
+
+# The sidecar file, every number little-endian:
+#   header:  b"SQLZ", version (u8), file change counter (u32) of the database it was built from, table count (u32)
+#   table:   name, leaf page count (u32), the leaf page numbers (u32 each) in rowid order, column count (u16)
+#   column:  name, then for every leaf: its smallest and largest non-NULL values and its Bloom filter (u16 length)
+#   name:    u16 length and UTF-8
+#   value:   a tag (u8): 0 NULL (the leaf has no values), 1 an int64, 2 a float64, 3 a u32 length and bytes
+NULL_TAG, INTEGER_TAG, REAL_TAG, BYTES_TAG = range(4)
+
+@dataclass
+class ColumnZones:
+    """
+    For every leaf page of a table, the smallest and largest non-NULL values of a column (None when the leaf has
+    none) in SQLite's order and a Bloom filter of its values.
+    """
+    minimums: list
+    maximums: list
+    blooms: list
+
+@dataclass
+class TableZoneMap:
+    """
+    The zone maps of some columns of a table, built from its leaf pages when the database had change_counter.
+    """
+    table: str
+    change_counter: int
+    leaf_pages: list
+    columns: dict # column -> ColumnZones
+
+def zone_map_path(pager):
+    return pager.database_path + ZONE_MAP_SUFFIX
+
+def change_counter(pager):
+    return int.from_bytes(pager.read_database_header()[FILE_CHANGE_COUNTER_OFFSET:FILE_CHANGE_COUNTER_OFFSET + 4], "big")
+
+def bloom_key(value):
+    """
+    The bytes a value is hashed as. Values SQLite considers equal hash the same: an INTEGER and a REAL holding the
+    same number, a TEXT and a BLOB holding the same bytes.
+    """
+    if isinstance(value, int) or (isinstance(value, float) and value.is_integer()):
+        return b"N%d" % value
+    elif isinstance(value, float):
+        return b"F" + value.hex().encode()
+    return b"T" + value
+
+def bloom_positions(key, bits):
+    # double hashing: the i-th position is h1 + i * h2, from one stable (unlike hash()) 128 bit digest
+    digest = hashlib.blake2b(key, digest_size=16).digest()
+    h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+    return [(h1 + i * h2) % bits for i in range(BLOOM_HASHES)]
+
+def build_bloom(values):
+    bits = max(MIN_BLOOM_BITS, len(values) * BLOOM_BITS_PER_VALUE)
+    bits += -bits % 8
+    bloom = bytearray(bits // 8)
+    for value in values:
+        for position in bloom_positions(bloom_key(value), bits):
+            bloom[position >> 3] |= 1 << (position & 7)
+    return bytes(bloom)
+
+def bloom_may_contain(bloom, value):
+    return all(bloom[position >> 3] >> (position & 7) & 1 for position in bloom_positions(bloom_key(value), len(bloom) * 8))
+
+def build_table_zone_map(pager, table, columns):
+    """
+    Reads every leaf page of table once, decoding just columns, into a TableZoneMap.
+    """
+    row_layout = RowLayout.for_columns(table.columns, columns, table.rowid_alias, table.real_columns)
+    leaf_pages = get_leaf_pages(pager, table.rootpage)
+    zones = {column: ColumnZones([], [], []) for column in row_layout.columns}
+    for page_number in leaf_pages:
+        page, page_header = read_page(pager, page_number)
+        rows = []
+        for cell_pointer in read_cell_pointers(page, page_header):
+            rowid, (buffer, offset, overflow) = read_table_cell(pager, page, cell_pointer)
+            rows.append(row_layout.decode(buffer, offset, rowid, overflow))
+        for column, values in zip(row_layout.columns, zip(*rows) if rows else [()] * len(row_layout.columns)):
+            values = {materialize(value) for value in values if value is not None}
+            zones[column].minimums.append(min(values, key=sort_key, default=None))
+            zones[column].maximums.append(max(values, key=sort_key, default=None))
+            zones[column].blooms.append(build_bloom(values))
+    return TableZoneMap(table.name, change_counter(pager), leaf_pages, zones)
+
+def leaf_can_match(zones, leaf, operator_name, literal):
+    """
+    Whether a row of leaf could satisfy the column compared with literal through operator_name, False only when
+    none can. Comparisons order values the way sort_key does, so the leaf's minimum and maximum bound them.
+    """
+    minimum, maximum = zones.minimums[leaf], zones.maximums[leaf]
+    if minimum is None or literal is None:
+        return False # only NULLs, or comparing with NULL: never true
+    if operator_name == 'IN':
+        return any(leaf_can_match(zones, leaf, '=', item) for item in literal)
+    if operator_name == 'BETWEEN':
+        low, high = literal
+        return low is not None and high is not None and sort_key(maximum) >= sort_key(low) and sort_key(minimum) <= sort_key(high)
+
+    key, low, high = sort_key(literal), sort_key(minimum), sort_key(maximum)
+    if operator_name in ('=', '=='):
+        return low <= key <= high and bloom_may_contain(zones.blooms[leaf], literal)
+    elif operator_name in ('!=', '<>'):
+        return not low == high == key
+    elif operator_name == '<':
+        return low < key
+    elif operator_name == '<=':
+        return low <= key
+    elif operator_name == '>':
+        return high > key
+    elif operator_name == '>=':
+        return high >= key
+    return True
+
+def zone_constraints(where, columns):
+    """
+    (column, operator, literal) for the predicates AND-ed together in where that compare a column of columns with
+    literals. A row must satisfy every one of them to match.
+    """
+    constraints = []
+    for predicate in get_conjuncts(where):
+        comparison = column_comparison(predicate)
+        if predicate['type'] == 'binary_expr' and predicate['operator'] == 'IN' and 'collation' not in predicate and predicate['left']['type'] == 'column_ref' \
+                and predicate['right']['type'] == 'expr_list' and all(item['type'] in ('number', 'single_quote_string', 'null') for item in predicate['right']['value']):
+            comparison = predicate['left']['column'], 'IN', [literal_value(item) for item in predicate['right']['value']]
+        if comparison is not None and comparison[0] in columns:
+            constraints.append(comparison)
+    return constraints
+
+def encode_name(name):
+    data = name.encode()
+    return struct.pack("<H", len(data)) + data
+
+def encode_value(value):
+    if value is None:
+        return bytes([NULL_TAG])
+    elif isinstance(value, int):
+        return struct.pack("<Bq", INTEGER_TAG, value)
+    elif isinstance(value, float):
+        return struct.pack("<Bd", REAL_TAG, value)
+    return struct.pack("<BI", BYTES_TAG, len(value)) + value
+
+def parse_name(data, offset):
+    (length,) = struct.unpack_from("<H", data, offset)
+    return data[offset + 2:offset + 2 + length].decode(), offset + 2 + length
+
+def parse_value(data, offset):
+    tag = data[offset]
+    if tag == NULL_TAG:
+        return None, offset + 1
+    elif tag == INTEGER_TAG:
+        return struct.unpack_from("<q", data, offset + 1)[0], offset + 9
+    elif tag == REAL_TAG:
+        return struct.unpack_from("<d", data, offset + 1)[0], offset + 9
+    (length,) = struct.unpack_from("<I", data, offset + 1)
+    return bytes(data[offset + 5:offset + 5 + length]), offset + 5 + length
+
+def encode_zone_maps(counter, zone_maps):
+    parts = [ZONE_MAP_MAGIC, struct.pack("<BII", ZONE_MAP_VERSION, counter, len(zone_maps))]
+    for zone_map in zone_maps.values():
+        parts.append(encode_name(zone_map.table))
+        parts.append(struct.pack(f"<I{len(zone_map.leaf_pages)}I", len(zone_map.leaf_pages), *zone_map.leaf_pages))
+        parts.append(struct.pack("<H", len(zone_map.columns)))
+        for column, zones in zone_map.columns.items():
+            parts.append(encode_name(column))
+            for minimum, maximum, bloom in zip(zones.minimums, zones.maximums, zones.blooms):
+                parts.extend((encode_value(minimum), encode_value(maximum), struct.pack("<H", len(bloom)), bloom))
+    return b"".join(parts)
+
+def parse_zone_maps(data):
+    """
+    The change counter and the TableZoneMaps (by lower case table name) of a sidecar file.
+    """
+    if data[:4] != ZONE_MAP_MAGIC or data[4] != ZONE_MAP_VERSION:
+        raise Exception("not a zone map file, or one of another version")
+    counter, table_count = struct.unpack_from("<II", data, 5)
+    offset = 13
+    zone_maps = {}
+    for _ in range(table_count):
+        table, offset = parse_name(data, offset)
+        (leaf_count,) = struct.unpack_from("<I", data, offset)
+        leaf_pages = list(struct.unpack_from(f"<{leaf_count}I", data, offset + 4))
+        (column_count,) = struct.unpack_from("<H", data, offset + 4 + 4 * leaf_count)
+        offset += 6 + 4 * leaf_count
+        columns = {}
+        for _ in range(column_count):
+            column, offset = parse_name(data, offset)
+            zones = columns[column] = ColumnZones([], [], [])
+            for _ in range(leaf_count):
+                minimum, offset = parse_value(data, offset)
+                maximum, offset = parse_value(data, offset)
+                (bloom_size,) = struct.unpack_from("<H", data, offset)
+                zones.minimums.append(minimum)
+                zones.maximums.append(maximum)
+                zones.blooms.append(bytes(data[offset + 2:offset + 2 + bloom_size]))
+                offset += 2 + bloom_size
+        zone_maps[table.lower()] = TableZoneMap(table, counter, leaf_pages, columns)
+    return counter, zone_maps
+
+def save_zone_maps(pager, zone_maps):
+    # written aside and renamed over the old file, so readers never see half of one
+    path = zone_map_path(pager)
+    with open(path + ".tmp", "wb") as sidecar:
+        sidecar.write(encode_zone_maps(change_counter(pager), zone_maps))
+    os.replace(path + ".tmp", path)
+
+def get_zone_maps(pager):
+    """
+    The TableZoneMaps of the database behind pager, kept on its catalog. A sidecar file built before the database
+    last changed is rebuilt, for the same tables and columns, and written again.
+    """
+    catalog = load_catalog(pager)
+    if catalog.zone_maps is not None:
+        return catalog.zone_maps
+
+    try:
+        with open(zone_map_path(pager), "rb") as sidecar:
+            counter, zone_maps = parse_zone_maps(sidecar.read())
+    except FileNotFoundError:
+        counter, zone_maps = None, {}
+
+    if zone_maps and counter != change_counter(pager):
+        stale = zone_maps
+        zone_maps = {}
+        for name, zone_map in stale.items():
+            table = catalog.tables.get(name)
+            if table is not None and not table.without_rowid:
+                zone_maps[name] = build_table_zone_map(pager, table, [column for column in zone_map.columns if column in table.columns])
+        try:
+            save_zone_maps(pager, zone_maps)
+        except OSError:
+            pass # a read-only directory, the rebuilt zone maps last as long as the catalog
+    catalog.zone_maps = zone_maps
+    return zone_maps
+
+def add_zone_map(pager, table_name, columns):
+    """
+    Builds the zone maps of columns of a table, replacing any it had, and saves them to the sidecar file.
+    """
+    catalog = load_catalog(pager)
+    table = catalog.get_table(table_name)
+    for column in columns:
+        if column not in table.columns:
+            raise Exception(f"no such column: {column}")
+    zone_maps = dict(get_zone_maps(pager))
+    zone_maps[table.name.lower()] = build_table_zone_map(pager, table, columns)
+    save_zone_maps(pager, zone_maps)
+    catalog.zone_maps = zone_maps
+
+def matching_leaf_pages(pager, table, where):
+    """
+    The leaf pages of table that can hold rows matching where, in rowid order, or None when no zone map of the
+    table rules out any leaf.
+    """
+    if not where:
+        return None
+    zone_map = get_zone_maps(pager).get(table.name.lower())
+    if zone_map is None:
+        return None
+    constraints = zone_constraints(where, zone_map.columns)
+    if not constraints:
+        return None
+
+    leaf_pages = [page_number for leaf, page_number in enumerate(zone_map.leaf_pages)
+                  if all(leaf_can_match(zone_map.columns[column], leaf, operator_name, literal) for column, operator_name, literal in constraints)]
+    stats = current_stats.get()
+    if stats is not None:
+        stats.leaf_pages_skipped += len(zone_map.leaf_pages) - len(leaf_pages)
+    return leaf_pages
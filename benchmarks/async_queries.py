@@ -0,0 +1,73 @@
+"""
+Measures how long a batch of concurrent statements keeps an asyncio event loop from running anything else.
+
+Usage: python -m benchmarks.async_queries companies.db "select id, name from companies where country = 'chad'" [copies]
+
+"before" runs copies of the statement straight from coroutines through query_rows in app/main.py, which is how an
+event loop had to embed the engine before: every page read blocks the loop. "after" runs them concurrently through
+Database from app/database.py. A ticker coroutine records the longest stretch the loop went without running it.
+Both start from a cold page cache.
+"""
+import asyncio
+import sys
+import time
+
+from app.database import Database
+from app.main import query_rows
+from app.overflow import materialize
+from app.pager import Pager
+
+TICK_SECONDS = 0.001
+
+
+async def longest_stall(statements):
+    """
+    Runs the statements coroutine alongside a ticker, returning the total and the longest gap between ticks.
+    """
+    stall = 0.0
+    async def ticker():
+        nonlocal stall
+        last = time.perf_counter()
+        while True:
+            await asyncio.sleep(TICK_SECONDS)
+            now = time.perf_counter()
+            stall = max(stall, now - last - TICK_SECONDS)
+            last = now
+
+    ticking = asyncio.create_task(ticker())
+    await asyncio.sleep(0) # let the ticker start
+    start = time.perf_counter()
+    results = await statements
+    total = time.perf_counter() - start
+    await asyncio.sleep(TICK_SECONDS * 2) # a loop blocked until now only gets to the ticker here
+    ticking.cancel()
+    return results, total, stall
+
+
+async def blocking_statements(database_file_path, statement, copies):
+    async def run():
+        return [tuple(materialize(value) for value in row) for row in query_rows(pager, statement)]
+
+    with Pager(database_file_path) as pager:
+        return await asyncio.gather(*[run() for _ in range(copies)])
+
+
+async def database_statements(database_file_path, statement, copies):
+    async def run():
+        return await (await db.execute(statement)).fetchall()
+
+    async with Database(database_file_path) as db:
+        return await asyncio.gather(*[run() for _ in range(copies)])
+
+
+if __name__ == "__main__":
+    database_file_path, statement = sys.argv[1], sys.argv[2]
+    copies = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+
+    before_rows, before, before_stall = asyncio.run(longest_stall(blocking_statements(database_file_path, statement, copies)))
+    after_rows, after, after_stall = asyncio.run(longest_stall(database_statements(database_file_path, statement, copies)))
+    assert before_rows == after_rows
+
+    print(f"statements: {copies}, rows each: {len(after_rows[0])}")
+    print(f"before (blocking reads): {before * 1000:,.1f} ms, longest event loop stall {before_stall * 1000:,.1f} ms")
+    print(f"after (Database):        {after * 1000:,.1f} ms, longest event loop stall {after_stall * 1000:,.1f} ms")
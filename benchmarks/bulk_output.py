@@ -0,0 +1,55 @@
+"""
+Measures how long writing out the result rows of a statement takes, apart from reading them.
+
+Usage: python -m benchmarks.bulk_output companies.db "select * from companies"
+
+The rows are read once up front, then written to /dev/null again and again. "before" is how select_statement used
+to write them: each value formatted into a str, decoding TEXT, and a print() per row. It is only kept here as a
+baseline. "after" is the list mode ResultWriter from app/output.py, formatting bytes and writing 64 KiB at a time.
+The other output modes are timed too.
+"""
+import contextlib
+import os
+import sys
+
+from app.main import query_rows
+from app.output import WRITERS
+from app.pager import Pager
+from benchmarks.suite import best_seconds
+
+
+def format_value(data):
+    datatype = type(data)
+    if datatype in (int, float):
+        return str(data)
+    elif data is None:
+        return ""
+    return str(data, "utf-8")
+
+
+def print_rows(rows):
+    with open(os.devnull, "w") as output, contextlib.redirect_stdout(output):
+        for values in rows:
+            print("|".join(map(format_value, values)))
+
+
+def write_rows(rows, mode):
+    with open(os.devnull, "wb") as output:
+        writer = WRITERS[mode](output)
+        writer.write_rows(rows)
+        writer.close()
+
+
+if __name__ == "__main__":
+    database_file_path, statement = sys.argv[1], sys.argv[2]
+
+    with Pager(database_file_path, cache_size=1 << 30) as pager:
+        rows = list(query_rows(pager, statement))
+        before, _ = best_seconds(lambda: print_rows(rows))
+        after = {mode: best_seconds(lambda: write_rows(rows, mode))[0] for mode in WRITERS}
+
+    print(f"rows: {len(rows):,}")
+    print(f"before (print per row): {before * 1000:,.1f} ms")
+    for mode, seconds in after.items():
+        print(f"after ({mode}): {seconds * 1000:,.1f} ms")
+    print(f"speedup (list): {before / after['list']:.1f}x")
@@ -0,0 +1,52 @@
+"""
+Measures index lookups whose index holds every column they read, with and without going to the table.
+
+Usage: python -m benchmarks.covering_index companies.db "select country, id from companies where country = 'chad'"
+
+"before" is the plan as the planner made it before covering indexes were recognised: every index entry is followed
+by a lookup of its row in the table B-tree. "after" is the index-only plan plan_query picks now, which builds the
+rows from the index entries alone. Each run starts from a fresh Pager, so pages come from the file (and the OS
+cache) rather than the page cache, which is what a one-off lookup pays. Pages read are reported along with times.
+"""
+import sys
+
+from app.btree import RowLayout
+from app.catalog import load_catalog
+from app.main import get_selected_columns, read_table_rows
+from app.pager import Pager
+from app.planner import plan_query
+from app.predicates import get_where_columns
+from benchmarks.suite import best_seconds
+from sql_parser import parse
+
+
+def plan_statement(database_file_path, statement, covering):
+    sql_ast = parse(statement)
+    with Pager(database_file_path) as pager:
+        table = load_catalog(pager).get_table(sql_ast["from"][0]["table"])
+        _, selected_columns = get_selected_columns(sql_ast, table.columns)
+        row_layout = RowLayout.for_columns(table.columns, selected_columns + get_where_columns(sql_ast["where"]), table.rowid_alias, table.real_columns)
+        plan = plan_query(pager, load_catalog(pager), table, sql_ast["where"], None,
+                          needed_columns=row_layout.columns if covering else None)
+    return plan, row_layout, sql_ast["where"]
+
+
+def run_plan(database_file_path, plan, row_layout, where):
+    with Pager(database_file_path) as pager:
+        rows = list(read_table_rows(pager, plan, row_layout, where))
+        return rows, pager.misses
+
+
+if __name__ == "__main__":
+    database_file_path, statement = sys.argv[1], sys.argv[2]
+
+    before_plan = plan_statement(database_file_path, statement, covering=False)
+    after_plan = plan_statement(database_file_path, statement, covering=True)
+    before, (before_rows, before_pages) = best_seconds(lambda: run_plan(database_file_path, *before_plan))
+    after, (after_rows, after_pages) = best_seconds(lambda: run_plan(database_file_path, *after_plan))
+    assert sorted(before_rows) == sorted(after_rows)
+
+    print(f"rows: {len(after_rows):,}")
+    print(f"before ({before_plan[0].describe()}): {before * 1000:,.2f} ms, {before_pages} pages read")
+    print(f"after ({after_plan[0].describe()}): {after * 1000:,.2f} ms, {after_pages} pages read")
+    print(f"speedup: {before / after:.1f}x")
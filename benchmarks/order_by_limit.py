@@ -0,0 +1,92 @@
+"""
+Measures how long ORDER BY ... LIMIT statements take to return their rows.
+
+Usage: python -m benchmarks.order_by_limit companies.db "select id, name from companies order by name limit 10"
+
+"before" reads every row of the table, sorts them all with sort_rows and only then skips to the rows LIMIT and OFFSET
+keep, which is what ORDER BY cost before plans walked B-trees in order and top_rows kept only the best rows. It is
+only kept here as a baseline. "after" is select_statement from app/main.py, with its output thrown away.
+
+When no B-tree order serves the statement, decoding every row takes most of the time either way, so the ordering
+step is also timed on its own, on rows decoded up front: sorting them all, the heapq heap top_rows used to keep and
+top_rows as it is now, sorting a chunk at a time with the best rows so far.
+"""
+import contextlib
+import heapq
+import io
+import itertools
+import sys
+
+from app.btree import RowLayout, read_pages, sort_key
+from app.catalog import load_catalog
+from app.main import get_selected_columns, limit_range, project_rows, select_statement, sort_rows, top_rows
+from app.pager import Pager
+from app.predicates import get_filtered_table_rows, get_where_columns
+from benchmarks.suite import best_seconds
+from sql_parser import parse
+
+
+def read_rows(pager, statement):
+    """
+    The rows of the table matching the statement's WHERE clause, in rowid order, along with the positions of the
+    ORDER BY and output columns in them.
+    """
+    sql_ast = parse(statement)
+    table = load_catalog(pager).get_table(sql_ast["from"][0]["table"])
+    _, selected_columns = get_selected_columns(sql_ast, table.columns)
+    orderby_columns = [term['expr']['column'] for term in sql_ast["orderby"]]
+    row_layout = RowLayout.for_columns(table.columns, selected_columns + get_where_columns(sql_ast["where"]) + orderby_columns, table.rowid_alias, table.real_columns)
+    table_rows = get_filtered_table_rows(pager, read_pages(pager, table.rootpage), row_layout, sql_ast["where"])
+    return table_rows, [row_layout.columns.index(column) for column in orderby_columns], [row_layout.columns.index(column) for column in selected_columns]
+
+
+def sort_everything(pager, statement):
+    sql_ast = parse(statement)
+    table_rows, orderby_positions, output_positions = read_rows(pager, statement)
+    offset, stop = limit_range(sql_ast["limit"])
+    table_rows = itertools.islice(sort_rows(table_rows, sql_ast["orderby"], orderby_positions), offset, stop)
+    return list(project_rows(table_rows, output_positions))
+
+
+def heap_rows(table_rows, orderby, positions, count):
+    """
+    top_rows as it was first written, keeping the best rows in a heapq heap. Only single direction ORDER BY clauses
+    went through it.
+    """
+    def key(row):
+        return [sort_key(row[position]) for position in positions]
+    select = heapq.nsmallest if orderby[0]['type'] == 'ASC' else heapq.nlargest
+    return select(count, table_rows, key=key)
+
+
+def run_statement(pager, statement):
+    with contextlib.redirect_stdout(io.StringIO()):
+        select_statement(pager, statement)
+
+
+if __name__ == "__main__":
+    database_file_path, statement = sys.argv[1], sys.argv[2]
+
+    with Pager(database_file_path, cache_size=1 << 30) as pager:
+        run_statement(pager, statement) # warms the page cache and the planner's statistics for both sides
+        before, _ = best_seconds(lambda: sort_everything(pager, statement))
+        after, _ = best_seconds(lambda: run_statement(pager, statement))
+
+        sql_ast = parse(statement)
+        orderby, (offset, stop) = sql_ast["orderby"], limit_range(sql_ast["limit"])
+        table_rows, orderby_positions, _ = read_rows(pager, statement)
+        table_rows = list(table_rows)
+        ordering = {
+            "sort every row": lambda: sort_rows(table_rows, orderby, orderby_positions)[:stop],
+            "top_rows": lambda: top_rows(table_rows, orderby, orderby_positions, stop),
+        }
+        if len({term['type'] for term in orderby}) == 1:
+            ordering["heapq heap"] = lambda: heap_rows(table_rows, orderby, orderby_positions, stop)
+        ordering_seconds = {name: best_seconds(run)[0] for name, run in ordering.items()}
+
+    print(f"before (sort every row): {before * 1000:,.1f} ms")
+    print(f"after (ordered walk or top_rows): {after * 1000:,.1f} ms")
+    print(f"speedup: {before / after:.1f}x")
+    print(f"ordering {len(table_rows):,} decoded rows:")
+    for name, seconds in ordering_seconds.items():
+        print(f"  {name}: {seconds * 1000:,.1f} ms")
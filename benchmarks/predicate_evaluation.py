@@ -0,0 +1,72 @@
+"""
+Measures how many table rows per second a filtered full table scan gets through.
+
+Usage: python -m benchmarks.predicate_evaluation companies.db "select id, name, domain from companies where country = 'chad'"
+
+The baseline only understands AND, OR and plain comparisons, so the WHERE clause has to stick to those.
+
+"before" decodes every selected column of every row and walks the WHERE AST for each one, comparing
+materialized values through sort_key, kept here only as a baseline. "after" is get_filtered_table_rows
+from app/predicates.py: the WHERE clause is compiled into closures once and only the columns it reads are
+decoded until a row matches.
+"""
+import sys
+
+from app.btree import RowLayout, get_table_rows, read_pages, sort_key
+from app.catalog import load_catalog
+from app.main import get_selected_columns
+from app.pager import Pager
+from app.predicates import COMPARISONS, get_filtered_table_rows, get_where_columns, literal_value
+from benchmarks.suite import best_seconds
+from sql_parser import parse
+
+
+def evaluate(expr, row, positions):
+    operator_name = expr['operator']
+    if operator_name == 'AND':
+        return evaluate(expr['left'], row, positions) and evaluate(expr['right'], row, positions)
+    elif operator_name == 'OR':
+        return evaluate(expr['left'], row, positions) or evaluate(expr['right'], row, positions)
+
+    def operand_value(node):
+        return row[positions[node['column']]] if node['type'] == 'column_ref' else literal_value(node)
+
+    value, other = operand_value(expr['left']), operand_value(expr['right'])
+    if value is None or other is None:
+        return False
+    return COMPARISONS[operator_name](sort_key(value), sort_key(other))
+
+
+def scan_with_evaluate(pager, rootpage, row_layout, where):
+    positions = {column: position for position, column in enumerate(row_layout.columns)}
+    return sum(1 for row in get_table_rows(pager, read_pages(pager, rootpage), row_layout) if evaluate(where, row, positions))
+
+
+def scan_with_compiled_predicate(pager, rootpage, row_layout, where):
+    return sum(1 for _ in get_filtered_table_rows(pager, read_pages(pager, rootpage), row_layout, where))
+
+
+def rows_per_second(scan, pager, table, table_rows, row_layout, where, repeat=3):
+    best, matches = best_seconds(lambda: scan(pager, table.rootpage, row_layout, where), repeat)
+    return matches, table_rows / best
+
+
+if __name__ == "__main__":
+    database_file_path, statement = sys.argv[1], sys.argv[2]
+    sql_ast = parse(statement)
+
+    with Pager(database_file_path, cache_size=1 << 30) as pager:
+        table = load_catalog(pager).get_table(sql_ast["from"][0]["table"])
+        _, selected_columns = get_selected_columns(sql_ast, table.columns)
+        where = sql_ast["where"]
+        row_layout = RowLayout.for_columns(table.columns, selected_columns + get_where_columns(where), table.rowid_alias, table.real_columns)
+        table_rows = sum(1 for _ in read_pages(pager, table.rootpage))
+
+        before_matches, before = rows_per_second(scan_with_evaluate, pager, table, table_rows, row_layout, where)
+        after_matches, after = rows_per_second(scan_with_compiled_predicate, pager, table, table_rows, row_layout, where)
+    assert before_matches == after_matches
+
+    print(f"rows: {table_rows}, matching: {after_matches}")
+    print(f"before (evaluate): {before:,.0f} rows/sec")
+    print(f"after (compiled):  {after:,.0f} rows/sec")
+    print(f"speedup: {after / before:.1f}x")
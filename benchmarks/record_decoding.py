@@ -0,0 +1,98 @@
+"""
+Measures how many table rows per second the record decoder gets through.
+
+Usage: python -m benchmarks.record_decoding companies.db companies
+
+"before" is the old stream based decoder (one stream.read per varint byte and per column), kept here
+only as a baseline. "after" is the buffer based decoder from app/record_parser.py.
+"""
+import io
+import sys
+
+from app.btree import INTERIOR_TABLE_PAGE, LEAF_TABLE_PAGE, read_cell_pointers, read_page
+from app.catalog import load_catalog
+from app.pager import Pager
+from app.record_parser import parse_record
+from app.varint_parser import parse_varint
+from benchmarks.suite import best_seconds
+
+
+def stream_parse_varint(stream):
+    usable_bytes = []
+    for _ in range(9):
+        byte = int.from_bytes(stream.read(1), "big")
+        usable_bytes.append(byte)
+        if byte & 0b10000000 == 0:
+            break
+
+    value = 0
+    for index, usable_byte in enumerate(usable_bytes):
+        usable_size = 8 if index == 8 else 7
+        value = (value << usable_size) + (usable_byte if usable_size == 8 else usable_byte & 0b01111111)
+    return value
+
+
+def stream_parse_record(stream, column_count):
+    initial_position = stream.tell()
+    body_start = initial_position + stream_parse_varint(stream)
+    serial_types = [stream_parse_varint(stream) for _ in range(column_count)]
+    stream.seek(body_start)
+
+    values = []
+    for serial_type in serial_types:
+        if serial_type >= 12:
+            values.append(stream.read((serial_type - 12) // 2))
+        elif serial_type in (0, 8, 9):
+            values.append(None if serial_type == 0 else serial_type - 8)
+        else:
+            width = (0, 1, 2, 3, 4, 6, 8, 8)[serial_type]
+            values.append(int.from_bytes(stream.read(width), "big", signed=True))
+    return values
+
+
+def collect_leaf_cells(pager, page_number, cells):
+    page, page_header = read_page(pager, page_number)
+    if page_header.page_type == LEAF_TABLE_PAGE:
+        cells.extend((page, cell_pointer) for cell_pointer in read_cell_pointers(page, page_header))
+    elif page_header.page_type == INTERIOR_TABLE_PAGE:
+        for cell_pointer in read_cell_pointers(page, page_header):
+            collect_leaf_cells(pager, int.from_bytes(page[cell_pointer:cell_pointer + 4], "big"), cells)
+        collect_leaf_cells(pager, page_header.right_most_pointer, cells)
+    return cells
+
+
+def decode_with_streams(cells, column_count):
+    for page, cell_pointer in cells:
+        stream = io.BytesIO(page)
+        stream.seek(cell_pointer)
+        stream_parse_varint(stream)
+        stream_parse_varint(stream)
+        stream_parse_record(stream, column_count)
+
+
+def decode_with_buffers(cells, column_count):
+    for page, cell_pointer in cells:
+        _, offset = parse_varint(page, cell_pointer)
+        _, offset = parse_varint(page, offset)
+        parse_record(page, offset, column_count)
+
+
+def rows_per_second(decode, cells, column_count, repeat=3):
+    best, _ = best_seconds(lambda: decode(cells, column_count), repeat)
+    return len(cells) / best
+
+
+if __name__ == "__main__":
+    database_file_path, table = sys.argv[1], sys.argv[2]
+
+    with Pager(database_file_path, cache_size=1 << 30) as pager:
+        table_record = load_catalog(pager).get_table(table)
+        cells = collect_leaf_cells(pager, table_record.rootpage, [])
+
+        before = rows_per_second(decode_with_streams, cells, len(table_record.columns))
+        after = rows_per_second(decode_with_buffers, cells, len(table_record.columns))
+
+    print(f"rows: {len(cells)}")
+    print(f"before (stream): {before:,.0f} rows/sec")
+    print(f"after (buffer):  {after:,.0f} rows/sec")
+    print(f"speedup: {after / before:.1f}x")
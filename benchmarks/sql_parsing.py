@@ -0,0 +1,66 @@
+"""
+Measures what parsing costs a query: importing the parser and parsing one statement.
+
+Usage: python -m benchmarks.sql_parsing
+
+"before" is sqlparse, which every query used to import and run twice (once in select_statement and once in
+sql_parser.parse), it is only kept here as a baseline. "after" is the hand-written parser in sql_parser.py,
+"cached" is sql_parser.prepare answering from its statement cache.
+"""
+import subprocess
+import sys
+
+from benchmarks.suite import best_seconds
+from sql_parser import parse, prepare
+
+STATEMENTS = [
+    "select count(*) from companies",
+    "select id, name from companies where country = 'eritrea'",
+    "SELECT name, \"size range\" FROM companies WHERE (country = 'chad' OR id > 1000) AND name LIKE 'a%' ORDER BY name DESC LIMIT 10",
+]
+
+
+def import_seconds(module, repeat=5):
+    """
+    Best wall clock time of a fresh interpreter importing module, minus one that imports nothing.
+    """
+    def best(code):
+        return best_seconds(lambda: subprocess.run([sys.executable, "-c", code], check=True), repeat)[0]
+
+    return best(f"import {module}") - best("pass")
+
+
+def parses_per_second(parse_statement, repeat=3, number=2000):
+    def parse_all():
+        for _ in range(number):
+            for statement in STATEMENTS:
+                parse_statement(statement)
+
+    best, _ = best_seconds(parse_all, repeat)
+    return number * len(STATEMENTS) / best
+
+
+if __name__ == "__main__":
+    try:
+        import sqlparse
+    except ImportError:
+        sqlparse = None
+
+    if sqlparse is not None:
+        def parse_twice_with_sqlparse(statement):
+            sqlparse.parse(statement)
+            sqlparse.parse(statement)
+
+        before_import = import_seconds("sqlparse")
+        before = parses_per_second(parse_twice_with_sqlparse, number=200)
+        print(f"before (sqlparse): import {before_import * 1000:.1f} ms, {before:,.0f} statements/sec")
+    else:
+        print("before (sqlparse): not installed, skipped")
+
+    after_import = import_seconds("sql_parser")
+    after = parses_per_second(parse)
+    cached = parses_per_second(prepare)
+    print(f"after (sql_parser): import {after_import * 1000:.1f} ms, {after:,.0f} statements/sec")
+    print(f"cached (prepare):   {cached:,.0f} statements/sec")
+    if sqlparse is not None:
+        print(f"speedup: {after / before:.0f}x per statement, {before_import * 1000 - after_import * 1000:.1f} ms less startup")
@@ -0,0 +1,192 @@
+"""
+Times the engine's hot paths against the sqlite3 module on a generated database and reports the results as JSON.
+
+Usage: python -m benchmarks.suite [--database bench.db] [--rows 1000000] [--output results.json] [--compare baseline.json]
+
+The database is made by generate_sqlite/script.py (with the default seed, so it's the same every time) unless it
+already exists. Every case is timed twice on each side: "cold" opens the database afresh for each run, with the
+catalog and statement caches emptied, which is what a single CLI invocation pays; "warm" runs on an open database
+whose caches the statement has already filled, as a REPL or server session would. Times are the best of --repeat runs.
+
+Engine statements run through run_command from app/main.py with their output captured, so formatting is timed too.
+The sqlite3 side fetches every row of the equivalent query.
+
+With --compare, engine times are checked against the results of an earlier run and every case that got slower
+by more than --tolerance is reported, making the exit status 1.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+
+from app.catalog import catalog_cache
+from app.main import run_command
+from app.pager import Pager
+from sql_parser import prepare
+
+GENERATOR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "generate_sqlite", "script.py")
+
+
+def get_cases(rows):
+    """
+    (name, engine command, equivalent sqlite3 query) for every case.
+    """
+    return [
+        ("dbinfo", ".dbinfo", "select count(*) from sqlite_schema where type = 'table'"),
+        ("tables", ".tables", "select name from sqlite_schema where type = 'table' and name != 'sqlite_sequence'"),
+        ("full_scan", "select id, name, domain from companies", None),
+        ("filtered_scan", "select id, name from companies where industry = 'retail' and year_founded = '1999'", None),
+        ("count", "select count(*) from companies", None),
+        ("index_equality", "select id, name from companies where country = 'chad'", None),
+        ("rowid_seek", f"select id, name from companies where id = {max(rows // 2, 1)}", None),
+    ]
+
+
+def generate_database(path, rows):
+    print(f"generating {path} with {rows} rows", file=sys.stderr)
+    subprocess.run([sys.executable, GENERATOR, "--path", os.path.abspath(path), "--rows", str(rows)], check=True,
+                   cwd=os.path.dirname(GENERATOR))
+
+
+def measure(run, repeat):
+    """
+    The seconds each of repeat calls of run took, along with what the last one returned.
+    """
+    seconds = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = run()
+        seconds.append(time.perf_counter() - start)
+    return seconds, result
+
+
+def best_seconds(run, repeat=5):
+    """
+    The fastest of repeat calls of run in seconds, along with what the last one returned. The other benchmarks time
+    their before and after with it.
+    """
+    seconds, result = measure(run, repeat)
+    return min(seconds), result
+
+
+def timings(run, repeat):
+    seconds, _ = measure(run, repeat)
+    return {"best_ms": min(seconds) * 1000, "median_ms": statistics.median(seconds) * 1000}
+
+
+def run_engine(pager, command):
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        run_command(pager, command)
+    return output.getvalue()
+
+
+def time_engine(database_path, command, repeat):
+    def cold():
+        catalog_cache.clear()
+        prepare.cache_clear()
+        with Pager(database_path) as pager:
+            run_engine(pager, command)
+
+    with Pager(database_path) as pager:
+        output = run_engine(pager, command) # also warms the caches for the warm runs
+        warm = timings(lambda: run_engine(pager, command), repeat)
+    return output, {"cold": timings(cold, repeat), "warm": warm}
+
+
+def time_sqlite3(database_path, query, repeat):
+    def cold():
+        with contextlib.closing(sqlite3.connect(database_path)) as connection:
+            connection.execute(query).fetchall()
+
+    with contextlib.closing(sqlite3.connect(database_path)) as connection:
+        rows = connection.execute(query).fetchall()
+        warm = timings(lambda: connection.execute(query).fetchall(), repeat)
+    return rows, {"cold": timings(cold, repeat), "warm": warm}
+
+
+def run_suite(database_path, rows, repeat):
+    results = []
+    for name, command, query in get_cases(rows):
+        output, engine = time_engine(database_path, command, repeat)
+        sqlite3_rows, baseline = time_sqlite3(database_path, query or command, repeat)
+        if query is None and len(output.splitlines()) != len(sqlite3_rows):
+            raise Exception(f"{name}: the engine returned {len(output.splitlines())} rows, sqlite3 {len(sqlite3_rows)}")
+        results.append({
+            "name": name,
+            "statement": command,
+            "rows": len(sqlite3_rows),
+            "engine": engine,
+            "sqlite3": baseline,
+            # how many times longer the engine takes than sqlite3
+            "slowdown": {mode: engine[mode]["best_ms"] / max(baseline[mode]["best_ms"], 1e-6) for mode in engine},
+        })
+        print(f"{name:>16}: engine {engine['cold']['best_ms']:9.2f} ms cold {engine['warm']['best_ms']:9.2f} ms warm, "
+              f"sqlite3 {baseline['cold']['best_ms']:8.2f} ms cold {baseline['warm']['best_ms']:8.2f} ms warm", file=sys.stderr)
+    return results
+
+
+def find_regressions(results, baseline_results, tolerance):
+    """
+    The (case, mode, before_ms, after_ms) of every engine time more than tolerance times its time in baseline_results.
+    """
+    before = {case["name"]: case for case in baseline_results["cases"]}
+    regressions = []
+    for case in results["cases"]:
+        if case["name"] not in before:
+            continue
+        for mode, timing in case["engine"].items():
+            before_ms = before[case["name"]]["engine"][mode]["best_ms"]
+            if timing["best_ms"] > before_ms * tolerance:
+                regressions.append((case["name"], mode, before_ms, timing["best_ms"]))
+    return regressions
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.suite")
+    parser.add_argument("--database", default="benchmark_companies.db", help="generated first when it doesn't exist")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="rows of a generated database")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="file to write the JSON results to, standard output when left out")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON results of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=1.2, help="slowdown over the baseline reported as a regression")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments(sys.argv[1:])
+    if not os.path.exists(arguments.database):
+        generate_database(arguments.database, arguments.rows)
+
+    with contextlib.closing(sqlite3.connect(arguments.database)) as connection:
+        rows = connection.execute("select count(*) from companies").fetchone()[0]
+    results = {
+        "database": arguments.database,
+        "rows": rows,
+        "python": platform.python_version(),
+        "sqlite_version": sqlite3.sqlite_version,
+        "repeat": arguments.repeat,
+        "cases": run_suite(arguments.database, rows, arguments.repeat),
+    }
+
+    if arguments.output:
+        with open(arguments.output, "w") as output:
+            json.dump(results, output, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if arguments.compare:
+        with open(arguments.compare) as baseline:
+            regressions = find_regressions(results, json.load(baseline), arguments.tolerance)
+        for name, mode, before_ms, after_ms in regressions:
+            print(f"regression: {name} ({mode}) {before_ms:.2f} ms -> {after_ms:.2f} ms", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
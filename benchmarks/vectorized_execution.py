@@ -0,0 +1,47 @@
+"""
+Measures how many table rows per second a statement gets through row by row and a batch of columns at a time.
+
+Usage: python -m benchmarks.vectorized_execution companies.db "select country, count(*), max(id) from companies group by country"
+
+"before" is select_statement from app/main.py as it runs by default, decoding, filtering and aggregating one row
+tuple at a time. "after" is the same statement with vectorized=True, which works on ColumnBatches from
+app/vectorized.py. Output is thrown away in both cases. Set NUMPY=0 in the environment to see how batches do
+without NumPy.
+"""
+import contextlib
+import io
+import os
+import sys
+
+from app import vectorized
+from app.btree import count_table_rows
+from app.catalog import load_catalog
+from app.main import select_statement
+from app.pager import Pager
+from benchmarks.suite import best_seconds
+from sql_parser import parse
+
+
+def run_statement(pager, statement, use_batches):
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        select_statement(pager, statement, vectorized=use_batches)
+    return output.getvalue()
+
+
+if __name__ == "__main__":
+    database_file_path, statement = sys.argv[1], sys.argv[2]
+    if os.environ.get("NUMPY") == "0":
+        vectorized.numpy = None
+
+    with Pager(database_file_path, cache_size=1 << 30) as pager:
+        table = load_catalog(pager).get_table(parse(statement)["from"][0]["table"])
+        table_rows = count_table_rows(pager, table.rootpage)
+        # warms the page cache and the planner's statistics for both sides, and checks they agree
+        assert run_statement(pager, statement, False) == run_statement(pager, statement, True)
+        before, _ = best_seconds(lambda: run_statement(pager, statement, False))
+        after, _ = best_seconds(lambda: run_statement(pager, statement, True))
+
+    print(f"rows: {table_rows}, numpy: {'no' if vectorized.numpy is None else 'yes'}")
+    print(f"before (row at a time): {table_rows / before:,.0f} rows/sec")
+    print(f"after (column batches): {table_rows / after:,.0f} rows/sec")
+    print(f"speedup: {after and before / after:.1f}x")
@@ -0,0 +1,42 @@
+"""
+Measures scans filtered on columns without an index, with and without the zone maps of the table.
+
+Usage: python -m benchmarks.zone_maps bench.db items "select count(*) from items where category = 'c7' and price > 990" category price
+
+The zone maps of the columns named after the statement are built first, written to the database's -zonemap sidecar
+file. "before" scans the table the way it was scanned before zone maps: the catalog is given none, so every leaf page
+is read and every row tested. "after" loads the sidecar and reads only the leaf pages whose minimums, maximums and
+Bloom filters leave room for a matching row. Each run starts from a fresh Pager, so pages come from the file (and
+the OS cache) rather than the page cache. Pages read are reported along with times.
+"""
+import sys
+
+from app.catalog import load_catalog
+from app.main import query_rows
+from app.pager import Pager
+from app.zonemaps import add_zone_map
+from benchmarks.suite import best_seconds
+
+
+def run_statement(database_file_path, statement, zone_maps):
+    with Pager(database_file_path) as pager:
+        catalog = load_catalog(pager)
+        catalog.zone_maps = None if zone_maps else {} # None has get_zone_maps load the sidecar again
+        rows = list(query_rows(pager, statement))
+        return rows, pager.misses
+
+
+if __name__ == "__main__":
+    database_file_path, table_name, statement, columns = sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4:]
+
+    with Pager(database_file_path) as pager:
+        add_zone_map(pager, table_name, columns)
+
+    before, (before_rows, before_pages) = best_seconds(lambda: run_statement(database_file_path, statement, zone_maps=False))
+    after, (after_rows, after_pages) = best_seconds(lambda: run_statement(database_file_path, statement, zone_maps=True))
+    assert sorted(before_rows) == sorted(after_rows)
+
+    print(f"rows: {len(after_rows):,}")
+    print(f"before (every leaf page): {before * 1000:,.2f} ms, {before_pages} pages read")
+    print(f"after (zone maps): {after * 1000:,.2f} ms, {after_pages} pages read")
+    print(f"speedup: {before / after:.1f}x")
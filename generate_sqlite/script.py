@@ -1,28 +1,107 @@
+import argparse
+import os
+import random
 import sqlite3
+import string
 from countries import countries
-import random
 
-con = sqlite3.connect('companies.db')
-cur = con.cursor()
+# Usage: python script.py --rows 10000000 --path companies.db
+#
+# Builds a companies table shaped like the one in the sample companies.db. The same arguments and seed always
+# produce the same rows, so benchmarks run against the same data every time.
+
+SCHEMA = '''create table companies (id integer primary key autoincrement, name text, domain text, year_founded text,
+industry text, "size range" text, locality text, country text, current_employees text, total_employees text)'''
 
 test_countries = ['chad', 'myanmar', 'suriname', 'thailand']
-#(name, domain, year_founded_industry, size range, locality, country, current_employees, total_employe)
+# rows that get one of the rare test countries, so lookups on them return a handful of rows from anywhere in the table
+test_rows = [69, 420, 3829, 19348, 390239, 794832, 2000345, 5901392]
+
+industries = ['computer software', 'information technology and services', 'hospital & health care', 'marketing and advertising',
+              'financial services', 'construction', 'education management', 'retail', 'real estate', 'automotive']
+size_ranges = ['1 - 10', '11 - 50', '51 - 200', '201 - 500', '501 - 1000', '1001 - 5000', '5001 - 10000', '10001+']
+
+WORD_POOL_SIZE = 4096 # distinct random words names and localities are made of
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Generate a synthetic companies database")
+    parser.add_argument("--path", default="companies.db")
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--batch-size", type=int, default=50_000, help="rows inserted per executemany and transaction")
+    parser.add_argument("--name-width", type=int, default=12, help="length of the random word names start with")
+    parser.add_argument("--indexes", default="country", help="comma separated columns to index, empty for none")
+    parser.add_argument("--skew", type=float, default=0.0, help="zipf exponent of the country distribution, 0 is uniform")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def random_words(rng, count, width):
+    return [''.join(rng.choices(string.ascii_lowercase, k=width)) for _ in range(count)]
+
+
+def country_weights(skew):
+    # the i-th country is picked with a weight of 1 / i^skew
+    return [1 / (rank ** skew) for rank in range(1, len(countries) + 1)]
+
+
+def generate_rows(rng, start, count, names, localities, weights):
+    """
+    The rows with ids start + 1 to start + count, built a column at a time.
+    """
+    country_column = [country.lower() for country in rng.choices(countries, weights=weights, k=count)]
+    for row in test_rows:
+        if start <= row < start + count:
+            country_column[row - start] = rng.choice(test_countries)
+
+    name_column = [f'{name} {start + i}' for i, name in enumerate(rng.choices(names, k=count))]
+    domain_column = [f'{name.replace(" ", "")}.com' for name in name_column]
+    year_column = [str(year) for year in rng.choices(range(1900, 2024), k=count)]
+    employees = rng.choices(range(1, 100_000), k=count)
+    return zip(
+        name_column,
+        domain_column,
+        year_column,
+        rng.choices(industries, k=count),
+        rng.choices(size_ranges, k=count),
+        [f'{locality}, {country}' for locality, country in zip(rng.choices(localities, k=count), country_column)],
+        country_column,
+        [str(employee) for employee in employees],
+        [str(employee + rng.randrange(1000)) for employee in employees],
+    )
 
 
-n = 10000000
+def main():
+    arguments = parse_arguments()
+    rng = random.Random(arguments.seed)
+    names = random_words(rng, WORD_POOL_SIZE, arguments.name_width)
+    localities = random_words(rng, WORD_POOL_SIZE, 8)
+    weights = country_weights(arguments.skew)
 
-for i in range(n):
-    if i in [69, 420, 3829, 19348, 390239, 794832, 2000345, 5901392]:
-        country = random.choice(test_countries)
-    else:
-        country = random.choice(countries)
+    if os.path.exists(arguments.path):
+        os.remove(arguments.path)
+    con = sqlite3.connect(arguments.path, isolation_level=None)
+    cur = con.cursor()
+    # a half written file is thrown away rather than recovered, so there's no need for a journal
+    cur.execute('pragma journal_mode = off')
+    cur.execute('pragma synchronous = off')
+    cur.execute(SCHEMA)
 
-    cur.execute('insert into companies (name, domain, year_founded, industry, "size range", locality, country, current_employees, total_employees) values (?, ?, ?, ?, ?, ?, ?, ?, ?)',
-            ['blah blah blah', 'blah blah', '2003', 'lol', 'bah', 'lol392 blah bahl', country.lower(), 393, 930])
+    for start in range(0, arguments.rows, arguments.batch_size):
+        count = min(arguments.batch_size, arguments.rows - start)
+        cur.execute('begin')
+        cur.executemany('insert into companies (name, domain, year_founded, industry, "size range", locality, country, current_employees, total_employees) values (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        generate_rows(rng, start, count, names, localities, weights))
+        cur.execute('commit')
 
-con.commit()
+    # built after the rows are in, which is much faster than keeping them up to date row by row
+    for column in filter(None, arguments.indexes.split(',')):
+        column = column.strip()
+        cur.execute(f'create index "idx_companies_{column.replace(" ", "_")}" on companies ("{column}")')
 
+    cur.close()
+    con.close()
 
 
-cur.close()
-con.close()
+if __name__ == "__main__":
+    main()
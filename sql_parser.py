@@ -1,81 +1,353 @@
 '''
+A small recursive descent parser for the SELECT statements we support. The AST follows the shape node-sql-parser uses:
+
 ast = {
     'type': 'select',
-    'columns': [{
-        'expr': {'type': 'column_ref', column: 'id'}
-        }],
-    'from': [{'table': ''}],
-    'where': {'type': 'binary_expr', 'operator': '=', left: {'type': 'column_ref', 'column': 'id'}, right: {'type': 'number', value: 1}} # this entire thing is a binary expression. row is compared against this. type can also be string or single quote string 
-}
-{
-  type: 'aggr_func',
-  name: 'COUNT',
-  args: { expr: { type: 'star', value: '*' } },
-  over: null
+    'columns': [
+        {'expr': {'type': 'column_ref', 'column': 'id'}, 'as': None},
+        {'expr': {'type': 'aggr_func', 'name': 'COUNT', 'args': {'expr': {'type': 'star', 'value': '*'}, 'distinct': False}}, 'as': None},
+    ],
+    'from': [
+        {'table': 'apples', 'as': 'a'},
+        {'table': 'oranges', 'as': None, 'join': 'LEFT JOIN', 'on': {'type': 'binary_expr', 'operator': '=', 'left': ..., 'right': ...}},
+    ],
+    'where': {'type': 'binary_expr', 'operator': '=', 'left': {'type': 'column_ref', 'column': 'id'}, 'right': {'type': 'number', 'value': 1}},
+    'groupby': [{'type': 'column_ref', 'column': 'color'}],
+    'orderby': [{'expr': {'type': 'column_ref', 'column': 'name'}, 'type': 'DESC'}],
+    'limit': {'value': 10, 'offset': 0},
+    'explain': False,
 }
+
+where, groupby, orderby and limit are None when the statement doesn't have them. SELECT * has a single column_ref to '*'.
+Qualified column names (a.color, a.*) have the table name or alias in a 'table' key, which is left out otherwise.
+join is INNER JOIN, LEFT JOIN or CROSS JOIN (also for a comma), on is None without an ON clause.
+explain is True for EXPLAIN QUERY PLAN SELECT ...
 '''
-import sqlparse 
-from sqlparse.sql import IdentifierList, Function, Identifier, Comparison, Where
+import re
+from functools import lru_cache
+
+STATEMENT_CACHE_SIZE = 256 # parsed statements kept by prepare
+
+KEYWORDS = {
+    'EXPLAIN', 'SELECT', 'DISTINCT', 'FROM', 'WHERE', 'AND', 'OR', 'NOT', 'BETWEEN', 'LIKE', 'ORDER', 'BY', 'ASC', 'DESC',
+    'LIMIT', 'OFFSET', 'AS', 'IN', 'IS', 'NULL', 'GROUP', 'JOIN', 'INNER', 'LEFT', 'OUTER', 'CROSS', 'ON',
+}
+AGGREGATES = {'COUNT', 'SUM', 'AVG', 'MIN', 'MAX'}
+COMPARISON_OPERATORS = {'=', '==', '!=', '<>', '<', '<=', '>', '>='}
+
+TOKEN_PATTERN = re.compile(r"""
+    (?P<whitespace>\s+|--[^\n]*)
+  | (?P<number>(?:\d+\.\d*|\.\d+|\d+)(?:[eE][+-]?\d+)?)
+  | (?P<string>'(?:[^']|'')*')
+  | (?P<quoted>"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\])
+  | (?P<word>[A-Za-z_][A-Za-z_0-9$]*)
+  | (?P<operator>==|!=|<>|<=|>=|[=<>*,;().+-])
+""", re.VERBOSE)
+
+def tokenize(statement):
+    """
+    Splits a statement into (kind, value) tuples. kind is one of number, string, identifier, keyword or operator,
+    keywords are upper cased and quoted identifiers and strings come back without their quotes.
+    """
+    tokens = []
+    position = 0
+    while position < len(statement):
+        match = TOKEN_PATTERN.match(statement, position)
+        if match is None:
+            raise Exception(f'unrecognized token: "{statement[position:position + 10]}"')
+        position = match.end()
+        kind, text = match.lastgroup, match.group()
+
+        if kind == 'whitespace':
+            continue
+        elif kind == 'number':
+            tokens.append(('number', float(text) if any(char in text for char in '.eE') else int(text)))
+        elif kind == 'string':
+            tokens.append(('string', text[1:-1].replace("''", "'")))
+        elif kind == 'quoted':
+            # "size range" style quoted column names
+            tokens.append(('identifier', text[1:-1].replace('""', '"') if text[0] == '"' else text[1:-1]))
+        elif kind == 'word' and text.upper() in KEYWORDS:
+            tokens.append(('keyword', text.upper()))
+        elif kind == 'word':
+            tokens.append(('identifier', text))
+        else:
+            tokens.append(('operator', text))
+    return tokens
+
+class Parser:
+    """
+    Recursive descent over the tokens of a statement:
+
+        statement      := [EXPLAIN QUERY PLAN] select
+        select         := SELECT result_column (',' result_column)* FROM table (join_operator table [ON expr])* [WHERE expr]
+                          [GROUP BY column (',' column)*] [ORDER BY ordering_term (',' ordering_term)*]
+                          [LIMIT signed_number [(OFFSET | ',') signed_number]] [';']
+        table          := name [[AS] name]
+        join_operator  := ',' | [INNER] JOIN | LEFT [OUTER] JOIN | CROSS JOIN
+        result_column  := '*' | name '.' '*' | (aggregate_call | column) [[AS] name]
+        aggregate_call := aggregate '(' ('*' | [DISTINCT] column) ')'
+        ordering_term  := (aggregate_call | column) [ASC | DESC]
+        column         := [name '.'] name
+        expr           := and_expr (OR and_expr)*
+        and_expr       := not_expr (AND not_expr)*
+        not_expr       := NOT not_expr | predicate
+        predicate      := '(' expr ')' | operand (comparison operand | [NOT] BETWEEN operand AND operand | [NOT] LIKE operand
+                          | [NOT] IN '(' operand (',' operand)* ')' | IS [NOT] NULL)
+        operand        := column | string | ['-'] number | NULL
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self, offset=0):
+        position = self.position + offset
+        return self.tokens[position] if position < len(self.tokens) else (None, None)
+
+    def advance(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def error(self):
+        kind, value = self.peek()
+        if kind is None:
+            return Exception("incomplete input")
+        return Exception(f'near "{value}": syntax error')
+
+    def accept(self, kind, value=None):
+        """
+        Consumes the next token if it matches, returning whether it did.
+        """
+        next_kind, next_value = self.peek()
+        if next_kind == kind and (value is None or next_value == value):
+            self.position += 1
+            return True
+        return False
+
+    def expect(self, kind, value=None):
+        next_kind, next_value = self.peek()
+        if next_kind != kind or (value is not None and next_value != value):
+            raise self.error()
+        self.position += 1
+        return next_value
+
+    def name(self):
+        return self.expect('identifier')
 
-def get_tablename(tokens):
-    # returns the first instance of identifer after the from keyword
+    def statement(self):
+        explain = self.accept('keyword', 'EXPLAIN')
+        if explain:
+            # QUERY and PLAN aren't reserved, columns may be called that
+            for word in ('QUERY', 'PLAN'):
+                if self.peek()[0] != 'identifier' or self.peek()[1].upper() != word:
+                    raise self.error()
+                self.position += 1
 
-    from_clause_reached = False 
-    for token in tokens:
-        if token.value.lower() == 'from':
-            from_clause_reached = True
-        if from_clause_reached:
-            if type(token) == Identifier:
-                return token.value
+        ast = self.select()
+        ast['explain'] = explain
+        return ast
 
-def get_where_clause(tokens):
-    for token in tokens:
-        if type(token) == Where:
-            return token 
+    def select(self):
+        self.expect('keyword', 'SELECT')
+        columns = [self.result_column()]
+        while self.accept('operator', ','):
+            columns.append(self.result_column())
 
-    return None
+        self.expect('keyword', 'FROM')
+        tables = [self.table()]
+        while True:
+            join = self.join_operator()
+            if join is None:
+                break
+            table = self.table()
+            table['join'] = join
+            table['on'] = self.expr() if self.accept('keyword', 'ON') else None
+            tables.append(table)
 
-def get_comparison(tokens):
-    for token in tokens:
-        if type(token) == Comparison:
-            return token
+        ast = {
+            'type': 'select',
+            'columns': columns,
+            'from': tables,
+            'where': self.expr() if self.accept('keyword', 'WHERE') else None,
+            'groupby': None,
+            'orderby': None,
+            'limit': None,
+        }
 
-    return None
+        if self.accept('keyword', 'GROUP'):
+            self.expect('keyword', 'BY')
+            ast['groupby'] = [self.column()]
+            while self.accept('operator', ','):
+                ast['groupby'].append(self.column())
 
-def get_col_and_value(token):
-    return (token.left.value, token.right.value)
+        if self.accept('keyword', 'ORDER'):
+            self.expect('keyword', 'BY')
+            ast['orderby'] = [self.ordering_term()]
+            while self.accept('operator', ','):
+                ast['orderby'].append(self.ordering_term())
 
-def get_where_condition(tokens):
-    where_clause = get_where_clause(tokens)
-    if where_clause:
-        comparison = get_comparison(where_clause.tokens)
-        if comparison:
-            return get_col_and_value(comparison)
+        if self.accept('keyword', 'LIMIT'):
+            limit, offset = self.signed_number(), 0
+            if self.accept('keyword', 'OFFSET'):
+                offset = self.signed_number()
+            elif self.accept('operator', ','):
+                # LIMIT offset, count
+                limit, offset = self.signed_number(), limit
+            ast['limit'] = {'value': limit, 'offset': offset}
 
-    return None
+        self.accept('operator', ';')
+        if self.peek()[0] is not None:
+            raise self.error()
+        return ast
+
+    def table(self):
+        table = {'table': self.name(), 'as': None}
+        if self.accept('keyword', 'AS') or self.peek()[0] == 'identifier':
+            table['as'] = self.name()
+        return table
+
+    def join_operator(self):
+        if self.accept('operator', ','):
+            return 'CROSS JOIN'
+        elif self.accept('keyword', 'LEFT'):
+            self.accept('keyword', 'OUTER')
+            join = 'LEFT JOIN'
+        elif self.accept('keyword', 'CROSS'):
+            join = 'CROSS JOIN'
+        elif self.accept('keyword', 'INNER') or self.peek() == ('keyword', 'JOIN'):
+            join = 'INNER JOIN'
+        else:
+            return None
+        self.expect('keyword', 'JOIN')
+        return join
+
+    def column(self):
+        name = self.name()
+        if self.accept('operator', '.'):
+            return {'type': 'column_ref', 'table': name, 'column': self.name()}
+        return {'type': 'column_ref', 'column': name}
+
+    def result_column(self):
+        if self.accept('operator', '*'):
+            return {'expr': {'type': 'column_ref', 'column': '*'}, 'as': None}
+        if self.peek()[0] == 'identifier' and self.peek(1) == ('operator', '.') and self.peek(2) == ('operator', '*'):
+            table = self.name()
+            self.position += 2
+            return {'expr': {'type': 'column_ref', 'table': table, 'column': '*'}, 'as': None}
+
+        expr = self.aggregate_call() if self.at_aggregate_call() else self.column()
+
+        alias = None
+        if self.accept('keyword', 'AS') or self.peek()[0] == 'identifier':
+            alias = self.name()
+        return {'expr': expr, 'as': alias}
+
+    def at_aggregate_call(self):
+        kind, value = self.peek()
+        return kind == 'identifier' and value.upper() in AGGREGATES and self.peek(1) == ('operator', '(')
+
+    def aggregate_call(self):
+        name = self.name().upper()
+        self.expect('operator', '(')
+        if self.accept('operator', '*'):
+            args = {'expr': {'type': 'star', 'value': '*'}, 'distinct': False}
+        else:
+            distinct = self.accept('keyword', 'DISTINCT')
+            args = {'expr': self.column(), 'distinct': distinct}
+        self.expect('operator', ')')
+        return {'type': 'aggr_func', 'name': name, 'args': args}
+
+    def ordering_term(self):
+        expr = self.aggregate_call() if self.at_aggregate_call() else self.column()
+        term = {'expr': expr, 'type': 'ASC'}
+        if self.accept('keyword', 'DESC'):
+            term['type'] = 'DESC'
+        else:
+            self.accept('keyword', 'ASC')
+        return term
+
+    def operand(self):
+        kind, value = self.advance()
+        if kind == 'identifier':
+            self.position -= 1
+            return self.column()
+        elif kind == 'string':
+            return {'type': 'single_quote_string', 'value': value}
+        elif kind == 'number':
+            return {'type': 'number', 'value': value}
+        elif (kind, value) == ('keyword', 'NULL'):
+            return {'type': 'null', 'value': None}
+        elif (kind, value) == ('operator', '-'):
+            return {'type': 'number', 'value': -self.expect('number')}
+        self.position -= 1
+        raise self.error()
+
+    def signed_number(self):
+        sign = -1 if self.accept('operator', '-') else 1
+        return sign * self.expect('number')
+
+    def expr(self):
+        left = self.and_expr()
+        while self.accept('keyword', 'OR'):
+            left = {'type': 'binary_expr', 'operator': 'OR', 'left': left, 'right': self.and_expr()}
+        return left
+
+    def and_expr(self):
+        left = self.not_expr()
+        while self.accept('keyword', 'AND'):
+            left = {'type': 'binary_expr', 'operator': 'AND', 'left': left, 'right': self.not_expr()}
+        return left
+
+    def not_expr(self):
+        if self.accept('keyword', 'NOT'):
+            return {'type': 'unary_expr', 'operator': 'NOT', 'expr': self.not_expr()}
+        return self.predicate()
+
+    def predicate(self):
+        if self.accept('operator', '('):
+            inner = self.expr()
+            self.expect('operator', ')')
+            return inner
+
+        left = self.operand()
+        negated = self.accept('keyword', 'NOT')
+        kind, value = self.advance()
+        if kind == 'operator' and value in COMPARISON_OPERATORS and not negated:
+            operator, right = value, self.operand()
+        elif (kind, value) == ('keyword', 'BETWEEN'):
+            low = self.operand()
+            self.expect('keyword', 'AND')
+            operator, right = 'BETWEEN', {'type': 'expr_list', 'value': [low, self.operand()]}
+        elif (kind, value) == ('keyword', 'LIKE'):
+            operator, right = 'LIKE', self.operand()
+        elif (kind, value) == ('keyword', 'IN'):
+            self.expect('operator', '(')
+            values = [self.operand()]
+            while self.accept('operator', ','):
+                values.append(self.operand())
+            self.expect('operator', ')')
+            operator, right = 'IN', {'type': 'expr_list', 'value': values}
+        elif (kind, value) == ('keyword', 'IS') and not negated:
+            operator = 'IS NOT' if self.accept('keyword', 'NOT') else 'IS'
+            self.expect('keyword', 'NULL')
+            right = {'type': 'null', 'value': None}
+        else:
+            self.position -= 1
+            raise self.error()
+
+        if negated:
+            operator = 'NOT ' + operator
+        return {'type': 'binary_expr', 'operator': operator, 'left': left, 'right': right}
 
 def parse(statement):
-    sql_tokens = sqlparse.parse(statement)[0].tokens
-    ast = {
-        "type": "select",
-        'from': [{"table": get_tablename(sql_tokens)}],
-    }
-
-    columns = []
-    identifiers = sql_tokens[2] 
-    if type(identifiers) == Function:
-        # count
-        columns.append({'type': 'aggr_func', 'name': 'COUNT', 'args':{ 'expr': { 'type': 'star', 'value': '*' }}})
-    elif type(identifiers) == Identifier:
-        columns.append({'expr': {'type': 'column_ref', 'column': identifiers.value}})
-    elif type(identifiers) == IdentifierList:  
-        # select statement with columsn
-
-        # get the names of all the columns
-        for token in identifiers:
-            if type(token) == Identifier:
-                columns.append({'expr': {'type': 'column_ref', 'column': token.value}})
-
-    ast["columns"] = columns
-
-    return ast
+    return Parser(tokenize(statement)).statement()
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def prepare(statement):
+    """
+    parse with a cache keyed on the statement text, for sessions that run the same statements again.
+    The returned AST is shared between callers and must not be modified.
+    """
+    return parse(statement)